@@ -10,3 +10,4 @@ admin.site.register(models.AbonStreet)
 admin.site.register(models.AbonRawPassword)
 admin.site.register(models.PassportInfo)
 admin.site.register(models.AdditionalTelephone)
+admin.site.register(models.AbonLease)
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class AbonappConfig(AppConfig):
     name = 'abonapp'
     verbose_name = 'Abonent app'
+
+    def ready(self):
+        # connects signals that invalidate index for dhcp events
+        from agent.commands import dhcp_index  # noqa
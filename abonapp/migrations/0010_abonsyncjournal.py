@@ -0,0 +1,29 @@
+# Generated by Django 2.1 on 2026-10-16 12:00
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gw_app', '0004_nasmodel_last_full_sync'),
+        ('abonapp', '0009_auto_20181123_1556'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AbonSyncJournal',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ip_address', models.GenericIPAddressField(blank=True, null=True)),
+                ('date', models.DateTimeField(auto_now_add=True)),
+                ('abon', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='abonapp.Abon')),
+                ('nas', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='gw_app.NASModel')),
+            ],
+            options={
+                'db_table': 'abonent_sync_journal',
+                'ordering': ('id',),
+            },
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 2.1 on 2026-10-16 12:00
+
+import django.db.models.deletion
+import djing.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('devapp', '0001_squashed_0005_device_ip_address_change'),
+        ('abonapp', '0010_abonsyncjournal'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AbonLease',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ip_address', models.GenericIPAddressField(verbose_name='Ip address')),
+                ('mac_address', djing.fields.MACAddressField(blank=True, integer=True, null=True, verbose_name='Mac address')),
+                ('port', models.PositiveSmallIntegerField(blank=True, null=True, verbose_name='Port')),
+                ('lease_start', models.DateTimeField(verbose_name='Lease start')),
+                ('last_seen', models.DateTimeField(db_index=True, verbose_name='Last seen')),
+                ('lease_end', models.DateTimeField(blank=True, null=True, verbose_name='Lease end')),
+                ('abon', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='abonapp.Abon')),
+                ('device', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='devapp.Device', verbose_name='Device')),
+            ],
+            options={
+                'db_table': 'abonent_lease',
+                'ordering': ('-lease_start',),
+                'index_together': {('ip_address', 'lease_start')},
+            },
+        ),
+    ]
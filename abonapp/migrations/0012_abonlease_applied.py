@@ -0,0 +1,24 @@
+# Generated by Django 2.1 on 2026-10-16 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('abonapp', '0011_abonlease'),
+    ]
+
+    operations = [
+        # leases that exist are already in subscribers
+        migrations.AddField(
+            model_name='abonlease',
+            name='applied',
+            field=models.BooleanField(db_index=True, default=True),
+        ),
+        migrations.AlterField(
+            model_name='abonlease',
+            name='applied',
+            field=models.BooleanField(db_index=True, default=False),
+        ),
+    ]
@@ -1,4 +1,4 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 from typing import Optional
 
 from accounts_app.models import UserProfile, MyUserManager, BaseAccount
@@ -7,11 +7,12 @@ from django.conf import settings
 from django.core import validators
 from django.core.validators import RegexValidator
 from django.db import models, transaction
-from django.db.models.signals import post_init, pre_save
+from django.db.models.signals import post_init, pre_save, post_save
 from django.dispatch import receiver
 from django.shortcuts import resolve_url
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _, gettext
+from djing.fields import MACAddressField
 from djing.lib import LogicError
 from group_app.models import Group
 from gw_app.nas_managers import SubnetQueue, NasFailedResult, NasNetworkError
@@ -96,6 +97,15 @@ class AbonManager(MyUserManager):
             params=(group_ids, str(nas_id))
         )
 
+    def for_nas_sync(self, nas_id: int):
+        """Subscribers of gateway ordered by ip, gateway managers merge them"""
+        return self.filter(is_active=True, nas_id=nas_id) \
+            .exclude(current_tariff=None, ip_address=None) \
+            .select_related('current_tariff__tariff') \
+            .extra(select={'ip_num': 'inet_aton(ip_address)'},
+                   order_by=('ip_num',)) \
+            .iterator()
+
 
 class Abon(BaseAccount):
     current_tariff = models.OneToOneField(
@@ -323,9 +333,10 @@ class Abon(BaseAccount):
                 is_access=self.is_access()
             )
 
-    def nas_sync_self(self) -> Optional[Exception]:
+    def nas_sync_self(self, mngr=None) -> Optional[Exception]:
         """
         Synchronize user with gateway
+        :param mngr: already connected manager of user gateway
         :return:
         """
         if self.nas is None:
@@ -333,7 +344,8 @@ class Abon(BaseAccount):
         try:
             agent_abon = self.build_agent_struct()
             if agent_abon is not None:
-                mngr = self.nas.get_nas_manager()
+                if mngr is None:
+                    mngr = self.nas.get_nas_manager()
                 mngr.update_user(agent_abon)
         except (NasFailedResult, NasNetworkError, ConnectionResetError) as e:
             print('ERROR:', e)
@@ -341,9 +353,10 @@ class Abon(BaseAccount):
         except LogicError:
             pass
 
-    def nas_add_self(self):
+    def nas_add_self(self, mngr=None):
         """
         Will add this user to network access server
+        :param mngr: already connected manager of user gateway
         :return:
         """
         if self.nas is None:
@@ -351,7 +364,8 @@ class Abon(BaseAccount):
         try:
             agent_abon = self.build_agent_struct()
             if agent_abon is not None:
-                mngr = self.nas.get_nas_manager()
+                if mngr is None:
+                    mngr = self.nas.get_nas_manager()
                 mngr.add_user(agent_abon)
         except (NasFailedResult, NasNetworkError, ConnectionResetError) as e:
             print('ERROR:', e)
@@ -383,6 +397,259 @@ class Abon(BaseAccount):
         self.save(update_fields=('current_tariff', 'last_connected_tariff'))
 
 
+class AbonSyncJournalManager(models.Manager):
+    def mark_changed(self, abon_queryset) -> int:
+        """
+        Remember that subscribers from queryset must be synchronized
+        with their gateways.
+        :param abon_queryset: QuerySet of Abon
+        :return: count of journal records
+        """
+        records = tuple(AbonSyncJournal(
+            abon_id=abon_id, nas_id=nas_id, ip_address=ip
+        ) for abon_id, nas_id, ip in abon_queryset.exclude(nas=None).values_list(
+            'pk', 'nas_id', 'ip_address'
+        ).iterator())
+        self.bulk_create(records)
+        return len(records)
+
+    def mark_synced(self, abon_id: int, nas_id: int, last_id: int) -> None:
+        """
+        Forget changes of subscriber that was pushed to gateway
+        :param last_id: max journal id that was before push
+        """
+        self.filter(abon_id=abon_id, nas_id=nas_id, id__lte=last_id).delete()
+
+    def get_last_id(self, **filters) -> Optional[int]:
+        return self.filter(**filters).aggregate(
+            last_id=models.Max('id')
+        ).get('last_id')
+
+    def get_changes(self, nas_id: int, last_id: int):
+        """
+        Make lists of subscribers that was changed for gateway
+        :param nas_id: gateway id
+        :param last_id: max journal id that is taken into account
+        :return: tuple of SubnetQueue for update and SubnetQueue for remove
+        """
+        records = self.filter(nas_id=nas_id, id__lte=last_id).values_list(
+            'abon_id', 'ip_address'
+        )
+        changed_ips = {}
+        for abon_id, ip in records.iterator():
+            changed_ips.setdefault(abon_id, set())
+            if ip:
+                changed_ips[abon_id].add(ip)
+        queues_for_update, queues_for_remove = [], {}
+        abons = Abon.objects.filter(pk__in=changed_ips.keys()).select_related(
+            'current_tariff__tariff'
+        )
+        for abon in abons.iterator():
+            queue = None
+            if abon.nas_id == nas_id and abon.is_access():
+                queue = abon.build_agent_struct()
+            if queue is None:
+                if abon.ip_address:
+                    changed_ips[abon.pk].add(abon.ip_address)
+            else:
+                queues_for_update.append(queue)
+                changed_ips[abon.pk].discard(str(queue.network.network_address))
+            for ip in changed_ips[abon.pk]:
+                queues_for_remove[(abon.pk, ip)] = SubnetQueue(
+                    name="uid%d" % abon.pk,
+                    network=ip,
+                    is_access=False
+                )
+        return queues_for_update, tuple(queues_for_remove.values())
+
+
+class AbonSyncJournal(models.Model):
+    """
+    Subscribers whose state on gateway may be outdated.
+    Records are removed after successful sync with gateway.
+    """
+    abon = models.ForeignKey(Abon, on_delete=models.CASCADE)
+    nas = models.ForeignKey('gw_app.NASModel', on_delete=models.CASCADE)
+    # Ip address of subscriber that may be on gateway now
+    ip_address = models.GenericIPAddressField(null=True, blank=True)
+    date = models.DateTimeField(auto_now_add=True)
+
+    objects = AbonSyncJournalManager()
+
+    def __str__(self):
+        return "%s: %s" % (self.date, self.abon_id)
+
+    class Meta:
+        db_table = 'abonent_sync_journal'
+        ordering = ('id',)
+
+
+# Lease of ip is considered expired when it is not renewed during this time,
+# it must be not less than max-lease-time of dhcpd. Leases that are not
+# renewed are not expired when it is not set, dhcp expiry events only.
+_dhcp_lease_time = getattr(settings, 'DHCP_LEASE_TIME', None)
+DHCP_LEASE_TIME = timedelta(seconds=_dhcp_lease_time) if _dhcp_lease_time else None
+
+# Renewal of lease is written not often than this time
+DHCP_LEASE_TOUCH_INTERVAL = timedelta(
+    seconds=getattr(settings, 'DHCP_LEASE_TOUCH_INTERVAL', 60 * 10)
+)
+
+
+class AbonLeaseManager(models.Manager):
+    def open_lease(self, ip: str, abon_id: int, mac=None, device_id=None,
+                   port_num=None, now=None):
+        """
+        Remember that ip is leased to subscriber. It is only one insert,
+        previous lease of this ip is closed by being older, and
+        subscriber gets the ip later by apply_pending
+        """
+        if now is None:
+            now = timezone.now()
+        return self.create(
+            ip_address=ip, abon_id=abon_id, mac_address=mac,
+            device_id=device_id, port=port_num,
+            lease_start=now, last_seen=now
+        )
+
+    def current(self, ip: str) -> Optional['AbonLease']:
+        """
+        Open lease of ip, it is the last started lease of ip
+        when it has no end
+        """
+        lease = self.filter(ip_address=ip).order_by('-lease_start', '-pk').first()
+        if lease is not None and lease.lease_end is None:
+            return lease
+
+    def touch(self, lease: 'AbonLease', now=None) -> None:
+        """
+        Lease is renewed, last_seen is updated not often
+        than DHCP_LEASE_TOUCH_INTERVAL to keep renewals cheap
+        """
+        if now is None:
+            now = timezone.now()
+        if lease.last_seen < now - DHCP_LEASE_TOUCH_INTERVAL:
+            self.filter(pk=lease.pk, lease_end=None).update(last_seen=now)
+
+    def close(self, ip: str, now=None) -> int:
+        """
+        Close open leases of ip, subscriber loses the ip by apply_pending
+        :return: count of closed leases
+        """
+        if now is None:
+            now = timezone.now()
+        return self.filter(ip_address=ip, lease_end=None).update(
+            lease_end=now, applied=False
+        )
+
+    def stale(self, now, lease_time: Optional[timedelta] = None):
+        """
+        Open leases that was not renewed during *lease_time*,
+        DHCP_LEASE_TIME by default. Nothing when it is not set.
+        """
+        lease_time = lease_time or DHCP_LEASE_TIME
+        if lease_time is None:
+            return self.none()
+        return self.filter(lease_end=None, last_seen__lt=now - lease_time)
+
+    def apply_pending(self) -> set:
+        """
+        Move leases that was opened or closed since last call into ip
+        addresses of subscribers. Events are replayed in order, so each
+        subscriber is saved once in his last state and gets into sync
+        journal. Dynamic subscriber that held ip of new lease loses it.
+        :return: ids of gateways of changed subscribers
+        """
+        with transaction.atomic():
+            leases = tuple(self.filter(applied=False).select_for_update().order_by(
+                'lease_start', 'pk'
+            ).values_list('pk', 'abon_id', 'ip_address', 'lease_end'))
+            if not leases:
+                return set()
+            abon_ids = {abon_id for pk, abon_id, ip, end in leases if abon_id is not None}
+            opened_ips = {ip for pk, abon_id, ip, end in leases if end is None}
+            abons = {a.pk: a for a in Abon.objects.filter(
+                models.Q(pk__in=abon_ids) |
+                models.Q(ip_address__in=opened_ips, is_dynamic_ip=True)
+            ).select_for_update()}
+            # lease that was superseded by later lease of its ip is
+            # closed without taking ip from the later holder
+            last_leases = dict(self.filter(
+                ip_address__in={ip for pk, abon_id, ip, end in leases if end is not None}
+            ).order_by('lease_start', 'pk').values_list('ip_address', 'pk'))
+            ips = {pk: a.ip_address for pk, a in abons.items()}
+            holders = {ip: pk for pk, ip in ips.items() if ip}
+            for pk, abon_id, ip, lease_end in leases:
+                if abon_id not in ips:
+                    continue
+                if lease_end is not None and last_leases.get(ip) != pk:
+                    continue
+                if lease_end is None:
+                    holder = holders.get(ip)
+                    if holder is not None and holder != abon_id:
+                        ips[holder] = None
+                    if holders.get(ips[abon_id]) == abon_id:
+                        del holders[ips[abon_id]]
+                    ips[abon_id] = ip
+                    holders[ip] = abon_id
+                elif ips[abon_id] == ip:
+                    ips[abon_id] = None
+                    holders.pop(ip, None)
+            nas_ids = set()
+            for pk, abon in abons.items():
+                if ips[pk] != abon.ip_address:
+                    # change of ip is in sync journal by abon_post_save
+                    abon.ip_address = ips[pk]
+                    abon.save(update_fields=('ip_address',))
+                    if abon.nas_id is not None:
+                        nas_ids.add(abon.nas_id)
+            self.filter(pk__in=tuple(pk for pk, abon_id, ip, end in leases)).update(applied=True)
+        return nas_ids
+
+    def holder_at(self, ip: str, time):
+        """
+        Who had ip at the time
+        :return: AbonLease or None
+        """
+        lease = self.filter(
+            ip_address=ip, lease_start__lte=time
+        ).select_related('abon').order_by('-lease_start', '-pk').first()
+        if lease is not None and (lease.lease_end is None or lease.lease_end > time):
+            return lease
+
+
+class AbonLease(models.Model):
+    """
+    Leases of dynamic ip, open lease is the last started lease of ip
+    that has no lease_end. Closed leases are kept as history of ip
+    addresses. Dhcp events only write here, ip of subscriber is
+    changed after them by AbonLeaseManager.apply_pending.
+    """
+    ip_address = models.GenericIPAddressField(_('Ip address'))
+    mac_address = MACAddressField(_('Mac address'), null=True, blank=True)
+    abon = models.ForeignKey(Abon, on_delete=models.SET_NULL, null=True, blank=True)
+    device = models.ForeignKey(
+        'devapp.Device', on_delete=models.SET_NULL,
+        null=True, blank=True, verbose_name=_('Device')
+    )
+    port = models.PositiveSmallIntegerField(_('Port'), null=True, blank=True)
+    lease_start = models.DateTimeField(_('Lease start'))
+    last_seen = models.DateTimeField(_('Last seen'), db_index=True)
+    lease_end = models.DateTimeField(_('Lease end'), null=True, blank=True)
+    # opening or closing of lease is moved into subscriber
+    applied = models.BooleanField(default=False, db_index=True)
+
+    objects = AbonLeaseManager()
+
+    def __str__(self):
+        return "%s: %s" % (self.ip_address, self.abon_id)
+
+    class Meta:
+        db_table = 'abonent_lease'
+        index_together = ('ip_address', 'lease_start')
+        ordering = ('-lease_start',)
+
+
 class PassportInfo(models.Model):
     series = models.CharField(
         _('Pasport serial'),
@@ -547,3 +814,75 @@ def abon_tariff_pre_save(sender, **kwargs):
     if getattr(abon_tariff, 'deadline') is None:
         calc_obj = abon_tariff.tariff.get_calc_type()(abon_tariff)
         abon_tariff.deadline = calc_obj.calc_deadline()
+
+
+# Fields that have an effect on subscriber state on gateway
+_NAS_SYNC_FIELDS = ('current_tariff_id', 'ip_address', 'is_active', 'nas_id')
+
+
+def _get_nas_sync_state(abon) -> dict:
+    # deferred fields are not in __dict__, and they are not loaded here
+    return {f: abon.__dict__[f] for f in _NAS_SYNC_FIELDS if f in abon.__dict__}
+
+
+@receiver(post_init, sender=Abon)
+def abon_post_init(sender, **kwargs):
+    abon = kwargs["instance"]
+    abon._nas_sync_state = _get_nas_sync_state(abon)
+
+
+@receiver(post_save, sender=Abon)
+def abon_post_save(sender, **kwargs):
+    abon = kwargs["instance"]
+    old_state = getattr(abon, '_nas_sync_state', {})
+    new_state = _get_nas_sync_state(abon)
+    abon._nas_sync_state = new_state
+    is_changed = kwargs.get('created') or any(
+        old_state[f] != v for f, v in new_state.items() if f in old_state
+    )
+    if not is_changed:
+        return
+    old_ip = old_state.get('ip_address')
+    old_nas_id = old_state.get('nas_id', abon.nas_id)
+    records = []
+    if abon.nas_id is not None:
+        records.append(AbonSyncJournal(
+            abon=abon, nas_id=abon.nas_id,
+            ip_address=old_ip if old_nas_id == abon.nas_id else None
+        ))
+    if old_nas_id is not None and old_nas_id != abon.nas_id:
+        # subscriber must be removed from previous gateway
+        records.append(AbonSyncJournal(
+            abon=abon, nas_id=old_nas_id, ip_address=old_ip
+        ))
+    AbonSyncJournal.objects.bulk_create(records)
+
+
+# Fields of tariff that have an effect on subscriber queues on gateway
+_TARIFF_NAS_SYNC_FIELDS = ('speedIn', 'speedOut')
+
+
+def _get_tariff_sync_state(tariff) -> dict:
+    return {f: tariff.__dict__[f] for f in _TARIFF_NAS_SYNC_FIELDS if f in tariff.__dict__}
+
+
+@receiver(post_init, sender=Tariff)
+def tariff_post_init(sender, **kwargs):
+    tariff = kwargs["instance"]
+    tariff._nas_sync_state = _get_tariff_sync_state(tariff)
+
+
+@receiver(post_save, sender=Tariff)
+def tariff_post_save(sender, **kwargs):
+    tariff = kwargs["instance"]
+    old_state = getattr(tariff, '_nas_sync_state', {})
+    new_state = _get_tariff_sync_state(tariff)
+    tariff._nas_sync_state = new_state
+    if kwargs.get('created') or not any(
+        old_state[f] != v for f, v in new_state.items() if f in old_state
+    ):
+        return
+    # queues of all subscribers on this tariff must get new speed
+    AbonSyncJournal.objects.mark_changed(
+        Abon.objects.filter(current_tariff__tariff=tariff)
+    )
@@ -1,9 +1,13 @@
 from celery import shared_task
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from kombu.exceptions import OperationalError
 
-from abonapp.models import Abon
+from abonapp.models import Abon, AbonSyncJournal, AbonLease
 from djing.lib import LogicError
 from gw_app.models import NASModel
-from gw_app.nas_managers import NasFailedResult, NasNetworkError, SubnetQueue
+from gw_app.nas_managers import NasFailedResult, NasNetworkError, SubnetQueue, nas_pool
 
 
 @shared_task
@@ -11,16 +15,23 @@ def customer_nas_command(customer_uid: int, command: str):
     if command not in ('add', 'sync'):
         return 'Command required'
     try:
-        cust = Abon.objects.get(pk=customer_uid)
+        cust = Abon.objects.select_related('nas').get(pk=customer_uid)
         print(cust, command)
-        if command == 'sync':
-            r = cust.nas_sync_self()
-            if isinstance(r, Exception):
-                return 'ABONAPP SYNC ERROR: %s' % r
-        elif command == 'add':
-            cust.nas_add_self()
-        else:
-            return 'ABONAPP SYNC ERROR: Unknown command "%s"' % command
+        if cust.nas is None:
+            raise LogicError('gateway required')
+        last_id = AbonSyncJournal.objects.get_last_id(abon=cust)
+        with nas_pool.session(cust.nas) as mngr:
+            if command == 'sync':
+                r = cust.nas_sync_self(mngr)
+            else:
+                r = cust.nas_add_self(mngr)
+        if isinstance(r, Exception):
+            # subscriber remains in journal, periodic sync will push him
+            if last_id is None:
+                AbonSyncJournal.objects.mark_changed(Abon.objects.filter(pk=cust.pk))
+            return 'ABONAPP SYNC ERROR: %s' % r
+        if last_id is not None and cust.nas_id is not None:
+            AbonSyncJournal.objects.mark_synced(cust.pk, cust.nas_id, last_id)
     except Abon.DoesNotExist:
         pass
     except (LogicError, NasFailedResult, NasNetworkError, ConnectionResetError) as e:
@@ -39,9 +50,89 @@ def customer_nas_remove(customer_uid: int, ip_addr: str, speed: tuple, is_access
             is_access=is_access
         )
         nas = NASModel.objects.get(pk=nas_pk)
-        mngr = nas.get_nas_manager()
-        mngr.remove_user(sq)
-    except (ValueError, NasFailedResult, NasNetworkError, LogicError) as e:
+        with nas_pool.session(nas) as mngr:
+            mngr.remove_user(sq)
+    except (ValueError, NasFailedResult, NasNetworkError, LogicError, ConnectionResetError) as e:
         return 'ABONAPP ERROR: %s' % e
     except NASModel.DoesNotExist:
         return 'NASModel.DoesNotExist id=%d' % nas_pk
+
+
+# Seconds while changes of leases are collected before push to gateway
+NAS_PUSH_DELAY = getattr(settings, 'NAS_PUSH_DELAY', 1)
+
+
+def _nas_push_key(nas_id: int) -> str:
+    return 'nas_push_%d' % nas_id
+
+
+# Cache key of scheduled apply_dhcp_leases
+_LEASE_APPLY_KEY = 'dhcp_lease_apply'
+
+
+def _schedule_once(key: str, task, args: tuple, countdown: float) -> None:
+    # key is expired when task is lost, so it can be scheduled again
+    if not cache.add(key, 1, countdown + 60):
+        return
+    try:
+        task.apply_async(args, countdown=countdown)
+    except OperationalError as e:
+        # changes remain pending, periodic.py applies them
+        cache.delete(key)
+        print('ERROR: %s is not scheduled:' % key, e)
+
+
+def schedule_nas_push(nas_id: int, countdown: float = NAS_PUSH_DELAY) -> None:
+    """
+    Push changes of subscribers from sync journal to gateway
+    a bit later, after current transaction is committed.
+    Many calls in NAS_PUSH_DELAY make only one push, and
+    each subscriber is pushed only in his last state.
+    """
+    transaction.on_commit(
+        lambda: _schedule_once(_nas_push_key(nas_id), nas_push_changes, (nas_id,), countdown)
+    )
+
+
+def schedule_lease_apply() -> None:
+    """
+    Move new dhcp leases into subscribers and push them to
+    gateways a bit later, after current transaction is committed.
+    Many dhcp events in NAS_PUSH_DELAY are applied together.
+    """
+    transaction.on_commit(
+        lambda: _schedule_once(_LEASE_APPLY_KEY, apply_dhcp_leases, (), NAS_PUSH_DELAY)
+    )
+
+
+@shared_task
+def apply_dhcp_leases():
+    # leases that come while apply are applied by next task
+    cache.delete(_LEASE_APPLY_KEY)
+    nas_ids = AbonLease.objects.apply_pending()
+    for nas_id in nas_ids:
+        # events were collected already, gateway is pushed at once
+        schedule_nas_push(nas_id, countdown=0)
+    return 'leases applied, %d gateways to push' % len(nas_ids)
+
+
+@shared_task
+def nas_push_changes(nas_id: int):
+    # changes that come while push are pushed by next task
+    cache.delete(_nas_push_key(nas_id))
+    try:
+        nas = NASModel.objects.get(pk=nas_id)
+        last_id = AbonSyncJournal.objects.get_last_id(nas=nas)
+        if last_id is None:
+            return
+        queues_for_update, queues_for_remove = \
+            AbonSyncJournal.objects.get_changes(nas.pk, last_id)
+        with nas_pool.session(nas) as mngr:
+            stats = mngr.sync_changes(queues_for_update, queues_for_remove)
+        AbonSyncJournal.objects.filter(nas=nas, id__lte=last_id).delete()
+        return str(stats)
+    except NASModel.DoesNotExist:
+        return 'NASModel.DoesNotExist id=%d' % nas_id
+    except (NasFailedResult, NasNetworkError, LogicError, ConnectionResetError) as e:
+        # subscribers remain in journal, periodic sync will push them
+        return 'ABONAPP PUSH ERROR: %s' % e
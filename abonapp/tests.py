@@ -1,14 +1,24 @@
+import json
+import threading
 from abc import ABCMeta
-from hashlib import md5
-from datetime import date
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from hashlib import md5, sha256
+from datetime import date, timedelta
 
 from accounts_app.models import UserProfile
 from django.shortcuts import resolve_url
-from django.test import TestCase, RequestFactory
+from django.test import TestCase, SimpleTestCase, RequestFactory, override_settings
 from django.conf import settings
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
-from abonapp.models import Abon, AbonStreet, PassportInfo
+from abonapp.models import (
+    Abon, AbonStreet, PassportInfo, AbonSyncJournal, AbonLease, AbonTariff, AbonLog
+)
+from agent.commands import dhcp_index
+from agent.commands.dhcp import dhcp_commit, dhcp_expiry
+from devapp.models import Device, Port
+from gw_app.models import NASModel
 from group_app.models import Group
 from tariff_app.models import Tariff
 from ip_pool.models import NetworkModel
@@ -369,3 +379,451 @@ class ClientLeasesTestCase(MyBaseTestCase, TestCase):
         updated_abon = Abon.objects.get(username=self.abon.username)
         ip_addr = updated_abon.ip_addresses.all().first()
         self.assertEqual('fde8:86a9:f132:1::7', ip_addr.ip)
+
+
+class AbonSyncJournalTestCase(MyBaseTestCase, TestCase):
+    def setUp(self):
+        super(AbonSyncJournalTestCase, self).setUp()
+        self.nas1 = NASModel.objects.create(
+            title='nas1', ip_address='192.168.8.12', ip_port=8728,
+            auth_login='admin', auth_passw='admin', nas_type='mktk'
+        )
+        self.nas2 = NASModel.objects.create(
+            title='nas2', ip_address='192.168.8.13', ip_port=8728,
+            auth_login='admin', auth_passw='admin', nas_type='mktk'
+        )
+
+    def test_unchanged_save(self):
+        self.abon.save(update_fields=('group',))
+        self.assertFalse(AbonSyncJournal.objects.exists())
+
+    def test_change_ip(self):
+        self.abon.nas = self.nas1
+        self.abon.ip_address = '10.0.0.2'
+        self.abon.save(update_fields=('nas', 'ip_address'))
+        self.abon.attach_ip_addr('10.0.0.3')
+        records = AbonSyncJournal.objects.filter(abon=self.abon)
+        self.assertEqual(records.count(), 2)
+        # old ip must be removed from gateway
+        self.assertEqual(records.last().ip_address, '10.0.0.2')
+        self.assertEqual(records.last().nas, self.nas1)
+
+    def test_change_nas(self):
+        self.abon.nas = self.nas1
+        self.abon.ip_address = '10.0.0.2'
+        self.abon.save(update_fields=('nas', 'ip_address'))
+        AbonSyncJournal.objects.all().delete()
+        self.abon.nas = self.nas2
+        self.abon.save(update_fields=('nas',))
+        self.assertTrue(AbonSyncJournal.objects.filter(
+            abon=self.abon, nas=self.nas2
+        ).exists())
+        self.assertTrue(AbonSyncJournal.objects.filter(
+            abon=self.abon, nas=self.nas1, ip_address='10.0.0.2'
+        ).exists())
+        last_id = AbonSyncJournal.objects.get_last_id(nas=self.nas1)
+        for_update, for_remove = AbonSyncJournal.objects.get_changes(
+            self.nas1.pk, last_id
+        )
+        self.assertEqual(len(for_update), 0)
+        self.assertEqual(len(for_remove), 1)
+        self.assertEqual(for_remove[0].name, 'uid%d' % self.abon.pk)
+
+    def test_change_tariff_speed(self):
+        tariff = Tariff.objects.create(
+            title='t1', descr='d', speedIn=10.0, speedOut=10.0, amount=10.0
+        )
+        self.abon.current_tariff = AbonTariff.objects.create(tariff=tariff)
+        self.abon.nas = self.nas1
+        self.abon.ip_address = '10.0.0.2'
+        self.abon.save(update_fields=('current_tariff', 'nas', 'ip_address'))
+        AbonSyncJournal.objects.all().delete()
+        tariff.title = 't2'
+        tariff.save(update_fields=('title',))
+        self.assertFalse(AbonSyncJournal.objects.exists())
+        tariff.speedIn = 20.0
+        tariff.save(update_fields=('speedIn',))
+        self.assertTrue(AbonSyncJournal.objects.filter(
+            abon=self.abon, nas=self.nas1
+        ).exists())
+
+
+class PeriodicBillingTestCase(MyBaseTestCase, TestCase):
+    def setUp(self):
+        super(PeriodicBillingTestCase, self).setUp()
+        self.now = timezone.now()
+        self.nas = NASModel.objects.create(
+            title='nas1', ip_address='192.168.8.12', ip_port=8728,
+            auth_login='admin', auth_passw='admin', nas_type='mktk'
+        )
+        self.tariff = Tariff.objects.create(
+            title='t1', descr='d', speedIn=10.0, speedOut=10.0, amount=10.0
+        )
+        self.rich = self._make_abon(self.abon, ballance=25.0, autoconnect=True)
+        self.poor = self._make_abon(Abon.objects.create_user(
+            telephone='+79781234568', username='poor', password='passw1'
+        ), ballance=5.0, autoconnect=True)
+        self.manual = self._make_abon(Abon.objects.create_user(
+            telephone='+79781234569', username='manual', password='passw1'
+        ), ballance=25.0, autoconnect=False)
+        AbonSyncJournal.objects.all().delete()
+
+    def _make_abon(self, abon, ballance: float, autoconnect: bool):
+        abon.current_tariff = AbonTariff.objects.create(
+            tariff=self.tariff, time_start=self.now - timedelta(days=31),
+            deadline=self.now - timedelta(days=1)
+        )
+        abon.ballance = ballance
+        abon.autoconnect_service = autoconnect
+        abon.nas = self.nas
+        abon.ip_address = '10.0.0.%d' % (Abon.objects.count() + 1)
+        abon.save(update_fields=('current_tariff', 'ballance', 'autoconnect_service',
+                                 'nas', 'ip_address'))
+        return abon
+
+    def _get(self, abon):
+        return Abon.objects.get(pk=abon.pk)
+
+    def test_renew_autoconnect(self):
+        from periodic import renew_autoconnect_services
+        renew_autoconnect_services(self.now, chunk_size=1)
+        # next run does not find renewed service
+        renew_autoconnect_services(self.now, chunk_size=1)
+        rich = self._get(self.rich)
+        self.assertEqual(rich.ballance, 15.0)
+        self.assertGreater(rich.current_tariff.deadline, self.now)
+        self.assertEqual(AbonLog.objects.filter(abon=rich).count(), 1)
+        # low ballance finishes service
+        poor = self._get(self.poor)
+        self.assertEqual(poor.ballance, 5.0)
+        self.assertIsNone(poor.current_tariff)
+        self.assertEqual(AbonLog.objects.filter(abon=poor).count(), 1)
+        self.assertEqual(AbonTariff.objects.count(), 2)
+        # only finished subscriber is pushed to gateway
+        self.assertListEqual(
+            list(AbonSyncJournal.objects.values_list('abon_id', flat=True)), [poor.pk]
+        )
+        # subscriber without autoconnect is not touched
+        self.assertIsNotNone(self._get(self.manual).current_tariff)
+
+    def test_finish_expired(self):
+        from periodic import finish_expired_services
+        finish_expired_services(self.now, chunk_size=1)
+        manual = self._get(self.manual)
+        self.assertIsNone(manual.current_tariff)
+        self.assertEqual(manual.ballance, 25.0)
+        self.assertEqual(AbonLog.objects.filter(abon=manual).count(), 1)
+        self.assertListEqual(
+            list(AbonSyncJournal.objects.values_list('abon_id', flat=True)), [manual.pk]
+        )
+        self.assertIsNotNone(self._get(self.rich).current_tariff)
+        self.assertEqual(AbonLog.objects.count(), 1)
+
+    def test_changed_after_select(self):
+        from periodic import finish_services_chunk, renew_services_chunk
+        rich_srv = self.rich.current_tariff_id
+        manual_srv = self.manual.current_tariff_id
+        # admin renews one service and switches autoconnect of other
+        AbonTariff.objects.filter(pk=rich_srv).update(deadline=self.now + timedelta(days=30))
+        Abon.objects.filter(pk=self.manual.pk).update(autoconnect_service=True)
+        self.assertEqual(renew_services_chunk((rich_srv,), self.now, {}), (0, 0))
+        self.assertEqual(finish_services_chunk((manual_srv,), self.now), 0)
+        self.assertEqual(self._get(self.rich).ballance, 25.0)
+        self.assertIsNotNone(self._get(self.manual).current_tariff)
+        self.assertFalse(AbonLog.objects.exists())
+
+
+API_SECRET = 'TestApiSecret'
+
+
+def _calc_hash(data):
+    if type(data) is str:
+        data = data.encode('utf-8')
+    return sha256(data).hexdigest()
+
+
+def _post_dhcp_batch(client, body: bytes, body_hash=None):
+    if body_hash is None:
+        body_hash = _calc_hash(body)
+    sign = _calc_hash('%s_%s' % (body_hash, API_SECRET))
+    return client.post(
+        '/abons/api/dhcp_lever/?body_hash=%s&sign=%s' % (body_hash, sign),
+        body, content_type='application/json'
+    )
+
+
+@override_settings(API_AUTH_SECRET=API_SECRET, API_AUTH_SUBNET='127.0.0.1')
+class DhcpLeverBatchTestCase(TestCase):
+    def _post(self, body: bytes, body_hash=None):
+        return _post_dhcp_batch(self.client, body, body_hash)
+
+    def test_results_for_each_event(self):
+        body = json.dumps({'events': [
+            {'client_ip': '10.0.0.2', 'cmd': 'unknown'},
+            {'cmd': 'expiry'},
+            'bad'
+        ]}).encode()
+        r = self._post(body)
+        self.assertEqual(r.status_code, 200)
+        results = r.json()['results']
+        self.assertEqual(len(results), 3)
+        self.assertEqual(results[0], '"cmd" parameter is invalid: unknown')
+        self.assertEqual(results[1], '"client_ip" parameter is missing')
+        self.assertEqual(results[2], 'event must be object')
+
+    def test_body_hash_mismatch(self):
+        body = json.dumps({'events': []}).encode()
+        r = self._post(body, body_hash=_calc_hash(b'other'))
+        self.assertEqual(r.status_code, 403)
+
+    def test_events_not_list(self):
+        r = self._post(json.dumps({'events': 1}).encode())
+        self.assertEqual(r.status_code, 400)
+
+
+class DhcpCommitTestCase(MyBaseTestCase, TestCase):
+    def setUp(self):
+        super(DhcpCommitTestCase, self).setUp()
+        self.dev = Device.objects.create(
+            mac_addr='78:81:f2:1f:d2:a9', comment='Switch',
+            devtype='Dl', group=self.group
+        )
+        self.port = Port.objects.create(device=self.dev, num=3, descr='p3')
+        self.abon.device = self.dev
+        self.abon.dev_port = self.port
+        self.abon.is_dynamic_ip = True
+        self.abon.save(update_fields=('device', 'dev_port', 'is_dynamic_ip'))
+        # changes of test transaction are never committed
+        dhcp_index.invalidate()
+
+    def test_commit_by_port(self):
+        dhcp_index.get_index()
+        with self.assertNumQueries(3):
+            # read of subscriber, read of lease of ip and insert of new lease
+            r = dhcp_commit('10.0.0.2', 'aa:bb:cc:dd:ee:ff', '78:81:F2:1F:D2:A9', 3)
+        self.assertEqual(r, 'User %s has no gateway' % self.abon.username)
+        # subscriber is changed in background
+        self.assertIsNone(Abon.objects.get(pk=self.abon.pk).ip_address)
+        with self.assertNumQueries(2):
+            # renewal writes nothing
+            r = dhcp_commit('10.0.0.2', 'aa:bb:cc:dd:ee:ff', '78:81:f2:1f:d2:a9', 3)
+        self.assertEqual(r, 'Ip has already attached')
+        AbonLease.objects.apply_pending()
+        self.assertEqual(Abon.objects.get(pk=self.abon.pk).ip_address, '10.0.0.2')
+
+    def test_lease_history(self):
+        dhcp_commit('10.0.0.2', 'aa:bb:cc:dd:ee:ff', '78:81:f2:1f:d2:a9', 3)
+        lease = AbonLease.objects.get(ip_address='10.0.0.2')
+        self.assertEqual(lease.abon_id, self.abon.pk)
+        self.assertEqual(lease.port, 3)
+        self.assertIsNone(lease.lease_end)
+        dhcp_expiry('10.0.0.2')
+        lease.refresh_from_db()
+        self.assertIsNotNone(lease.lease_end)
+        holder = AbonLease.objects.holder_at('10.0.0.2', lease.lease_start)
+        self.assertEqual(holder.abon, self.abon)
+        self.assertIsNone(AbonLease.objects.holder_at('10.0.0.2', lease.lease_end))
+        self.assertEqual(dhcp_expiry('10.0.0.2'), 'Lease of ip 10.0.0.2 is already closed')
+
+    def test_apply_pending(self):
+        other = Abon.objects.create_user(
+            telephone='+79781234568', username='other', password='passw1'
+        )
+        other.is_dynamic_ip = True
+        other.save(update_fields=('is_dynamic_ip',))
+        leases = AbonLease.objects
+        leases.open_lease('10.0.0.2', self.abon.pk)
+        leases.open_lease('10.0.0.3', self.abon.pk)
+        leases.apply_pending()
+        # only last lease of subscriber is his ip
+        self.assertEqual(Abon.objects.get(pk=self.abon.pk).ip_address, '10.0.0.3')
+        # ip is taken by other subscriber
+        leases.open_lease('10.0.0.3', other.pk)
+        self.assertEqual(leases.current('10.0.0.3').abon_id, other.pk)
+        leases.apply_pending()
+        self.assertIsNone(Abon.objects.get(pk=self.abon.pk).ip_address)
+        self.assertEqual(Abon.objects.get(pk=other.pk).ip_address, '10.0.0.3')
+        self.assertEqual(leases.filter(applied=False).count(), 0)
+        # stale close of superseded lease keeps ip of later holder
+        AbonLease.objects.filter(
+            ip_address='10.0.0.3', abon=self.abon
+        ).update(lease_end=timezone.now(), applied=False)
+        leases.apply_pending()
+        self.assertEqual(Abon.objects.get(pk=other.pk).ip_address, '10.0.0.3')
+        # closed lease frees ip
+        leases.close('10.0.0.3')
+        self.assertIsNone(leases.current('10.0.0.3'))
+        leases.apply_pending()
+        self.assertIsNone(Abon.objects.get(pk=other.pk).ip_address)
+
+    def test_expiry_without_lease(self):
+        self.abon.current_tariff = AbonTariff.objects.create(
+            tariff=Tariff.objects.create(
+                title='t1', descr='d', speedIn=10.0, speedOut=10.0, amount=10.0
+            )
+        )
+        self.abon.ip_address = '10.0.0.2'
+        self.abon.save(update_fields=('current_tariff', 'ip_address'))
+        with self.assertNumQueries(4):
+            # close of lease, check of history, read of subscriber and closed lease
+            self.assertIsNone(dhcp_expiry('10.0.0.2'))
+        AbonLease.objects.apply_pending()
+        self.assertIsNone(Abon.objects.get(pk=self.abon.pk).ip_address)
+
+    def test_close_stale_leases(self):
+        from periodic import close_stale_leases
+        dhcp_commit('10.0.0.2', 'aa:bb:cc:dd:ee:ff', '78:81:f2:1f:d2:a9', 3)
+        AbonLease.objects.apply_pending()
+        lease = AbonLease.objects.get(ip_address='10.0.0.2')
+        lease_time = timedelta(hours=1)
+        stale_time = lease.last_seen + timedelta(hours=2)
+        # lease is renewed after its id was selected as stale
+        ids = (lease.pk,)
+        AbonLease.objects.filter(pk=lease.pk).update(last_seen=stale_time)
+        self.assertEqual(close_stale_leases(ids, stale_time, lease_time), 0)
+        lease.refresh_from_db()
+        self.assertIsNone(lease.lease_end)
+        self.assertEqual(Abon.objects.get(pk=self.abon.pk).ip_address, '10.0.0.2')
+        # not renewed
+        later = stale_time + timedelta(hours=2)
+        self.assertEqual(close_stale_leases(ids, later, lease_time), 1)
+        lease.refresh_from_db()
+        self.assertEqual(lease.lease_end, later)
+        AbonLease.objects.apply_pending()
+        self.assertIsNone(Abon.objects.get(pk=self.abon.pk).ip_address)
+
+    @override_settings(API_AUTH_SECRET=API_SECRET, API_AUTH_SUBNET='127.0.0.1')
+    def test_batch_commit_expiry(self):
+        body = json.dumps({'events': [{
+            'client_ip': '10.0.0.2', 'client_mac': 'aa:bb:cc:dd:ee:ff',
+            'switch_mac': '78:81:f2:1f:d2:a9', 'switch_port': 3, 'cmd': 'commit'
+        }, {
+            'client_ip': '10.0.0.3', 'cmd': 'expiry'
+        }]}).encode()
+        r = _post_dhcp_batch(self.client, body)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.json()['results'], [
+            'User %s has no gateway' % self.abon.username,
+            'Subscriber with ip 10.0.0.3 does not exist'
+        ])
+        AbonLease.objects.apply_pending()
+        self.assertEqual(Abon.objects.get(pk=self.abon.pk).ip_address, '10.0.0.2')
+        lease = AbonLease.objects.get(ip_address='10.0.0.2')
+        self.assertIsNone(lease.lease_end)
+        body = json.dumps({'events': [{'client_ip': '10.0.0.2', 'cmd': 'expiry'}]}).encode()
+        r = _post_dhcp_batch(self.client, body)
+        self.assertEqual(r.status_code, 200)
+        lease.refresh_from_db()
+        self.assertIsNotNone(lease.lease_end)
+
+    def test_commit_unknown(self):
+        r = dhcp_commit('10.0.0.2', 'aa:bb:cc:dd:ee:ff', '78:81:f2:1f:d2:aa', 3)
+        self.assertEqual(r, 'Device with mac 78:81:f2:1f:d2:aa not found')
+        r = dhcp_commit('10.0.0.2', 'aa:bb:cc:dd:ee:ff', '78:81:f2:1f:d2:a9', 4)
+        self.assertEqual(r, "User with device with mac '78:81:f2:1f:d2:a9' does not exist")
+
+    def test_not_dynamic(self):
+        self.abon.is_dynamic_ip = False
+        self.abon.save(update_fields=('is_dynamic_ip',))
+        dhcp_index.invalidate()
+        dhcp_index.get_index()
+        with self.assertNumQueries(0):
+            r = dhcp_commit('10.0.0.2', 'aa:bb:cc:dd:ee:ff', '78:81:f2:1f:d2:a9', 3)
+        self.assertEqual(r, 'User settings is not dynamic')
+
+    @override_settings(API_AUTH_SECRET=API_SECRET, API_AUTH_SUBNET='127.0.0.1')
+    def test_push_status(self):
+        nas = NASModel.objects.create(
+            title='nas1', ip_address='192.168.8.12', ip_port=8728,
+            auth_login='admin', auth_passw='admin', nas_type='mktk'
+        )
+        self.abon.nas = nas
+        self.abon.save(update_fields=('nas',))
+        AbonSyncJournal.objects.all().delete()
+        dhcp_commit('10.0.0.2', 'aa:bb:cc:dd:ee:ff', '78:81:f2:1f:d2:a9', 3)
+        url = '/abons/api/dhcp_lever/status/'
+        sign = _calc_hash('10.0.0.2_%s' % API_SECRET)
+        r = self.client.get(url, {'client_ip': '10.0.0.2', 'sign': sign})
+        self.assertEqual(r.json()['push'], 'pending')
+        self.assertEqual(AbonLease.objects.apply_pending(), {nas.pk})
+        r = self.client.get(url, {'client_ip': '10.0.0.2', 'sign': sign})
+        self.assertEqual(r.json()['push'], 'pending')
+        AbonSyncJournal.objects.all().delete()
+        r = self.client.get(url, {'client_ip': '10.0.0.2', 'sign': sign})
+        self.assertEqual(r.json()['push'], 'applied')
+
+
+class _BatchHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        server = self.server
+        server.bodies.append(self.rfile.read(int(self.headers['Content-Length'])))
+        status = server.statuses.pop(0) if server.statuses else 200
+        data = json.dumps({'status': 'ok', 'results': []}).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        # server closes kept alive connection after each reply
+        self.close_connection = server.close_after_reply
+
+    def log_message(self, *args):
+        pass
+
+
+class DhcpLeverScriptTestCase(SimpleTestCase):
+    def setUp(self):
+        self.httpd = HTTPServer(('127.0.0.1', 0), _BatchHandler)
+        self.httpd.bodies = []
+        self.httpd.statuses = []
+        self.httpd.close_after_reply = False
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        import dhcp_lever
+        self.client = dhcp_lever.BatchClient('http://127.0.0.1:%d' % self.httpd.server_port)
+
+    def tearDown(self):
+        self.client.close()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def test_parse_event(self):
+        from dhcp_lever import parse_event
+        self.assertEqual(parse_event(['commit', '10.0.0.2', 'aa:bb:cc:dd:ee:ff', '78:81:f2:1f:d2:a9', '3']), {
+            'client_ip': '10.0.0.2', 'client_mac': 'aa:bb:cc:dd:ee:ff',
+            'switch_mac': '78:81:f2:1f:d2:a9', 'switch_port': 3, 'cmd': 'commit'
+        })
+        self.assertEqual(parse_event(['expiry', '10.0.0.2']), {'client_ip': '10.0.0.2', 'cmd': 'expiry'})
+        self.assertEqual(parse_event(['release', '10.0.0.2']), {'client_ip': '10.0.0.2', 'cmd': 'release'})
+        self.assertIsNone(parse_event(['commit', '10.0.0.2', 'aa:bb:cc:dd:ee:ff', '78:81:f2:1f:d2:a9', 'x']))
+        self.assertIsNone(parse_event(['commit', '10.0.0.2']))
+        self.assertIsNone(parse_event(['unknown', '10.0.0.2']))
+        self.assertIsNone(parse_event(['expiry']))
+
+    def test_send(self):
+        events = [{'client_ip': '10.0.0.2', 'cmd': 'expiry'}]
+        self.assertTrue(self.client.send(events))
+        self.assertEqual(json.loads(self.httpd.bodies[0].decode()), {'events': events})
+
+    def test_reconnect(self):
+        self.httpd.close_after_reply = True
+        events = [{'client_ip': '10.0.0.2', 'cmd': 'expiry'}]
+        self.assertTrue(self.client.send(events))
+        # kept connection is closed by server, batch is sent by new one
+        self.assertTrue(self.client.send(events))
+        self.assertEqual(len(self.httpd.bodies), 2)
+
+    def test_retry_and_drop(self):
+        events = [{'client_ip': '10.0.0.2', 'cmd': 'expiry'}]
+        # billing error, batch is kept for retry
+        self.httpd.statuses = [500]
+        self.assertFalse(self.client.send(events))
+        # rejected batch would be rejected again, it is dropped
+        self.httpd.statuses = [403]
+        self.assertTrue(self.client.send(events))
+
+    def test_server_down(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.assertFalse(self.client.send([{'client_ip': '10.0.0.2', 'cmd': 'expiry'}]))
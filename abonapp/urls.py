@@ -1,4 +1,5 @@
 from django.urls import path, include, re_path
+from django.views.decorators.csrf import csrf_exempt
 
 from abonapp import views
 
@@ -57,5 +58,6 @@ urlpatterns = [
     # Api's
     path('api/abons/', views.abons),
     path('api/abon_filter/', views.search_abon),
-    path('api/dhcp_lever/', views.DhcpLever.as_view())
+    path('api/dhcp_lever/', csrf_exempt(views.DhcpLever.as_view())),
+    path('api/dhcp_lever/status/', views.DhcpLeverStatus.as_view())
 ]
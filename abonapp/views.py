@@ -1,3 +1,4 @@
+import json
 from datetime import datetime
 from typing import Dict, Optional
 from kombu.exceptions import OperationalError
@@ -11,10 +12,10 @@ from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin, PermissionRequiredMixin
 from django.core.exceptions import PermissionDenied, ValidationError
 from django.db import IntegrityError, transaction
-from django.db.models import Count
+from django.db.models import Count, Q
 from django.http import (
     HttpResponse, HttpResponseBadRequest,
-    HttpResponseRedirect
+    HttpResponseRedirect, HttpResponseForbidden, JsonResponse
 )
 from django.shortcuts import render, redirect, get_object_or_404, resolve_url
 from django.urls import reverse_lazy
@@ -1240,7 +1241,11 @@ def attach_nas(request, gid):
             nas = get_object_or_404(NASModel, pk=gateway_id)
             customers = models.Abon.objects.filter(group__id=gid)
             if customers.exists():
-                customers.update(nas=nas)
+                with transaction.atomic():
+                    # remove from previous gateways and add to new
+                    models.AbonSyncJournal.objects.mark_changed(customers)
+                    customers.update(nas=nas)
+                    models.AbonSyncJournal.objects.mark_changed(customers)
                 messages.success(
                     request,
                     _('Network access server for users in this '
@@ -1297,11 +1302,15 @@ def search_abon(request):
     )
 
 
+# Max count of dhcp events in one batch of DhcpLever
+DHCP_LEVER_MAX_EVENTS = getattr(settings, 'DHCP_LEVER_MAX_EVENTS', 1000)
+
+
 class DhcpLever(SecureApiView):
     #
     # Api view for dhcp event
     #
-    http_method_names = ('get',)
+    http_method_names = ('get', 'post')
 
     @method_decorator(json_view)
     def get(self, request, *args, **kwargs):
@@ -1314,6 +1323,38 @@ class DhcpLever(SecureApiView):
         except IntegrityError as e:
             return {'status': str(e).replace('\n', ' ')}
 
+    def post(self, request, *args, **kwargs):
+        """
+        Batch of events in json body: {"events": [data, ...]}, each data
+        is like for get. Sign of GET parameters covers only body_hash,
+        it is sha256 of body.
+        """
+        body_hash = request.GET.get('body_hash')
+        if not body_hash or lib.calc_hash(request.body) != body_hash:
+            return HttpResponseForbidden('Access Denied')
+        try:
+            events = json.loads(request.body.decode('utf-8')).get('events')
+        except (ValueError, UnicodeDecodeError, AttributeError):
+            return HttpResponseBadRequest('Body must be json object')
+        if not isinstance(events, list) or len(events) > DHCP_LEVER_MAX_EVENTS:
+            return HttpResponseBadRequest(
+                '"events" must be list of not more than %d items' % DHCP_LEVER_MAX_EVENTS
+            )
+        results = []
+        for data in events:
+            if not isinstance(data, dict):
+                results.append('event must be object')
+                continue
+            try:
+                # failed event does not break others
+                with transaction.atomic():
+                    r = self.on_dhcp_event(data)
+                results.append(None if r is None else str(r))
+            except IntegrityError as e:
+                results.append(str(e).replace('\n', ' '))
+        return JsonResponse({'status': 'ok', 'results': results},
+                            json_dumps_params={'ensure_ascii': False})
+
     @staticmethod
     def on_dhcp_event(data: Dict) -> Optional[str]:
         """
@@ -1350,6 +1391,27 @@ class DhcpLever(SecureApiView):
             return str(e)
 
 
+class DhcpLeverStatus(SecureApiView):
+    #
+    # Api view for state of push of dhcp lease to gateway
+    #
+    http_method_names = ('get',)
+
+    @method_decorator(json_view)
+    def get(self, request, *args, **kwargs):
+        client_ip = request.GET.get('client_ip')
+        if not client_ip:
+            return {'status': '"client_ip" parameter is missing'}
+        # lease is not moved into subscriber yet, or there is new ip
+        # of subscriber or old ip that must be removed from gateway
+        is_pending = models.AbonLease.objects.filter(
+            ip_address=client_ip, applied=False
+        ).exists() or models.AbonSyncJournal.objects.filter(
+            Q(abon__ip_address=client_ip) | Q(ip_address=client_ip)
+        ).exists()
+        return {'status': 'ok', 'push': 'pending' if is_pending else 'applied'}
+
+
 class PayHistoryListView(LoginAdminPermissionMixin, OrderedFilteredList):
     permission_required = 'group_app.view_group'
     context_object_name = 'pay_history'
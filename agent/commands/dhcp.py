@@ -1,56 +1,81 @@
 from typing import Optional
-from django.core.exceptions import MultipleObjectsReturned
-from abonapp.models import Abon
-from devapp.models import Device, Port
+from django.utils import timezone
+from netaddr import EUI, AddrFormatError
+from abonapp.models import Abon, AbonLease
+from abonapp.tasks import schedule_lease_apply
+from agent.commands.dhcp_index import get_index, MULTIPLE
+
+
+def _parse_mac(mac: str) -> Optional[EUI]:
+    try:
+        return EUI(mac)
+    except (AddrFormatError, TypeError, ValueError):
+        return None
 
 
 def dhcp_commit(client_ip: str, client_mac: str,
                 switch_mac: str, switch_port: int) -> Optional[str]:
+    index = get_index()
+    dev = index.get_device(switch_mac)
+    if dev is None:
+        return 'Device with mac %s not found' % switch_mac
+    mngr_class = dev.get_manager_klass()
+
+    if mngr_class.get_is_use_device_port():
+        try:
+            switch_port = int(switch_port)
+        except (TypeError, ValueError):
+            return 'Port %s on device with mac %s is invalid' % (switch_port, switch_mac)
+        subscriber = index.get_subscriber(dev, switch_port)
+    else:
+        subscriber = index.get_subscriber(dev, None)
+    if subscriber is None:
+        return "User with device with mac '%s' does not exist" % switch_mac
+    if subscriber == MULTIPLE:
+        return 'MultipleObjectsReturned: device with mac %s, port %s' % (
+            switch_mac, switch_port
+        )
+    if not subscriber.is_dynamic_ip:
+        return 'User settings is not dynamic'
     try:
-        dev = Device.objects.get(mac_addr=switch_mac)
-        mngr_class = dev.get_manager_klass()
-
-        if mngr_class.get_is_use_device_port():
-            abon = Abon.objects.get(dev_port__device=dev,
-                                    dev_port__num=switch_port,
-                                    device=dev, is_active=True)
-        else:
-            abon = Abon.objects.get(device=dev, is_active=True)
-        if not abon.is_dynamic_ip:
-            return 'User settings is not dynamic'
-        if client_ip == abon.ip_address:
-            return 'Ip has already attached'
-        abon.attach_ip_addr(client_ip, strict=False)
-        if abon.is_access():
-            r = abon.nas_sync_self()
-            return r if r else None
-        else:
-            return 'User %s is not access to service' % abon.username
+        abon = Abon.objects.select_related(
+            'current_tariff__tariff'
+        ).get(pk=subscriber.pk)
     except Abon.DoesNotExist:
         return "User with device with mac '%s' does not exist" % switch_mac
-    except Device.DoesNotExist:
-        return 'Device with mac %s not found' % switch_mac
-    except Port.DoesNotExist:
-        return 'Port %(switch_port)d on device with mac %(switch_mac)s does not exist' % {
-            'switch_port': int(switch_port),
-            'switch_mac': switch_mac
-        }
-    except MultipleObjectsReturned as e:
-        return 'MultipleObjectsReturned:' + ' '.join(
-            (type(e), e, str(switch_port))
-        )
+    lease = AbonLease.objects.current(client_ip)
+    if lease is not None and lease.abon_id == abon.pk:
+        AbonLease.objects.touch(lease)
+        return 'Ip has already attached'
+    AbonLease.objects.open_lease(
+        client_ip, abon.pk, mac=_parse_mac(client_mac), device_id=dev.pk,
+        port_num=switch_port if mngr_class.get_is_use_device_port() else None
+    )
+    # subscriber gets ip and is pushed to gateway in background
+    schedule_lease_apply()
+    if abon.nas_id is None:
+        return 'User %s has no gateway' % abon.username
+    if not abon.is_access():
+        return 'User %s is not access to service' % abon.username
 
 
 def dhcp_expiry(client_ip: str) -> Optional[str]:
-    abon = Abon.objects.filter(
-        ip_address=client_ip, is_active=True
-    ).exclude(current_tariff=None).first()
-    if abon is None:
-        return "Subscriber with ip %s does not exist" % client_ip
-    else:
-        is_freed = abon.free_ip_addr()
-        if is_freed:
-            abon.nas_sync_self()
+    if not AbonLease.objects.close(client_ip):
+        if AbonLease.objects.filter(ip_address=client_ip).exists():
+            return 'Lease of ip %s is already closed' % client_ip
+        # ip may be attached before leases were kept
+        abon_id = Abon.objects.filter(
+            ip_address=client_ip, is_active=True
+        ).exclude(current_tariff=None).values_list('pk', flat=True).first()
+        if abon_id is None:
+            return "Subscriber with ip %s does not exist" % client_ip
+        now = timezone.now()
+        AbonLease.objects.create(
+            ip_address=client_ip, abon_id=abon_id,
+            lease_start=now, last_seen=now, lease_end=now
+        )
+    # subscriber loses ip and is pushed to gateway in background
+    schedule_lease_apply()
 
 
 def dhcp_release(client_ip: str) -> Optional[str]:
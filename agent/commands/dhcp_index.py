@@ -0,0 +1,145 @@
+"""
+Index of switches and subscribers behind their ports for dhcp events.
+
+It maps mac of switch to device and its type, and (device, port) to
+subscriber. It is built from two queries and kept in django cache,
+so all workers share it. Any save or delete of Device, Port or
+fields of Abon that are in index changes version of index, and
+each worker builds or loads it again on next event.
+"""
+from typing import Optional, NamedTuple
+from uuid import uuid4
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from netaddr import EUI, AddrFormatError
+
+from abonapp.models import Abon
+from devapp.models import Device, Port
+
+
+_VERSION_KEY = 'dhcp_index_version'
+_INDEX_KEY = 'dhcp_index'
+
+# Seconds while index is kept in cache, it is made again after that
+DHCP_INDEX_TTL = 3600
+
+# Fields of Abon which index depends on
+_ABON_INDEX_FIELDS = frozenset((
+    'device', 'dev_port', 'is_active', 'is_dynamic_ip', 'username'
+))
+
+# Marks (device, port) that has more than one subscriber,
+# it is not object() because index is pickled into cache
+MULTIPLE = 'multiple'
+
+
+class IndexedDevice(NamedTuple):
+    pk: int
+    devtype: str
+
+    def get_manager_klass(self):
+        return Device(devtype=self.devtype).get_manager_klass()
+
+
+class IndexedSubscriber(NamedTuple):
+    pk: int
+    username: str
+    is_dynamic_ip: bool
+
+
+class DhcpIndex(object):
+    def __init__(self, version: str):
+        self.version = version
+        # int(mac): IndexedDevice
+        self.devices = {}
+        # (device_id, port_num): IndexedSubscriber or MULTIPLE.
+        # port_num is None for key of subscribers by device only
+        self.subscribers = {}
+
+    def build(self):
+        for pk, mac, devtype in Device.objects.exclude(mac_addr=None).values_list(
+                'pk', 'mac_addr', 'devtype').iterator():
+            self.devices[int(mac)] = IndexedDevice(pk, devtype)
+        for pk, username, is_dynamic, dev_id, port_dev_id, port_num in Abon.objects.filter(
+                is_active=True).exclude(device=None).values_list(
+                'pk', 'username', 'is_dynamic_ip', 'device_id',
+                'dev_port__device_id', 'dev_port__num').iterator():
+            subscriber = IndexedSubscriber(pk, username, is_dynamic)
+            self._add(dev_id, None, subscriber)
+            if port_num is not None and port_dev_id == dev_id:
+                self._add(dev_id, port_num, subscriber)
+
+    def _add(self, dev_id: int, port_num: Optional[int], subscriber):
+        key = (dev_id, port_num)
+        if key in self.subscribers:
+            self.subscribers[key] = MULTIPLE
+        else:
+            self.subscribers[key] = subscriber
+
+    def get_device(self, mac: str) -> Optional[IndexedDevice]:
+        try:
+            return self.devices.get(int(EUI(mac)))
+        except (AddrFormatError, TypeError, ValueError):
+            return None
+
+    def get_subscriber(self, dev: IndexedDevice, port_num: Optional[int]):
+        """
+        :return: IndexedSubscriber, MULTIPLE or None
+        """
+        return self.subscribers.get((dev.pk, port_num))
+
+
+_local_index = None
+
+
+def get_index() -> DhcpIndex:
+    """
+    Returns index of current version, from memory of this process
+    when it is not changed, or from cache, or built again
+    """
+    global _local_index
+    version = cache.get(_VERSION_KEY)
+    if version is None:
+        cache.add(_VERSION_KEY, uuid4().hex, None)
+        version = cache.get(_VERSION_KEY)
+    if _local_index is not None and _local_index.version == version:
+        return _local_index
+    index = cache.get(_INDEX_KEY)
+    if index is None or index.version != version:
+        # version is taken before build, so index that is built
+        # while it is changed would not be used
+        index = DhcpIndex(version)
+        index.build()
+        cache.set(_INDEX_KEY, index, DHCP_INDEX_TTL)
+    _local_index = index
+    return index
+
+
+def invalidate():
+    cache.set(_VERSION_KEY, uuid4().hex, None)
+
+
+def _invalidate_on_commit():
+    # other workers must not build index before changes are committed
+    transaction.on_commit(invalidate)
+
+
+@receiver(post_save, sender=Device)
+@receiver(post_delete, sender=Device)
+@receiver(post_save, sender=Port)
+@receiver(post_delete, sender=Port)
+@receiver(post_delete, sender=Abon)
+def dhcp_index_changed(sender, **kwargs):
+    _invalidate_on_commit()
+
+
+@receiver(post_save, sender=Abon)
+def dhcp_index_abon_saved(sender, **kwargs):
+    update_fields = kwargs.get('update_fields')
+    if update_fields is not None and _ABON_INDEX_FIELDS.isdisjoint(update_fields):
+        # for example attach of ip from dhcp, which is most often
+        return
+    _invalidate_on_commit()
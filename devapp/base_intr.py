@@ -1,8 +1,13 @@
 from abc import ABCMeta, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
-from typing import Union, Iterable, AnyStr, Generator, Optional, Dict
-from easysnmp import Session
+from hashlib import md5
+from uuid import uuid4
+from typing import Union, Iterable, AnyStr, Generator, Optional, Dict, Sequence, Tuple, List
+from easysnmp import Session, EasySNMPError
 
+from django.conf import settings
+from django.core.cache import cache
 from django.utils.translation import gettext, gettext_lazy as _
 
 ListOrError = Union[
@@ -10,6 +15,9 @@ ListOrError = Union[
     Union[Exception, Iterable]
 ]
 
+# Status, signal in dBm and distance in meters of ONU
+OnuState = Tuple[Optional[int], Optional[float], Optional[float]]
+
 
 class DeviceImplementationError(NotImplementedError):
     pass
@@ -40,6 +48,27 @@ class DevBase(object, metaclass=ABCMeta):
         """
         return 5, _('Reboot not ready')
 
+    def port_toggle(self, snmp_num: int, enable: bool) -> None:
+        """
+        Enable or disable port by its snmp number, without reading
+        ports of device
+        """
+        raise DeviceImplementationError(gettext('Port toggling is not supported'))
+
+    def get_onu_signals(self) -> Optional[Dict[str, OnuState]]:
+        """
+        State of all ONUs of OLT, read by one table of OLT
+        :return: snmp_extra of ONU -> OnuState, None when device has no ONUs
+        """
+        return None
+
+    def poll_state(self) -> Tuple[ListOrError, Optional[Dict[str, OnuState]]]:
+        """
+        Ports of device and state of its ONUs for poll_devices.py,
+        devices that read both from one table override it
+        """
+        return self.get_ports(), self.get_onu_signals()
+
     @abstractmethod
     def get_ports(self) -> ListOrError:
         pass
@@ -116,6 +145,58 @@ class BasePort(object, metaclass=ABCMeta):
         return ':'.join('%x' % ord(i) for i in self._mac)
 
 
+# Rows of each column in one GETBULK pdu
+SNMP_MAX_REPETITIONS = 25
+
+# Seconds while walked lists and tables of device are taken from cache,
+# 0 turns cache off. Any SET to device drops its cached values.
+SNMP_CACHE_TTL = getattr(settings, 'SNMP_CACHE_TTL', 30)
+
+_SNMP_NO_VALUE = ('NOSUCHOBJECT', 'NOSUCHINSTANCE', 'ENDOFMIBVIEW')
+
+
+# Admin status of ifTable, 1 is up and 2 is down
+IF_ADMIN_STATUS_OID = '.1.3.6.1.2.1.2.2.1.7'
+
+# How many devices is processed at the same time by toggle_ports
+PORT_TOGGLE_WORKERS = getattr(settings, 'PORT_TOGGLE_WORKERS', 16)
+
+
+def toggle_ports(operations: Iterable[Tuple[DevBase, int, bool]],
+                 workers=PORT_TOGGLE_WORKERS) -> List[Optional[Exception]]:
+    """
+    Enable or disable ports on many devices. Devices are processed
+    concurrently, ports of one device one by one in its session.
+    :param operations: (manager of device, snmp number of port, enable)
+    :return: error or None for each operation, in the same order
+    """
+    operations = tuple(operations)
+    by_manager = {}
+    for i, (mngr, snmp_num, enable) in enumerate(operations):
+        by_manager.setdefault(id(mngr), (mngr, []))[1].append((i, snmp_num, enable))
+    results = [None] * len(operations)
+
+    def run(mngr, ops):
+        for i, snmp_num, enable in ops:
+            try:
+                mngr.port_toggle(snmp_num, enable)
+            except (EasySNMPError, DeviceImplementationError, OSError) as e:
+                # one failed port does not stop others
+                results[i] = e
+
+    if by_manager:
+        with ThreadPoolExecutor(max_workers=min(workers, len(by_manager))) as executor:
+            for f in [executor.submit(run, mngr, ops) for mngr, ops in by_manager.values()]:
+                f.result()
+    return results
+
+
+def invalidate_snmp_cache(ip: str):
+    """Next reads from device with *ip* are not taken from cache"""
+    if SNMP_CACHE_TTL:
+        cache.set('snmp_gen:%s' % ip, uuid4().hex, None)
+
+
 class SNMPBaseWorker(object, metaclass=ABCMeta):
     ses = None
 
@@ -135,21 +216,159 @@ class SNMPBaseWorker(object, metaclass=ABCMeta):
 
     def set_int_value(self, oid: str, value):
         self.start_ses()
-        return self.ses.set(oid, value, 'i')
+        try:
+            return self.ses.set(oid, value, 'i')
+        finally:
+            self.invalidate_snmp_cache()
+
+    def _cache_key(self, *parts) -> Optional[str]:
+        if not SNMP_CACHE_TTL:
+            return None
+        gen_key = 'snmp_gen:%s' % self._ip
+        generation = cache.get(gen_key)
+        if generation is None:
+            generation = uuid4().hex
+            cache.add(gen_key, generation, None)
+            generation = cache.get(gen_key, generation)
+        return 'snmp:%s:%s:%s' % (
+            self._ip, generation, md5(repr(parts).encode()).hexdigest()
+        )
+
+    def _cached(self, key_parts: tuple, fetch):
+        key = self._cache_key(*key_parts)
+        if key is None:
+            return fetch()
+        r = cache.get(key)
+        if r is None:
+            r = fetch()
+            cache.set(key, r, SNMP_CACHE_TTL)
+        return r
+
+    def invalidate_snmp_cache(self):
+        """Next reads from this device are not taken from cache"""
+        invalidate_snmp_cache(self._ip)
+
+    def _walk(self, oid):
+        self.start_ses()
+        if self._ver == 1:
+            return self.ses.walk(oid)
+        # GETBULK gives many rows in one pdu
+        return self.ses.bulkwalk(oid, max_repetitions=SNMP_MAX_REPETITIONS)
 
     def get_list(self, oid) -> Generator:
-        self.start_ses()
-        for v in self.ses.walk(oid):
-            yield v.value
+        yield from self._cached(('list', oid), lambda: tuple(
+            v.value for v in self._walk(oid)
+        ))
 
     def get_list_keyval(self, oid) -> Generator:
-        self.start_ses()
-        for v in self.ses.walk(oid):
-            snmpnum = v.oid.split('.')[-1:]
-            yield v.value, snmpnum[0] if len(snmpnum) > 0 else None
+        def fetch():
+            r = []
+            for v in self._walk(oid):
+                snmpnum = v.oid.split('.')[-1:]
+                r.append((v.value, snmpnum[0] if len(snmpnum) > 0 else None))
+            return tuple(r)
+        yield from self._cached(('keyval', oid), fetch)
 
     def get_item(self, oid):
         self.start_ses()
         v = self.ses.get(oid).value
         if v != 'NOSUCHINSTANCE':
             return v
+
+    def get_items(self, *oids) -> tuple:
+        """
+        Get many values in one pdu
+        :return: values in order of oids, None for missing instances
+        """
+        self.start_ses()
+        return tuple(
+            None if v.snmp_type in _SNMP_NO_VALUE else v.value
+            for v in self.ses.get(list(oids))
+        )
+
+    def get_table(self, columns: Dict[str, str],
+                  max_repetitions=SNMP_MAX_REPETITIONS) -> Dict[str, Dict]:
+        """
+        Fetch many columns of tables by GETBULK. All columns are walked
+        together, so each pdu brings max_repetitions rows of each column.
+        Columns may be from different tables with the same index.
+        :param columns: name of column -> oid of column
+        :return: index of row -> {name of column: value}, index is
+                 the part of oid after oid of column, e.g. '12' or '3.1'
+        """
+        return self._cached(
+            ('table', sorted(columns.items()), max_repetitions),
+            lambda: self._fetch_table(columns, max_repetitions)
+        )
+
+    def _fetch_table(self, columns: Dict[str, str], max_repetitions: int) -> Dict[str, Dict]:
+        self.start_ses()
+        if self._ver == 1:
+            return self._get_table_by_walk(columns)
+        bases = {name: oid.strip('.') for name, oid in columns.items()}
+        cursors = dict(bases)
+        rows = {}
+        use_numeric = self.ses.use_numeric
+        self.ses.use_numeric = True
+        try:
+            while cursors:
+                names = tuple(cursors.keys())
+                res = self.ses.get_bulk(
+                    ['.%s' % cursors[n] for n in names],
+                    non_repeaters=0, max_repetitions=max_repetitions
+                )
+                finished = set()
+                moved = set()
+                # varbinds of one pdu are interleaved by columns
+                for i, v in enumerate(res):
+                    name = names[i % len(names)]
+                    if name in finished:
+                        continue
+                    oid = _full_oid(v)
+                    base = bases[name]
+                    if v.snmp_type in _SNMP_NO_VALUE or not oid.startswith(base + '.'):
+                        finished.add(name)
+                        continue
+                    rows.setdefault(oid[len(base) + 1:], {})[name] = v.value
+                    if cursors[name] != oid:
+                        cursors[name] = oid
+                        moved.add(name)
+                for name in names:
+                    # end of column, or agent that does not move forward
+                    if name in finished or name not in moved:
+                        del cursors[name]
+        finally:
+            self.ses.use_numeric = use_numeric
+        return rows
+
+    def _get_table_by_walk(self, columns: Dict[str, str]) -> Dict[str, Dict]:
+        rows = {}
+        use_numeric = self.ses.use_numeric
+        self.ses.use_numeric = True
+        try:
+            for name, column_oid in columns.items():
+                base = column_oid.strip('.')
+                for v in self.ses.walk(column_oid):
+                    oid = _full_oid(v)
+                    if oid.startswith(base + '.'):
+                        rows.setdefault(oid[len(base) + 1:], {})[name] = v.value
+        finally:
+            self.ses.use_numeric = use_numeric
+        return rows
+
+
+def _full_oid(v) -> str:
+    if v.oid_index:
+        return ('%s.%s' % (v.oid, v.oid_index)).strip('.')
+    return v.oid.strip('.')
+
+
+def sorted_indexes(rows: Dict[str, Dict], column: Optional[str] = None) -> Sequence[str]:
+    """
+    Indexes of rows from SNMPBaseWorker.get_table in numeric order
+    :param column: only rows that have this column
+    """
+    return sorted(
+        (i for i, row in rows.items() if column is None or column in row),
+        key=lambda i: tuple(int(n) for n in i.split('.') if n.isdigit())
+    )
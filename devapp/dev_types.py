@@ -13,7 +13,7 @@ from devapp.expect_scripts import register_f601_onu, register_f660_onu, ExpectVa
 from devapp.expect_scripts.base import sn_to_mac
 from .base_intr import (
     DevBase, SNMPBaseWorker, BasePort, DeviceImplementationError,
-    ListOrError, DeviceConfigurationError
+    ListOrError, DeviceConfigurationError, sorted_indexes, IF_ADMIN_STATUS_OID
 )
 
 
@@ -69,14 +69,10 @@ class DLinkPort(BasePort):
         self.snmp_worker = snmp_worker
 
     def disable(self):
-        self.snmp_worker.set_int_value(
-            "%s.%d" % ('.1.3.6.1.2.1.2.2.1.7', self.num), 2
-        )
+        self.snmp_worker.port_toggle(self.snmp_num, False)
 
     def enable(self):
-        self.snmp_worker.set_int_value(
-            "%s.%d" % ('.1.3.6.1.2.1.2.2.1.7', self.num), 1
-        )
+        self.snmp_worker.port_toggle(self.snmp_num, True)
 
 
 class DLinkDevice(DevBase, SNMPBaseWorker):
@@ -107,26 +103,32 @@ class DLinkDevice(DevBase, SNMPBaseWorker):
 
     def get_ports(self) -> ListOrError:
         interfaces_count = safe_int(self.get_item('.1.3.6.1.2.1.2.1.0'))
-        nams = tuple(self.get_list('.1.3.6.1.4.1.171.10.134.2.1.1.100.2.1.3'))
-        stats = tuple(self.get_list('.1.3.6.1.2.1.2.2.1.7'))
-        macs = tuple(self.get_list('.1.3.6.1.2.1.2.2.1.6'))
-        speeds = tuple(self.get_list('.1.3.6.1.2.1.2.2.1.5'))
-        try:
-            for n in range(interfaces_count):
-                status = True if int(stats[n]) == 1 else False
-                yield DLinkPort(
-                    num=n + 1,
-                    name=nams[n] if len(nams) > 0 else '',
-                    status=status,
-                    mac=macs[n] if len(macs) > 0 else _('does not fetch the mac'),
-                    speed=int(speeds[n]) if len(speeds) > 0 else 0,
-                    snmp_worker=self)
-        except IndexError:
-            return DeviceImplementationError('Dlink port index error')
+        rows = self.get_table({
+            'name': '.1.3.6.1.4.1.171.10.134.2.1.1.100.2.1.3',
+            'status': '.1.3.6.1.2.1.2.2.1.7',
+            'mac': '.1.3.6.1.2.1.2.2.1.6',
+            'speed': '.1.3.6.1.2.1.2.2.1.5'
+        })
+        for n in range(1, interfaces_count + 1):
+            row = rows.get(str(n))
+            if row is None or 'status' not in row:
+                return DeviceImplementationError('Dlink port index error')
+            yield DLinkPort(
+                num=n,
+                name=row.get('name', ''),
+                status=safe_int(row['status']) == 1,
+                mac=row.get('mac', _('does not fetch the mac')),
+                speed=safe_int(row.get('speed')),
+                snmp_worker=self)
 
     def get_device_name(self):
         return self.get_item('.1.3.6.1.2.1.1.1.0')
 
+    def port_toggle(self, snmp_num: int, enable: bool) -> None:
+        self.set_int_value(
+            '%s.%d' % (IF_ADMIN_STATUS_OID, int(snmp_num)), 1 if enable else 2
+        )
+
     def uptime(self) -> timedelta:
         uptimestamp = safe_int(self.get_item('.1.3.6.1.2.1.1.8.0'))
         tm = RuTimedelta(timedelta(seconds=uptimestamp / 100)) or RuTimedelta(timedelta())
@@ -149,12 +151,13 @@ class DLinkDevice(DevBase, SNMPBaseWorker):
 
 
 class ONUdev(BasePort):
-    def __init__(self, signal, snmp_worker, *args, **kwargs):
+    def __init__(self, signal, snmp_worker, *args, distance=None, **kwargs):
         super(ONUdev, self).__init__(*args, **kwargs)
         if not issubclass(snmp_worker.__class__, SNMPBaseWorker):
             raise TypeError
         self.snmp_worker = snmp_worker
         self.signal = signal
+        self.distance = distance
 
     def disable(self):
         pass
@@ -175,28 +178,63 @@ class OLTDevice(DevBase, SNMPBaseWorker):
         DevBase.__init__(self, dev_instance)
         SNMPBaseWorker.__init__(self, dev_instance.ip_address, dev_instance.man_passw, 2)
 
-    def get_ports(self) -> ListOrError:
-        nms = self.get_list('.1.3.6.1.4.1.3320.101.10.1.1.79')
+    # Columns of ONUs, ports and signals are read by one table,
+    # poll_state makes both of them from one walk
+    ONU_COLUMNS = {
+        'onu_num': '.1.3.6.1.4.1.3320.101.10.1.1.79',
+        'status': '.1.3.6.1.4.1.3320.101.10.1.1.26',
+        'mac': '.1.3.6.1.4.1.3320.101.10.1.1.3',
+        'distance': '.1.3.6.1.4.1.3320.101.10.1.1.27',
+        'signal': '.1.3.6.1.4.1.3320.101.10.5.1.5',
+        'name': '.1.3.6.1.2.1.2.2.1.2'
+    }
+
+    def _ports_from_rows(self, rows: dict) -> list:
         res = []
+        for i in sorted_indexes(rows, 'onu_num'):
+            n = int(rows[i]['onu_num'])
+            row = rows.get(str(n), {})
+            signal = safe_float(row.get('signal'))
+            res.append(ONUdev(
+                num=n,
+                name=row.get('name'),
+                status=row.get('status') == '3',
+                mac=row.get('mac'),
+                speed=0,
+                signal=signal / 10 if signal else '—',
+                distance=safe_int(row.get('distance')) / 10,
+                snmp_worker=self))
+        return res
+
+    @staticmethod
+    def _signals_from_rows(rows: dict) -> dict:
+        res = {}
+        # ONU is bound to OLT by its interface index
+        for i in sorted_indexes(rows, 'status'):
+            row = rows[i]
+            signal = safe_float(row.get('signal'))
+            distance = row.get('distance')
+            res[i] = (
+                safe_int(row['status']),
+                signal / 10 if signal else None,
+                int(distance) / 10 if distance and distance.isdigit() else None
+            )
+        return res
+
+    def get_ports(self) -> ListOrError:
         try:
-            for nm in nms:
-                n = int(nm)
-                status = self.get_item('.1.3.6.1.4.1.3320.101.10.1.1.26.%d' % n)
-                signal = safe_float(self.get_item('.1.3.6.1.4.1.3320.101.10.5.1.5.%d' % n))
-                onu = ONUdev(
-                    num=n,
-                    name=self.get_item('.1.3.6.1.2.1.2.2.1.2.%d' % n),
-                    status=True if status == '3' else False,
-                    mac=self.get_item('.1.3.6.1.4.1.3320.101.10.1.1.3.%d' % n),
-                    speed=0,
-                    signal=signal / 10 if signal else '—',
-                    snmp_worker=self)
-                res.append(onu)
+            return self._ports_from_rows(self.get_table(self.ONU_COLUMNS))
         except EasySNMPTimeoutError as e:
             return EasySNMPTimeoutError(
                 "%s (%s)" % (gettext('wait for a reply from the SNMP Timeout'), e)
-            ), res
-        return res
+            ), []
+
+    def get_onu_signals(self):
+        return self._signals_from_rows(self.get_table(self.ONU_COLUMNS))
+
+    def poll_state(self):
+        rows = self.get_table(self.ONU_COLUMNS)
+        return self._ports_from_rows(rows), self._signals_from_rows(rows)
 
     def get_device_name(self):
         return self.get_item('.1.3.6.1.2.1.1.5.0')
@@ -262,10 +300,14 @@ class OnuDevice(DevBase, SNMPBaseWorker):
         if num == 0:
             return
         try:
-            status = self.get_item('.1.3.6.1.4.1.3320.101.10.1.1.26.%d' % num)
-            signal = safe_float(self.get_item('.1.3.6.1.4.1.3320.101.10.5.1.5.%d' % num))
-            distance = self.get_item('.1.3.6.1.4.1.3320.101.10.1.1.27.%d' % num)
-            mac = self.get_item('.1.3.6.1.4.1.3320.101.10.1.1.3.%d' % num)
+            status, signal, distance, mac, name = self.get_items(
+                '.1.3.6.1.4.1.3320.101.10.1.1.26.%d' % num,
+                '.1.3.6.1.4.1.3320.101.10.5.1.5.%d' % num,
+                '.1.3.6.1.4.1.3320.101.10.1.1.27.%d' % num,
+                '.1.3.6.1.4.1.3320.101.10.1.1.3.%d' % num,
+                '.1.3.6.1.2.1.2.2.1.2.%d' % num
+            )
+            signal = safe_float(signal)
             if mac is not None:
                 mac = ':'.join('%x' % ord(i) for i in mac)
             # uptime = self.get_item('.1.3.6.1.2.1.2.2.1.9.%d' % num)
@@ -273,9 +315,9 @@ class OnuDevice(DevBase, SNMPBaseWorker):
                 return {
                     'status': status,
                     'signal': signal / 10 if signal else '—',
-                    'name': self.get_item('.1.3.6.1.2.1.2.2.1.2.%d' % num),
+                    'name': name,
                     'mac': mac,
-                    'distance': int(distance) / 10 if distance.isdigit() else 0
+                    'distance': int(distance) / 10 if distance and distance.isdigit() else 0
                 }
         except EasySNMPTimeoutError as e:
             return {'err': "%s: %s" % (_('ONU not connected'), e)}
@@ -324,16 +366,10 @@ class EltexPort(BasePort):
         self.snmp_worker = snmp_worker
 
     def disable(self):
-        self.snmp_worker.set_int_value(
-            "%s.%d" % ('.1.3.6.1.2.1.2.2.1.7', self.num),
-            2
-        )
+        self.snmp_worker.port_toggle(self.snmp_num, False)
 
     def enable(self):
-        self.snmp_worker.set_int_value(
-            "%s.%d" % ('.1.3.6.1.2.1.2.2.1.7', self.num),
-            1
-        )
+        self.snmp_worker.port_toggle(self.snmp_num, True)
 
 
 class EltexSwitch(DLinkDevice):
@@ -343,14 +379,20 @@ class EltexSwitch(DLinkDevice):
     tech_code = 'eltex_sw'
 
     def get_ports(self) -> ListOrError:
+        rows = self.get_table({
+            'speed': '.1.3.6.1.2.1.2.2.1.5',
+            'name': '.1.3.6.1.2.1.31.1.1.1.18',
+            'status': '.1.3.6.1.2.1.2.2.1.8',
+            'mac': '.1.3.6.1.2.1.2.2.1.6'
+        })
         for i, n in enumerate(range(49, 77), 1):
-            speed = self.get_item('.1.3.6.1.2.1.2.2.1.5.%d' % n)
+            row = rows.get(str(n), {})
             yield EltexPort(self,
                 num=i,
-                name=self.get_item('.1.3.6.1.2.1.31.1.1.1.18.%d' % n),
-                status=self.get_item('.1.3.6.1.2.1.2.2.1.8.%d' % n),
-                mac=self.get_item('.1.3.6.1.2.1.2.2.1.6.%d' % n),
-                speed=int(speed or 0)
+                name=row.get('name'),
+                status=row.get('status'),
+                mac=row.get('mac'),
+                speed=safe_int(row.get('speed'))
             )
 
     def get_device_name(self):
@@ -383,49 +425,86 @@ class Olt_ZTE_C320(OLTDevice):
     description = 'OLT ZTE C320'
 
     def get_fibers(self):
+        rows = self.get_table({
+            'name': '.1.3.6.1.4.1.3902.1012.3.13.1.1.1',
+            'onu_num': '.1.3.6.1.4.1.3902.1012.3.13.1.1.13'
+        })
         fibers = ({
             'fb_id': fiber_id,
-            'fb_name': fiber_name,
-            'fb_onu_num': safe_int(self.get_item('.1.3.6.1.4.1.3902.1012.3.13.1.1.13.%d' % int(fiber_id)))
-        } for fiber_name, fiber_id in self.get_list_keyval('.1.3.6.1.4.1.3902.1012.3.13.1.1.1'))
+            'fb_name': rows[fiber_id]['name'],
+            'fb_onu_num': safe_int(rows[fiber_id].get('onu_num'))
+        } for fiber_id in sorted_indexes(rows, 'name'))
         return fibers
 
     def get_ports_on_fiber(self, fiber_num: int) -> Iterable:
 
-        onu_types = self.get_list_keyval('.1.3.6.1.4.1.3902.1012.3.28.1.1.1.%d' % fiber_num)
-        onu_ports = self.get_list('.1.3.6.1.4.1.3902.1012.3.28.1.1.2.%d' % fiber_num)
-        onu_signals = safe_int(self.get_list('.1.3.6.1.4.1.3902.1012.3.50.12.1.1.10.%d' % fiber_num))
-
-        # Real sn in last 3 octets
-        onu_sns = self.get_list('.1.3.6.1.4.1.3902.1012.3.28.1.1.5.%d' % fiber_num)
-        onu_prefixs = self.get_list('.1.3.6.1.4.1.3902.1012.3.50.11.2.1.1.%d' % fiber_num)
+        rows = self.get_table({
+            'type': '.1.3.6.1.4.1.3902.1012.3.28.1.1.1.%d' % fiber_num,
+            'port': '.1.3.6.1.4.1.3902.1012.3.28.1.1.2.%d' % fiber_num,
+            # Real sn in last 4 octets
+            'sn': '.1.3.6.1.4.1.3902.1012.3.28.1.1.5.%d' % fiber_num,
+            'prefix': '.1.3.6.1.4.1.3902.1012.3.50.11.2.1.1.%d' % fiber_num
+        })
+        # signal table is indexed by onu number and onu interface
+        signals = {
+            i.split('.')[0]: row['signal'] for i, row in self.get_table({
+                'signal': '.1.3.6.1.4.1.3902.1012.3.50.12.1.1.10.%d' % fiber_num
+            }).items()
+        }
         onu_list = ({
-            'onu_type': onu_type_num[0],
-            'onu_port': onu_port,
-            'onu_signal': conv_zte_signal(onu_signal),
-            'onu_sn': onu_prefix + ''.join('%.2X' % ord(i) for i in onu_sn[-4:]),  # Real sn in last 4 octets,
-            'snmp_extra': "%d.%d" % (fiber_num, safe_int(onu_type_num[1])),
-        } for onu_type_num, onu_port, onu_signal, onu_sn, onu_prefix in zip(
-            onu_types, onu_ports, onu_signals, onu_sns, onu_prefixs
-        ))
+            'onu_type': rows[onu_num]['type'],
+            'onu_port': rows[onu_num].get('port'),
+            'onu_signal': conv_zte_signal(safe_int(signals.get(onu_num))),
+            'onu_sn': rows[onu_num].get('prefix', '') + ''.join(
+                '%.2X' % ord(i) for i in rows[onu_num].get('sn', '')[-4:]
+            ),
+            'snmp_extra': "%d.%d" % (fiber_num, safe_int(onu_num)),
+        } for onu_num in sorted_indexes(rows, 'type'))
 
         return onu_list
 
+    def get_onu_signals(self):
+        # tables of all fibers, index is fiber.onu.interface
+        rows = self.get_table({
+            'status': '.1.3.6.1.4.1.3902.1012.3.50.12.1.1.1',
+            'signal': '.1.3.6.1.4.1.3902.1012.3.50.12.1.1.10',
+            'distance': '.1.3.6.1.4.1.3902.1012.3.50.12.1.1.18'
+        })
+        res = {}
+        for i in sorted_indexes(rows, 'status'):
+            parts = i.split('.')
+            if len(parts) != 3 or parts[2] != '1':
+                continue
+            row = rows[i]
+            signal = row.get('signal')
+            if signal and signal.isdigit() and signal != '65535':
+                signal = conv_zte_signal(int(signal))
+            else:
+                # 65535 is for ONU without signal
+                signal = None
+            distance = row.get('distance')
+            res['%s.%s' % (parts[0], parts[1])] = (
+                safe_int(row['status']),
+                signal,
+                int(distance) / 10 if distance and distance.isdigit() else None
+            )
+        return res
+
     def get_units_unregistered(self, fiber_num: int) -> Iterable:
-        sn_num_list = self.get_list_keyval('.1.3.6.1.4.1.3902.1012.3.13.3.1.2.%d' % fiber_num)
-        firmware_ver = self.get_list('.1.3.6.1.4.1.3902.1012.3.13.3.1.11.%d' % fiber_num)
-        loid_passws = self.get_list('.1.3.6.1.4.1.3902.1012.3.13.3.1.9.%d' % fiber_num)
-        loids = self.get_list('.1.3.6.1.4.1.3902.1012.3.13.3.1.8.%d' % fiber_num)
+        rows = self.get_table({
+            'sn': '.1.3.6.1.4.1.3902.1012.3.13.3.1.2.%d' % fiber_num,
+            'firmware_ver': '.1.3.6.1.4.1.3902.1012.3.13.3.1.11.%d' % fiber_num,
+            'loid_passw': '.1.3.6.1.4.1.3902.1012.3.13.3.1.9.%d' % fiber_num,
+            'loid': '.1.3.6.1.4.1.3902.1012.3.13.3.1.8.%d' % fiber_num
+        })
 
         return ({
-            'mac': ':'.join('%x' % ord(i) for i in sn[-6:]),
-            'firmware_ver': frm_ver,
-            'loid_passw': loid_passw,
-            'loid': loid,
-            'sn': sn
-        } for frm_ver, loid_passw, loid, (sn, num) in zip(
-            firmware_ver, loid_passws, loids, sn_num_list
-        ))
+            'mac': ':'.join('%x' % ord(i) for i in rows[i]['sn'][-6:]),
+            'firmware_ver': rows[i].get('firmware_ver'),
+            'loid_passw': rows[i].get('loid_passw'),
+            'loid': rows[i].get('loid'),
+            'sn': rows[i]['sn']
+        } for i in sorted_indexes(rows, 'sn'))
 
     def uptime(self):
         up_timestamp = safe_int(self.get_item('.1.3.6.1.2.1.1.3.0'))
@@ -493,15 +572,18 @@ class ZteOnuDevice(OnuDevice):
             fiber_num, onu_num = snmp_extra.split('.')
             fiber_num, onu_num = int(fiber_num), int(onu_num)
             fiber_addr = '%d.%d' % (fiber_num, onu_num)
-            status = self.get_item('.1.3.6.1.4.1.3902.1012.3.50.12.1.1.1.%s.1' % fiber_addr)
-            signal = safe_int(self.get_item('.1.3.6.1.4.1.3902.1012.3.50.12.1.1.10.%s.1' % fiber_addr))
-            distance = self.get_item('.1.3.6.1.4.1.3902.1012.3.50.12.1.1.18.%s.1' % fiber_addr)
-            ip_addr = self.get_item('.1.3.6.1.4.1.3902.1012.3.50.16.1.1.10.%s' % fiber_addr)
-            vlans = self.get_item('.1.3.6.1.4.1.3902.1012.3.50.15.100.1.1.7.%s.1.1' % fiber_addr)
-            int_name = self.get_item('.1.3.6.1.4.1.3902.1012.3.28.1.1.3.%s' % fiber_addr)
-            onu_type = self.get_item('.1.3.6.1.4.1.3902.1012.3.28.1.1.1.%s' % fiber_addr)
-
-            sn = self.get_item('.1.3.6.1.4.1.3902.1012.3.28.1.1.5.%s' % fiber_addr)
+            status, signal, distance, ip_addr, vlans, int_name, onu_type, sn = self.get_items(
+                '.1.3.6.1.4.1.3902.1012.3.50.12.1.1.1.%s.1' % fiber_addr,
+                '.1.3.6.1.4.1.3902.1012.3.50.12.1.1.10.%s.1' % fiber_addr,
+                '.1.3.6.1.4.1.3902.1012.3.50.12.1.1.18.%s.1' % fiber_addr,
+                '.1.3.6.1.4.1.3902.1012.3.50.16.1.1.10.%s' % fiber_addr,
+                '.1.3.6.1.4.1.3902.1012.3.50.15.100.1.1.7.%s.1.1' % fiber_addr,
+                '.1.3.6.1.4.1.3902.1012.3.28.1.1.3.%s' % fiber_addr,
+                '.1.3.6.1.4.1.3902.1012.3.28.1.1.1.%s' % fiber_addr,
+                # Real sn in last 4 octets
+                '.1.3.6.1.4.1.3902.1012.3.28.1.1.5.%s' % fiber_addr
+            )
+            signal = safe_int(signal)
             if sn is not None:
                 sn = 'ZTEG%s' % ''.join('%.2X' % ord(x) for x in sn[-4:])
 
@@ -588,24 +670,29 @@ class HuaweiSwitch(EltexSwitch):
     tech_code = 'huawei_s2300'
 
     def get_ports(self):
-        interfaces_ids = self.get_list('.1.3.6.1.2.1.17.1.4.1.2')
-        if interfaces_ids is None:
+        rows = self.get_table({
+            'if_index': '.1.3.6.1.2.1.17.1.4.1.2',
+            'speed': '.1.3.6.1.2.1.2.2.1.5',
+            'oper_status': '.1.3.6.1.2.1.2.2.1.7',
+            'link_status': '.1.3.6.1.2.1.2.2.1.8',
+            'name': '.1.3.6.1.2.1.2.2.1.2'
+        })
+        interfaces_ids = sorted_indexes(rows, 'if_index')
+        if not interfaces_ids:
             raise DeviceImplementationError('Switch returned null')
-        for i, n in enumerate(interfaces_ids):
-            n = int(n)
-            speed = self.get_item('.1.3.6.1.2.1.2.2.1.5.%d' % n)
-            oper_status = safe_int(self.get_item('.1.3.6.1.2.1.2.2.1.7.%d' % n))
-            oper_status = True if oper_status == 1 else False
-            link_status = safe_int(self.get_item('.1.3.6.1.2.1.2.2.1.8.%d' % n))
-            link_status = True if link_status == 1 else False
+        for i, base_port in enumerate(interfaces_ids):
+            n = int(rows[base_port]['if_index'])
+            row = rows.get(str(n), {})
+            oper_status = safe_int(row.get('oper_status')) == 1
+            link_status = safe_int(row.get('link_status')) == 1
             ep = EltexPort(
                 self,
                 num=i+1,
                 snmp_num=n,
-                name=self.get_item('.1.3.6.1.2.1.2.2.1.2.%d' % n),         # name
+                name=row.get('name'),                                      # name
                 status=oper_status,                                        # status
-                mac='', # self.get_item('.1.3.6.1.2.1.2.2.1.6.%d' % n),    # mac
-                speed=0 if not link_status else safe_int(speed)            # speed
+                mac='',                                                    # mac
+                speed=0 if not link_status else safe_int(row.get('speed'))  # speed
             )
             ep.writable = True
             yield ep
@@ -0,0 +1,36 @@
+# Generated by Django 2.1 on 2026-10-16 12:00
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('devapp', '0001_squashed_0005_device_ip_address_change'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PortState',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('num', models.PositiveIntegerField()),
+                ('snmp_num', models.PositiveIntegerField()),
+                ('name', models.CharField(blank=True, default='', max_length=64)),
+                ('status', models.BooleanField(default=False)),
+                ('speed', models.BigIntegerField(default=0)),
+                ('mac', models.CharField(blank=True, default='', max_length=24)),
+                ('signal', models.FloatField(blank=True, null=True)),
+                ('distance', models.FloatField(blank=True, null=True)),
+                ('writable', models.BooleanField(default=False)),
+                ('updated', models.DateTimeField()),
+                ('device', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='devapp.Device')),
+            ],
+            options={
+                'db_table': 'dev_port_state',
+                'ordering': ('num',),
+                'unique_together': {('device', 'num')},
+            },
+        ),
+    ]
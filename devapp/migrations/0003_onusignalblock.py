@@ -0,0 +1,29 @@
+# Generated by Django 2.1 on 2026-10-16 12:00
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('devapp', '0002_portstate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OnuSignalBlock',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('step', models.PositiveIntegerField(default=0)),
+                ('samples', models.BinaryField(default=b'')),
+                ('device', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='devapp.Device')),
+            ],
+            options={
+                'db_table': 'dev_onu_signal',
+                'ordering': ('day',),
+                'unique_together': {('device', 'day')},
+            },
+        ),
+    ]
@@ -1,15 +1,16 @@
+from datetime import datetime, time, timedelta
 from typing import Optional, AnyStr
 
 from jsonfield import JSONField
-from django.db import models
+from django.db import models, transaction, connection
 from django.shortcuts import resolve_url
 from django.utils.translation import gettext_lazy as _
 
 from djing.fields import MACAddressField
-from djing.lib import MyChoicesAdapter
+from djing.lib import MyChoicesAdapter, safe_int
 from group_app.models import Group
-from . import dev_types
-from .base_intr import DevBase
+from . import dev_types, onu_signal
+from .base_intr import DevBase, invalidate_snmp_cache
 
 
 class DeviceDBException(Exception):
@@ -91,10 +92,15 @@ class Device(models.Model):
 
     def register_device(self):
         mng = self.get_manager_object()
-        if not self.extra_data:
-            if self.parent_dev and self.parent_dev.extra_data:
-                return mng.register_device(self.parent_dev.extra_data)
-        return mng.register_device(self.extra_data)
+        parent = self.parent_dev
+        if not self.extra_data and parent and parent.extra_data:
+            r = mng.register_device(parent.extra_data)
+        else:
+            r = mng.register_device(self.extra_data)
+        # tables of unregistered and registered ONU on OLT are changed
+        if parent and parent.ip_address:
+            invalidate_snmp_cache(str(parent.ip_address))
+        return r
 
     def get_absolute_url(self):
         return resolve_url('devapp:edit', self.group.pk, self.pk)
@@ -117,3 +123,192 @@ class Port(models.Model):
         verbose_name = _('Port')
         verbose_name_plural = _('Ports')
         ordering = ('num',)
+
+
+class PortStateManager(models.Manager):
+    def store(self, states_by_device: dict) -> int:
+        """
+        Replace state of ports of devices in one transaction
+        :param states_by_device: device id -> iterable of PortState
+        :return: count of stored rows
+        """
+        rows = [st for states in states_by_device.values() for st in states]
+        with transaction.atomic():
+            self.filter(device_id__in=tuple(states_by_device.keys())).delete()
+            self.bulk_create(rows, batch_size=1000)
+        return len(rows)
+
+
+class PortState(models.Model):
+    """
+    Last polled state of port or ONU of device, see poll_devices.py
+    It has the same attributes as devapp.base_intr.BasePort for templates.
+    """
+    device = models.ForeignKey(Device, on_delete=models.CASCADE)
+    num = models.PositiveIntegerField()
+    snmp_num = models.PositiveIntegerField()
+    name = models.CharField(max_length=64, blank=True, default='')
+    status = models.BooleanField(default=False)
+    speed = models.BigIntegerField(default=0)
+    mac = models.CharField(max_length=24, blank=True, default='')
+    signal = models.FloatField(null=True, blank=True)
+    distance = models.FloatField(null=True, blank=True)
+    writable = models.BooleanField(default=False)
+    updated = models.DateTimeField()
+
+    objects = PortStateManager()
+
+    @classmethod
+    def from_port(cls, device_id: int, port, now):
+        """
+        :param port: instance of devapp.base_intr.BasePort
+        """
+        try:
+            mac = port.mac()
+        except (TypeError, ValueError):
+            mac = ''
+        status = port.st
+        if not isinstance(status, bool):
+            # Raw ifOperStatus of some switches
+            status = safe_int(status) == 1
+        signal = getattr(port, 'signal', None)
+        distance = getattr(port, 'distance', None)
+        return cls(
+            device_id=device_id, num=port.num, snmp_num=port.snmp_num,
+            name=str(port.nm or '')[:64], status=status,
+            speed=safe_int(port.sp), mac=mac[:24],
+            signal=signal if isinstance(signal, (int, float)) else None,
+            distance=distance if isinstance(distance, (int, float)) else None,
+            writable=bool(port.writable), updated=now
+        )
+
+    # Names of BasePort attributes
+    @property
+    def nm(self):
+        return self.name
+
+    @property
+    def st(self):
+        return self.status
+
+    @property
+    def sp(self):
+        return self.speed
+
+    def __str__(self):
+        return "%s: %d %s" % (self.device_id, self.num, self.status)
+
+    class Meta:
+        db_table = 'dev_port_state'
+        unique_together = ('device', 'num')
+        ordering = ('num',)
+
+
+class OnuSignalBlockManager(models.Manager):
+    def append(self, states_by_device: dict, now) -> int:
+        """
+        Add one sample to block of current day of each ONU,
+        in one transaction for all of them. Existing blocks are
+        appended in place by database, so only new record is sent
+        for each ONU, blocks are made only for new day.
+        :param states_by_device: device id -> (status, signal, distance)
+        :return: count of added samples
+        """
+        day = now.date()
+        sec = now.hour * 3600 + now.minute * 60 + now.second
+        records = {dev_id: onu_signal.pack_sample(
+            onu_signal.OnuSample(sec, signal, distance, status)
+        ) for dev_id, (status, signal, distance) in states_by_device.items()}
+        with transaction.atomic():
+            existing = set(self.filter(
+                device_id__in=tuple(records.keys()), day=day
+            ).values_list('device_id', flat=True))
+            if existing:
+                with connection.cursor() as cur:
+                    cur.executemany(
+                        'UPDATE %s SET samples = CONCAT(samples, %%s) '
+                        'WHERE device_id=%%s AND day=%%s' % self.model._meta.db_table,
+                        [(records[dev_id], dev_id, day) for dev_id in existing]
+                    )
+            self.bulk_create((
+                self.model(device_id=dev_id, day=day, samples=record)
+                for dev_id, record in records.items() if dev_id not in existing
+            ), batch_size=500)
+        return len(records)
+
+    def downsample(self, before_day, step: int) -> int:
+        """
+        Leave one sample for each *step* seconds in blocks
+        that are older than *before_day*
+        :return: count of changed blocks
+        """
+        count = 0
+        for block in self.filter(day__lt=before_day, step__lt=step).iterator():
+            block.samples = onu_signal.pack_samples(
+                onu_signal.downsample(block.get_samples(), step)
+            )
+            block.step = step
+            block.save(update_fields=('samples', 'step'))
+            count += 1
+        return count
+
+    def history(self, device_id: int, since_day) -> list:
+        """
+        :return: list of (datetime, devapp.onu_signal.OnuSample) in time order
+        """
+        res = []
+        for block in self.filter(device_id=device_id, day__gte=since_day).order_by('day'):
+            day_start = datetime.combine(block.day, time())
+            res.extend(
+                (day_start + timedelta(seconds=s.sec), s) for s in block.get_samples()
+            )
+        return res
+
+    def signal_drops(self, day, days_before: int, min_drop: float) -> list:
+        """
+        ONUs whose average signal of *day* is lower than average
+        signal of day that was *days_before* days earlier
+        :return: list of (device_id, signal before, signal now) ordered
+                 from the biggest drop
+        """
+        before_day = day - timedelta(days=days_before)
+        averages = {}
+        for dev_id, block_day, samples in self.filter(
+                day__in=(day, before_day)).values_list('device_id', 'day', 'samples').iterator():
+            averages[(dev_id, block_day)] = onu_signal.average_signal(
+                onu_signal.unpack_samples(samples)
+            )
+        res = []
+        for (dev_id, block_day), signal_before in averages.items():
+            if block_day != before_day or signal_before is None:
+                continue
+            signal_now = averages.get((dev_id, day))
+            if signal_now is not None and signal_before - signal_now >= min_drop:
+                res.append((dev_id, signal_before, signal_now))
+        res.sort(key=lambda r: r[2] - r[1])
+        return res
+
+
+class OnuSignalBlock(models.Model):
+    """
+    Signal, distance and status of ONU for one day, packed by
+    devapp.onu_signal. Filled by poll_devices.py from tables of OLT.
+    """
+    device = models.ForeignKey(Device, on_delete=models.CASCADE)
+    day = models.DateField()
+    # Seconds between samples after downsampling, 0 is for raw samples
+    step = models.PositiveIntegerField(default=0)
+    samples = models.BinaryField(default=b'')
+
+    objects = OnuSignalBlockManager()
+
+    def get_samples(self):
+        return onu_signal.unpack_samples(self.samples)
+
+    def __str__(self):
+        return "%s: %s" % (self.device_id, self.day)
+
+    class Meta:
+        db_table = 'dev_onu_signal'
+        unique_together = ('device', 'day')
+        ordering = ('day',)
@@ -0,0 +1,84 @@
+"""
+Packed samples of ONU optical signal for devapp.models.OnuSignalBlock.
+
+Samples of one ONU for one day are kept in one binary block of
+fixed-width records, so poll of many ONUs appends few bytes for each
+ONU instead of new row. Record is second of day, signal in hundredths
+of dBm, distance in meters and raw status of ONU from OLT.
+"""
+from struct import Struct
+from typing import Optional, NamedTuple, Iterable, List
+
+# second of day, signal * 100, distance, status
+_RECORD = Struct('<IhHB')
+RECORD_SIZE = _RECORD.size
+
+# Values that mean 'not known' in record
+_NO_SIGNAL = -0x8000
+_NO_DISTANCE = 0xffff
+_NO_STATUS = 0xff
+
+
+class OnuSample(NamedTuple):
+    sec: int
+    signal: Optional[float]
+    distance: Optional[float]
+    status: Optional[int]
+
+
+def _clamp(v: int, low: int, high: int) -> int:
+    return max(low, min(high, v))
+
+
+def pack_sample(sample: OnuSample) -> bytes:
+    signal, distance, status = sample.signal, sample.distance, sample.status
+    return _RECORD.pack(
+        _clamp(int(sample.sec), 0, 86399),
+        _NO_SIGNAL if signal is None else _clamp(round(signal * 100), _NO_SIGNAL + 1, 0x7fff),
+        _NO_DISTANCE if distance is None else _clamp(round(distance), 0, _NO_DISTANCE - 1),
+        _NO_STATUS if status is None else _clamp(int(status), 0, _NO_STATUS - 1)
+    )
+
+
+def pack_samples(samples: Iterable[OnuSample]) -> bytes:
+    return b''.join(pack_sample(s) for s in samples)
+
+
+def unpack_samples(data: bytes) -> List[OnuSample]:
+    # tail of broken write is dropped
+    data = bytes(data[:len(data) - len(data) % RECORD_SIZE])
+    return [OnuSample(
+        sec=sec,
+        signal=None if signal == _NO_SIGNAL else signal / 100,
+        distance=None if distance == _NO_DISTANCE else float(distance),
+        status=None if status == _NO_STATUS else status
+    ) for sec, signal, distance, status in _RECORD.iter_unpack(data)]
+
+
+def _avg(values: List[float]) -> Optional[float]:
+    return sum(values) / len(values) if values else None
+
+
+def downsample(samples: Iterable[OnuSample], step: int) -> List[OnuSample]:
+    """
+    One sample for each *step* seconds, signal and distance are
+    averaged, status is the last one in interval
+    """
+    buckets = {}
+    for s in samples:
+        buckets.setdefault(s.sec - s.sec % step, []).append(s)
+    res = []
+    for sec in sorted(buckets.keys()):
+        bucket = buckets[sec]
+        res.append(OnuSample(
+            sec=sec,
+            signal=_avg([s.signal for s in bucket if s.signal is not None]),
+            distance=_avg([s.distance for s in bucket if s.distance is not None]),
+            status=bucket[-1].status
+        ))
+    return res
+
+
+def average_signal(samples: Iterable[OnuSample]) -> Optional[float]:
+    return _avg([s.signal for s in samples if s.signal is not None])
+
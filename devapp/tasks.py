@@ -1,27 +1,99 @@
-from typing import Iterable
+import os
+from hashlib import sha256
+from tempfile import NamedTemporaryFile
+from typing import Iterable, Optional
 from subprocess import run
 from celery import shared_task
+from django.conf import settings
+from django.core.cache import cache
+from kombu.exceptions import OperationalError
 from devapp.models import Device
 
+MACS_CONF_PATH = getattr(settings, 'DHCP_MACS_CONF_PATH', '/etc/dhcp/macs.conf')
+
+# Seconds while registrations of devices are collected into one rebuild
+ONU_REGISTER_DELAY = getattr(settings, 'ONU_REGISTER_DELAY', 3)
+
+_ONU_REGISTER_KEY = 'onu_register_scheduled'
+
+
+def render_macs_conf(devices: Iterable[Device]) -> str:
+    """
+    Make dhcpd subclasses of devices that may be attached to subscribers
+    :param devices: devices with selected group
+    """
+    lines = []
+    for dev in devices:
+        if dev.mac_addr is None or dev.group is None:
+            continue
+        group_code = dev.group.code
+        if not group_code:
+            continue
+        try:
+            mn = dev.get_manager_klass()
+        except TypeError:
+            continue
+        if not mn.has_attachable_to_subscriber:
+            continue
+        lines.append('subclass "%(group_code)s.%(dev_code)s" "%(mac)s";\n' % {
+            'group_code': group_code,
+            'mac': dev.mac_addr,
+            'dev_code': mn.tech_code
+        })
+    return ''.join(lines)
+
+
+def write_if_changed(path: str, content: str) -> bool:
+    """
+    Replace file atomically when its content is differ
+    :return: True if file was changed
+    """
+    data = content.encode('utf-8')
+    try:
+        with open(path, 'rb') as f:
+            if sha256(f.read()).digest() == sha256(data).digest():
+                return False
+    except FileNotFoundError:
+        pass
+    # temp file in the same dir, so rename is atomic
+    with NamedTemporaryFile('wb', dir=os.path.dirname(path) or '.',
+                            prefix='.macs', delete=False) as f:
+        f.write(data)
+        tmp_name = f.name
+    try:
+        os.chmod(tmp_name, 0o644)
+        os.replace(tmp_name, path)
+    except OSError:
+        os.unlink(tmp_name)
+        raise
+    return True
+
 
 @shared_task
-def onu_register(device_ids: Iterable[int]):
-    with open('/etc/dhcp/macs.conf', 'w') as f:
-        for dev_id in device_ids:
-            dev = Device.objects.get(pk=dev_id)
-            if not dev.has_attachable_to_subscriber() or dev.mac_addr is None:
-                continue
-            group_code = dev.group.code
-            if not group_code:
-                continue
-            try:
-                mn = dev.get_manager_klass()
-                dev_code = mn.tech_code
-                f.write('subclass "%(group_code)s.%(dev_code)s" "%(mac)s";\n' % {
-                    'group_code': group_code,
-                    'mac': dev.mac_addr,
-                    'dev_code': dev_code
-                })
-            except TypeError:
-                continue
-    run(('/usr/bin/sudo', 'systemctl', 'restart', 'isc-dhcp-server.service'))
+def onu_register(device_ids: Optional[Iterable[int]] = None):
+    # next registration makes new rebuild
+    cache.delete(_ONU_REGISTER_KEY)
+    devices = Device.objects.exclude(group=None).select_related('group').only(
+        'pk', 'mac_addr', 'devtype', 'group', 'group__code'
+    ).order_by('pk')
+    if device_ids is not None:
+        devices = devices.filter(pk__in=tuple(device_ids))
+    if write_if_changed(MACS_CONF_PATH, render_macs_conf(devices.iterator())):
+        # dhcpd can not reload config, only restart
+        run(('/usr/bin/sudo', 'systemctl', 'restart', 'isc-dhcp-server.service'))
+        return 'macs.conf changed'
+    return 'macs.conf not changed'
+
+
+def schedule_onu_register():
+    """
+    Rebuild macs.conf from all devices a bit later, many
+    calls in ONU_REGISTER_DELAY make only one rebuild
+    """
+    if not cache.add(_ONU_REGISTER_KEY, 1, ONU_REGISTER_DELAY + 60):
+        return
+    try:
+        onu_register.apply_async(countdown=ONU_REGISTER_DELAY)
+    except OperationalError:
+        cache.delete(_ONU_REGISTER_KEY)
+        raise
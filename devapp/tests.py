@@ -1,9 +1,21 @@
+import os
 from hashlib import sha256
+from collections import namedtuple
+from datetime import datetime, timedelta
+from tempfile import TemporaryDirectory
+from unittest import mock
 from django.shortcuts import resolve_url
 from django.test import TestCase, RequestFactory, override_settings
+from django.utils import timezone
 
 from accounts_app.models import UserProfile
-from devapp.models import Device
+from devapp.base_intr import (
+    SNMPBaseWorker, DeviceImplementationError, sorted_indexes, toggle_ports
+)
+from devapp.dev_types import EltexPort, OLTDevice, Olt_ZTE_C320, ZteOnuDevice
+from devapp.models import Device, PortState, OnuSignalBlock
+from devapp.onu_signal import OnuSample, pack_samples, unpack_samples, downsample
+from devapp.tasks import render_macs_conf, write_if_changed
 from group_app.models import Group
 
 rf = RequestFactory()
@@ -52,3 +64,278 @@ class DevTest(TestCase):
             'sign': sign
         })
         self.assertEqual(r.status_code, 200)
+
+
+class MacsConfTest(TestCase):
+    def setUp(self):
+        grp = Group.objects.create(title='Grp1', code='grp')
+        Device.objects.create(
+            mac_addr='78:81:f2:1f:d2:a9', comment='Switch',
+            devtype='Dl', group=grp
+        )
+        Device.objects.create(
+            mac_addr='78:81:f2:1f:d2:aa', comment='Olt',
+            devtype='Pn', group=grp
+        )
+
+    def test_render(self):
+        conf = render_macs_conf(Device.objects.select_related('group').order_by('pk'))
+        self.assertEqual(conf, 'subclass "grp.dlink_sw" "78:81:f2:1f:d2:a9";\n')
+
+    def test_write_if_changed(self):
+        with TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'macs.conf')
+            self.assertTrue(write_if_changed(path, 'a;\n'))
+            self.assertFalse(write_if_changed(path, 'a;\n'))
+            self.assertTrue(write_if_changed(path, 'b;\n'))
+            with open(path) as f:
+                self.assertEqual(f.read(), 'b;\n')
+            self.assertEqual(os.listdir(tmp_dir), ['macs.conf'])
+
+
+FakeVar = namedtuple('FakeVar', ('oid', 'oid_index', 'value', 'snmp_type'))
+
+
+class FakeSnmpSession(object):
+    """Answers GETBULK from sorted dict of numeric oid -> value"""
+    use_numeric = False
+
+    def __init__(self, data: dict):
+        self.data = sorted(data.items(), key=lambda i: tuple(int(n) for n in i[0].split('.')))
+        self.pdu_count = 0
+
+    def _next(self, oid: str):
+        key = tuple(int(n) for n in oid.strip('.').split('.'))
+        for o, v in self.data:
+            if tuple(int(n) for n in o.split('.')) > key:
+                base, index = o.rsplit('.', 1)
+                return FakeVar('.' + base, index, v, 'OCTETSTR')
+        return FakeVar(oid, '', 'ENDOFMIBVIEW', 'ENDOFMIBVIEW')
+
+    def set(self, oid, value, snmp_type):
+        self.pdu_count += 1
+        self.data = [(o, str(value) if o == oid.strip('.') else v) for o, v in self.data]
+        return True
+
+    def get_bulk(self, oids, non_repeaters=0, max_repetitions=10):
+        self.pdu_count += 1
+        res = []
+        cursors = list(oids)
+        for _ in range(max_repetitions):
+            for i, oid in enumerate(cursors):
+                v = self._next(oid)
+                res.append(v)
+                cursors[i] = '%s.%s' % (v.oid, v.oid_index) if v.oid_index else v.oid
+        return res
+
+
+class FakeSnmpWorker(SNMPBaseWorker):
+    def __init__(self, data: dict):
+        super(FakeSnmpWorker, self).__init__('127.0.0.1')
+        self.ses = FakeSnmpSession(data)
+        self.invalidate_snmp_cache()
+
+
+class SnmpTableTest(TestCase):
+    def test_get_table(self):
+        data = {}
+        for n in range(1, 31):
+            data['1.3.6.1.2.1.2.2.1.2.%d' % n] = 'port%d' % n
+            data['1.3.6.1.2.1.2.2.1.8.%d' % n] = '1'
+        data['1.3.6.1.2.1.2.2.1.9.1'] = 'next column'
+        worker = FakeSnmpWorker(data)
+        rows = worker.get_table({
+            'name': '.1.3.6.1.2.1.2.2.1.2',
+            'status': '.1.3.6.1.2.1.2.2.1.8'
+        }, max_repetitions=10)
+        self.assertEqual(len(rows), 30)
+        self.assertEqual(rows['12'], {'name': 'port12', 'status': '1'})
+        self.assertEqual(sorted_indexes(rows)[:3], ['1', '2', '3'])
+        # 30 rows by 10 in pdu, and one more to find end of columns
+        self.assertEqual(worker.ses.pdu_count, 4)
+        self.assertFalse(worker.ses.use_numeric)
+
+    def test_table_cache(self):
+        data = {'1.3.6.1.2.1.2.2.1.7.%d' % n: '1' for n in range(1, 5)}
+        worker = FakeSnmpWorker(data)
+        columns = {'status': '.1.3.6.1.2.1.2.2.1.7'}
+        worker.get_table(columns)
+        pdu_count = worker.ses.pdu_count
+        self.assertEqual(worker.get_table(columns)['2'], {'status': '1'})
+        self.assertEqual(worker.ses.pdu_count, pdu_count)
+        # set drops cached tables of device
+        worker.set_int_value('.1.3.6.1.2.1.2.2.1.7.2', 2)
+        self.assertEqual(worker.get_table(columns)['2'], {'status': '2'})
+
+    def test_register_onu_drops_olt_cache(self):
+        grp = Group.objects.create(title='Grp1')
+        olt = Device.objects.create(
+            ip_address='127.0.0.1', mac_addr='78:81:f2:1f:d2:ac',
+            comment='Olt', devtype='Zt', man_passw='public', group=grp
+        )
+        onu = Device.objects.create(
+            mac_addr='78:81:f2:1f:d2:ad', comment='Onu', devtype='Zo',
+            snmp_extra='268501760.5', parent_dev=olt, group=grp
+        )
+        worker = FakeSnmpWorker({'1.3.6.1.2.1.2.2.1.7.1': '1'})
+        columns = {'status': '.1.3.6.1.2.1.2.2.1.7'}
+        worker.get_table(columns)
+        worker.ses.data = [('1.3.6.1.2.1.2.2.1.7.1', '2')]
+        self.assertEqual(worker.get_table(columns)['1'], {'status': '1'})
+        with mock.patch.object(ZteOnuDevice, 'register_device') as register:
+            onu.register_device()
+        register.assert_called_once_with(onu.extra_data)
+        self.assertEqual(worker.get_table(columns)['1'], {'status': '2'})
+
+
+class PortStateTest(TestCase):
+    def setUp(self):
+        grp = Group.objects.create(title='Grp1')
+        self.dev = Device.objects.create(
+            ip_address='192.168.0.101', mac_addr='78:81:f2:1f:d2:ab',
+            comment='Switch', devtype='Dl', man_passw='public', group=grp
+        )
+
+    def test_store(self):
+        worker = FakeSnmpWorker({})
+        now = timezone.now()
+        ports = (
+            EltexPort(worker, num=1, name='p1', status='1', mac='', speed=100),
+            EltexPort(worker, num=2, name='p2', status='2', mac='', speed=0),
+        )
+        states = tuple(PortState.from_port(self.dev.pk, p, now) for p in ports)
+        self.assertEqual(PortState.objects.store({self.dev.pk: states}), 2)
+        # next cycle replaces state
+        self.assertEqual(PortState.objects.store({self.dev.pk: states[1:]}), 1)
+        down = PortState.objects.get(device=self.dev)
+        self.assertEqual(down.num, 2)
+        self.assertFalse(down.st)
+        self.assertEqual(down.nm, 'p2')
+
+
+class FakeSwitch(FakeSnmpWorker):
+    def port_toggle(self, snmp_num: int, enable: bool):
+        if snmp_num > 4:
+            raise DeviceImplementationError('no port %d' % snmp_num)
+        self.set_int_value('.1.3.6.1.2.1.2.2.1.7.%d' % snmp_num, 1 if enable else 2)
+
+
+class TogglePortsTest(TestCase):
+    def test_toggle_many(self):
+        data = {'1.3.6.1.2.1.2.2.1.7.%d' % n: '1' for n in range(1, 5)}
+        sw1, sw2 = FakeSwitch(dict(data)), FakeSwitch(dict(data))
+        results = toggle_ports((
+            (sw1, 1, False), (sw2, 2, False), (sw1, 5, False), (sw1, 3, True)
+        ))
+        self.assertIsNone(results[0])
+        self.assertIsNone(results[1])
+        self.assertIsInstance(results[2], DeviceImplementationError)
+        self.assertIsNone(results[3])
+        self.assertEqual(dict(sw1.ses.data)['1.3.6.1.2.1.2.2.1.7.1'], '2')
+        self.assertEqual(dict(sw2.ses.data)['1.3.6.1.2.1.2.2.1.7.2'], '2')
+        # one pdu for each port, without reading of ports
+        self.assertEqual(sw1.ses.pdu_count, 2)
+
+
+class OnuSignalTest(TestCase):
+    def setUp(self):
+        grp = Group.objects.create(title='Grp1')
+        self.olt = Device.objects.create(
+            ip_address='192.168.0.102', mac_addr='78:81:f2:1f:d2:ac',
+            comment='Olt', devtype='Zt', man_passw='public', group=grp
+        )
+        self.onu = Device.objects.create(
+            mac_addr='78:81:f2:1f:d2:ad', comment='Onu', devtype='Zo',
+            snmp_extra='268501760.5', parent_dev=self.olt, group=grp
+        )
+
+    def test_pack(self):
+        samples = [
+            OnuSample(60, -21.5, 1200.0, 1),
+            OnuSample(120, None, None, None),
+            OnuSample(3700, -25.0, 1200.0, 2),
+        ]
+        data = pack_samples(samples)
+        self.assertEqual(len(data), 27)
+        self.assertEqual(unpack_samples(data), samples)
+        # broken tail is dropped
+        self.assertEqual(unpack_samples(data + b'\x01'), samples)
+        hourly = downsample(samples, 3600)
+        self.assertEqual(hourly, [
+            OnuSample(0, -21.5, 1200.0, None),
+            OnuSample(3600, -25.0, 1200.0, 2),
+        ])
+
+    def test_zte_signals(self):
+        base = '1.3.6.1.4.1.3902.1012.3.50.12.1.1'
+        worker = FakeSnmpWorker({
+            base + '.1.268501760.5.1': '1',
+            base + '.1.268501760.6.1': '2',
+            base + '.10.268501760.5.1': '5000',
+            base + '.10.268501760.6.1': '65535',
+            base + '.18.268501760.5.1': '12000',
+        })
+        signals = Olt_ZTE_C320.get_onu_signals(worker)
+        self.assertEqual(signals, {
+            '268501760.5': (1, -20.0, 1200.0),
+            '268501760.6': (2, None, None),
+        })
+
+    def test_bdcom_poll_state(self):
+        olt = Device.objects.create(
+            ip_address='192.168.0.103', mac_addr='78:81:f2:1f:d2:ae',
+            comment='Bdcom', devtype='Pn', man_passw='public', group=self.olt.group
+        )
+        base = '1.3.6.1.4.1.3320.101.10'
+        mngr = olt.get_manager_object()
+        mngr.ses = FakeSnmpSession({
+            base + '.1.1.79.5': '5',
+            base + '.1.1.26.5': '3',
+            base + '.1.1.3.5': '00:01:02:03:04:05',
+            base + '.1.1.27.5': '120',
+            base + '.5.1.5.5': '-215',
+            '1.3.6.1.2.1.2.2.1.2.5': 'EPON0/1:1',
+        })
+        with mock.patch('devapp.base_intr.SNMP_CACHE_TTL', 0):
+            ports, signals = mngr.poll_state()
+            pdu_count = mngr.ses.pdu_count
+            mngr.get_table(OLTDevice.ONU_COLUMNS)
+        # ports and signals are made from one walk
+        self.assertEqual(mngr.ses.pdu_count, pdu_count * 2)
+        self.assertEqual([p.num for p in ports], [5])
+        self.assertEqual(signals, {'5': (3, -21.5, 12.0)})
+
+    def test_poll_broken_devices(self):
+        from poll_devices import poll_devices
+        unknown = Device.objects.create(
+            ip_address='192.168.0.104', mac_addr='78:81:f2:1f:d2:af',
+            comment='Unknown', devtype='Xx', man_passw='public', group=self.olt.group
+        )
+        with mock.patch.object(Olt_ZTE_C320, 'poll_state', side_effect=ValueError('bad value')):
+            results = poll_devices((unknown, self.olt), workers=2, timeout=10)
+        self.assertEqual(results, {})
+
+    def test_append_and_drops(self):
+        day = datetime(2026, 10, 16)
+        week_ago = day - timedelta(days=7)
+        blocks = OnuSignalBlock.objects
+        first_pk = None
+        for h in range(3):
+            blocks.append({self.onu.pk: (1, -20.0, 1200.0)}, week_ago + timedelta(hours=h))
+            blocks.append({self.onu.pk: (1, -24.5, 1200.0)}, day + timedelta(hours=h))
+            if first_pk is None:
+                first_pk = blocks.get(device=self.onu, day=day.date()).pk
+        self.assertEqual(blocks.count(), 2)
+        # block of day is appended in place
+        self.assertEqual(blocks.get(device=self.onu, day=day.date()).pk, first_pk)
+        history = blocks.history(self.onu.pk, day.date())
+        self.assertEqual(len(history), 3)
+        self.assertEqual(history[1][0], day + timedelta(hours=1))
+        self.assertEqual(history[1][1].signal, -24.5)
+        self.assertEqual(blocks.signal_drops(day.date(), 7, 3), [(self.onu.pk, -20.0, -24.5)])
+        self.assertEqual(blocks.signal_drops(day.date(), 7, 5), [])
+        # older block keeps one sample for day
+        self.assertEqual(blocks.downsample(day.date(), 86400), 1)
+        old = blocks.get(device=self.onu, day=week_ago.date())
+        self.assertEqual(old.step, 86400)
+        self.assertEqual(old.get_samples(), [OnuSample(0, -20.0, 1200.0, 1)])
@@ -7,6 +7,8 @@ urlpatterns = [
     path('', views.GroupsListView.as_view(), name='group_list'),
     path('devices_without_groups/', views.DevicesWithoutGroupsListView.as_view(), name='devices_null_group'),
     path('fix_onu/', views.fix_onu, name='fix_onu'),
+    path('ports_down/', views.PortsDownListView.as_view(), name='ports_down'),
+    path('toggle_ports/', views.toggle_ports_many, name='toggle_ports_many'),
     path('<int:device_id>/reboot/', views.RebootDevice.as_view(), name='reboot'),
     path('<int:group_id>/', views.DevicesListView.as_view(), name='devs'),
     path('<int:group_id>/add/', views.DeviceCreateView.as_view(), name='add'),
@@ -19,6 +21,7 @@ urlpatterns = [
     path('<int:group_id>/<int:device_id>/ports/<int:port_id>/show_subscriber_on_port/', views.ShowSubscriberOnPort.as_view(), name='show_subscriber_on_port'),
     path('<int:group_id>/<int:device_id>/ports_add/', views.add_ports, name='add_ports'),
     path('<int:group_id>/<int:device_id>/register_device/', views.register_device, name='dev_register'),
+    path('<int:group_id>/<int:device_id>/signal_history/', views.onu_signal_history, name='onu_signal_history'),
     re_path('^(\d+)/(?P<device_id>\d+)/(?P<port_id>\d+)_(?P<status>[0-1]{1})$', views.toggle_port, name='port_toggle'),
     path('<int:group_id>/<int:device_id>/<int:port_id>/del/', views.delete_single_port, name='del_port'),
     path('<int:group_id>/<int:device_id>/<int:port_id>/edit/', views.EditSinglePort.as_view(), name='edit_port'),
@@ -30,6 +33,7 @@ urlpatterns = [
 
     # Monitoring api
     path('on_device_event/', views.OnDeviceMonitoringEvent.as_view()),
+    path('api/onu_signal_drops/', views.OnuSignalDropsView.as_view(), name='onu_signal_drops'),
 
     # Nagios mon generate
     path('nagios/hosts/', views.nagios_objects_conf, name='nagios_objects_conf'),
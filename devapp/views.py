@@ -1,4 +1,6 @@
+import json
 import re
+from datetime import timedelta
 from ipaddress import ip_address
 
 from kombu.exceptions import OperationalError
@@ -12,6 +14,7 @@ from django.db import IntegrityError
 from django.db.models import Q, Count
 from django.http import HttpResponse, Http404
 from django.shortcuts import render, redirect, get_object_or_404, resolve_url
+from django.utils import timezone
 from django.utils.decorators import method_decorator
 from django.utils.translation import gettext_lazy as _, gettext
 from django.views.generic import DetailView, DeleteView, UpdateView, CreateView
@@ -29,9 +32,11 @@ from messenger.tasks import multicast_viber_notify
 from guardian.decorators import permission_required_or_403 as permission_required
 from guardian.shortcuts import get_objects_for_user
 from devapp.forms import DeviceForm, PortForm, DeviceExtraDataForm, DeviceRebootForm
-from devapp.models import Device, Port, DeviceDBException, DeviceMonitoringException
-from devapp.tasks import onu_register
-from devapp.base_intr import DeviceImplementationError, DeviceConfigurationError
+from devapp.models import (
+    Device, Port, PortState, OnuSignalBlock, DeviceDBException, DeviceMonitoringException
+)
+from devapp.tasks import schedule_onu_register
+from devapp.base_intr import DeviceImplementationError, DeviceConfigurationError, toggle_ports
 from devapp import expect_scripts
 
 
@@ -92,9 +97,7 @@ class DeviceDeleteView(LoginAdminPermissionMixin, DeleteView):
                 self.object.mac_addr or '-',
                 self.object.comment or '-'
             ))
-            onu_register.delay(
-                tuple(dev.pk for dev in Device.objects.exclude(group=None).only('pk').iterator())
-            )
+            schedule_onu_register()
         except (DeviceDBException, PermissionError, OperationalError) as e:
             messages.error(request, e)
         messages.success(request, _('Device successfully deleted'))
@@ -150,9 +153,7 @@ class DeviceUpdate(LoginAdminPermissionMixin, UpdateView):
         r = super().form_valid(form)
         # change device info in dhcpd.conf
         try:
-            onu_register.delay(
-                tuple(dev.pk for dev in Device.objects.exclude(group=None).only('pk').iterator())
-            )
+            schedule_onu_register()
             messages.success(self.request, _('Device info has been saved'))
         except (PermissionError, OperationalError) as e:
             messages.error(self.request, e)
@@ -224,9 +225,7 @@ class DeviceCreateView(LoginAdminMixin, PermissionRequiredMixin, CreateView):
                     self.object.mac_addr,
                     self.object.comment
                 ))
-            onu_register.delay(
-                tuple(dev.pk for dev in Device.objects.exclude(group=None).only('pk').iterator())
-            )
+            schedule_onu_register()
             messages.success(self.request, _('Device info has been saved'))
         except (PermissionError, OperationalError) as e:
             messages.error(self.request, e)
@@ -479,7 +478,7 @@ def add_single_port(request, group_id, device_id):
 @only_admins
 @permission_required('devapp.view_device')
 def devview(request, group_id: int, device_id: int):
-    ports, manager = None, None
+    ports, manager, ports_updated = None, None, None
     device = get_object_or_404(Device, id=device_id)
 
     if not device.group:
@@ -488,22 +487,39 @@ def devview(request, group_id: int, device_id: int):
 
     template_name = 'generic_switch.html'
     try:
-        if device.ip_address and not ping(str(device.ip_address)):
-            messages.error(request, _('Dot was not pinged'))
         if device.man_passw:
             manager = device.get_manager_object()
-            ports = tuple(manager.get_ports())
-            if ports is not None and len(ports) > 0 and isinstance(ports[0],
-                                                                   Exception):
-                messages.error(request, ports[0])
-                ports = ports[1]
             template_name = manager.get_template_name()
+            if not request.GET.get('refresh'):
+                # state from last poll, see poll_devices.py
+                ports = tuple(PortState.objects.filter(device=device))
+                if ports:
+                    ports_updated = ports[0].updated
+                    # uptime is not read from device too
+                    manager = None
+                else:
+                    ports = None
+            if ports is None:
+                if request.GET.get('refresh'):
+                    manager.invalidate_snmp_cache()
+                if device.ip_address and not ping(str(device.ip_address)):
+                    messages.error(request, _('Dot was not pinged'))
+                ports = tuple(manager.get_ports())
+                if ports is not None and len(ports) > 0 and isinstance(ports[0],
+                                                                       Exception):
+                    messages.error(request, ports[0])
+                    ports = ports[1]
+                now = timezone.now()
+                PortState.objects.store({device.pk: tuple(
+                    PortState.from_port(device.pk, p, now) for p in ports
+                )})
         else:
             messages.warning(request, _('Not Set snmp device password'))
 
         return render(request, 'devapp/custom_dev_page/' + template_name, {
             'dev': device,
             'ports': ports,
+            'ports_updated': ports_updated,
             'dev_accs': Abon.objects.filter(device=device),
             'dev_manager': manager,
             'ports_db': Port.objects.filter(device=device).annotate(
@@ -520,6 +536,16 @@ def devview(request, group_id: int, device_id: int):
     })
 
 
+class PortsDownListView(LoginAdminPermissionMixin,
+                        global_base_views.OrderedFilteredList):
+    context_object_name = 'ports'
+    template_name = 'devapp/ports_down.html'
+    queryset = PortState.objects.filter(status=False).select_related(
+        'device', 'device__group'
+    ).order_by('device__comment', 'num')
+    permission_required = 'devapp.view_device'
+
+
 @login_required
 @only_admins
 def zte_port_view_uncfg(request, group_id: str, device_id: str, fiber_id: str):
@@ -577,27 +603,72 @@ def toggle_port(request, device_id: str, port_id: str, status=0):
     port_id = int(port_id)
     device = get_object_or_404(Device, id=int(device_id))
     try:
-        if ping(device.ip_address):
-            if device.man_passw:
-                manager = device.get_manager_object()
-                ports = tuple(manager.get_ports())
-                if status:
-                    ports[port_id - 1].enable()
-                else:
-                    ports[port_id - 1].disable()
-            else:
-                messages.warning(request, _('Not Set snmp device password'))
+        if device.man_passw:
+            manager = device.get_manager_object()
+            # port_id is snmp number of port
+            manager.port_toggle(port_id, bool(status))
+            PortState.objects.filter(device=device, snmp_num=port_id).update(
+                status=bool(status)
+            )
         else:
-            messages.error(request, _('Dot was not pinged'))
+            messages.warning(request, _('Not Set snmp device password'))
     except EasySNMPTimeoutError:
         messages.error(request, _('wait for a reply from the SNMP Timeout'))
     except EasySNMPError as e:
         messages.error(request, 'EasySNMPError: %s' % e)
+    except DeviceImplementationError as e:
+        messages.error(request, e)
     return redirect('devapp:view',
                     device.group.pk if device.group is not None else 0,
                     device_id)
 
 
+@login_required
+@only_admins
+@permission_required('devapp.can_toggle_ports')
+@json_view
+def toggle_ports_many(request):
+    """
+    Enable or disable many ports on many devices at once.
+    POST json body: {"ports": [{"device": id, "port": snmp number, "enable": false}, ...]}
+    """
+    if request.method != 'POST':
+        return {'status': 'POST required'}
+    try:
+        items = json.loads(request.body.decode('utf-8')).get('ports')
+        items = tuple(
+            (int(i['device']), int(i['port']), bool(i['enable'])) for i in items
+        )
+    except (ValueError, UnicodeDecodeError, AttributeError, KeyError, TypeError):
+        return {'status': '"ports" must be list of {"device", "port", "enable"}'}
+    devices = Device.objects.filter(
+        pk__in={dev_id for dev_id, port, enable in items}
+    ).exclude(man_passw=None).exclude(man_passw='').select_related('parent_dev')
+    managers, errors = {}, {}
+    for dev in devices:
+        try:
+            managers[dev.pk] = dev.get_manager_object()
+        except (DeviceImplementationError, DeviceDBException) as e:
+            errors[dev.pk] = str(e)
+    operations = tuple(
+        (managers[dev_id], port, enable) for dev_id, port, enable in items
+        if dev_id in managers
+    )
+    results = iter(toggle_ports(operations))
+    out = []
+    for dev_id, port, enable in items:
+        if dev_id in managers:
+            err = next(results)
+            if err is None:
+                PortState.objects.filter(device_id=dev_id, snmp_num=port).update(
+                    status=enable
+                )
+            out.append(None if err is None else str(err))
+        else:
+            out.append(errors.get(dev_id, gettext('Device not found or has no snmp password')))
+    return {'status': 'ok', 'results': out}
+
+
 class GroupsListView(LoginAdminMixin, global_base_views.OrderedFilteredList):
     context_object_name = 'groups'
     template_name = 'devapp/group_list.html'
@@ -828,6 +899,55 @@ class DevicesGetListView(global_base_views.SecureApiView):
         return list(res)
 
 
+class OnuSignalDropsView(global_base_views.SecureApiView):
+    """
+    ONUs whose average signal of today is lower than it was days ago,
+    for example api/onu_signal_drops/?days=7&drop=3
+    """
+    http_method_names = ('get',)
+
+    @method_decorator(json_view)
+    def get(self, request, *args, **kwargs):
+        days = safe_int(request.GET.get('days')) or 7
+        try:
+            min_drop = float(request.GET.get('drop', 3))
+        except ValueError:
+            min_drop = 3.0
+        drops = OnuSignalBlock.objects.signal_drops(
+            timezone.now().date(), days, min_drop
+        )
+        devices = Device.objects.filter(pk__in=tuple(d[0] for d in drops)).only(
+            'pk', 'comment', 'mac_addr', 'snmp_extra', 'group_id', 'parent_dev_id'
+        ).in_bulk()
+        return [{
+            'device': dev_id,
+            'comment': devices[dev_id].comment,
+            'mac_addr': str(devices[dev_id].mac_addr or ''),
+            'snmp_extra': devices[dev_id].snmp_extra,
+            'parent_dev': devices[dev_id].parent_dev_id,
+            'group': devices[dev_id].group_id,
+            'signal_before': round(before, 2),
+            'signal_now': round(now, 2)
+        } for dev_id, before, now in drops if dev_id in devices]
+
+
+@login_required
+@only_admins
+@permission_required('devapp.view_device')
+@json_view
+def onu_signal_history(request, group_id: int, device_id: int):
+    """Samples of ONU signal for chart on device page"""
+    days = min(safe_int(request.GET.get('days')) or 1, 366)
+    since_day = timezone.now().date() - timedelta(days=days - 1)
+    history = OnuSignalBlock.objects.history(device_id, since_day)
+    return {
+        'labels': [tm.strftime('%d.%m %H:%M') for tm, s in history],
+        'signal': [s.signal for tm, s in history],
+        'distance': [s.distance for tm, s in history],
+        'status': [s.status for tm, s in history]
+    }
+
+
 @login_required
 @only_admins
 @json_view
@@ -1,13 +1,41 @@
 #!/usr/bin/env python3
+import grp
+import json
+import os
+import socket
 import sys
+from collections import OrderedDict
+from http.client import HTTPConnection, HTTPSConnection, HTTPException
+from time import monotonic
 from urllib.error import HTTPError
-from urllib.parse import urlencode
+from urllib.parse import urlencode, urlsplit
 from urllib.request import urlopen
 from hashlib import sha256
 
 API_AUTH_SECRET = 'yourapikey'
 SERVER_DOMAIN = 'http://localhost:8000'
 
+# Unix datagram socket of running './dhcp_lever.py serve',
+# events are passed there instead of sending them from the hook.
+# dhcp_lever_send.c writes there without start of python
+LEVER_SOCKET = '/run/dhcp_lever.sock'
+
+# Access mode of socket, user of dhcp server must be able to write there
+LEVER_SOCKET_MODE = 0o660
+
+# Group of socket, it is group of dhcp server user, for example 'dhcpd'.
+# It may be given as argument: './dhcp_lever.py serve dhcpd'
+LEVER_SOCKET_GROUP = None
+
+# Seconds while events are collected into one batch
+BATCH_DELAY = 0.3
+
+# Max count of events in one batch
+BATCH_SIZE = 500
+
+# Seconds before next try when billing is not available
+RETRY_DELAY = 5
+
 
 def die(text):
     print(text)
@@ -53,33 +81,184 @@ def send_to(data, server=SERVER_DOMAIN):
         print('ERROR:', e)
 
 
+def parse_event(args):
+    """
+    Event from arguments of hook: action, ip, and for commit
+    mac of client, mac of switch and port of switch
+    :return: dict of event or None when arguments are wrong
+    """
+    if len(args) < 2:
+        return
+    action = args[0]
+    if action == 'commit':
+        if len(args) < 5:
+            return
+        try:
+            switch_port = int(args[4])
+        except ValueError:
+            return
+        return {
+            'client_ip': args[1],
+            'client_mac': args[2],
+            'switch_mac': args[3],
+            'switch_port': switch_port,
+            'cmd': 'commit'
+        }
+    elif action == 'expiry' or action == 'release':
+        return {
+            'client_ip': args[1],
+            'cmd': action
+        }
+
+
+def send_to_daemon(args, sock_path=LEVER_SOCKET) -> bool:
+    """
+    Pass event to running daemon
+    :return: False if daemon is not running
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        sock.sendto(' '.join(args).encode('utf-8'), sock_path)
+        return True
+    except OSError:
+        return False
+    finally:
+        sock.close()
+
+
+class BatchClient(object):
+    """Sends batches of events to billing over one kept alive connection"""
+
+    def __init__(self, server=SERVER_DOMAIN):
+        url = urlsplit(server)
+        self._conn_class = HTTPSConnection if url.scheme == 'https' else HTTPConnection
+        self._netloc = url.netloc
+        self._path = '%s/abons/api/dhcp_lever/' % url.path.rstrip('/')
+        self._conn = None
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def send(self, events) -> bool:
+        """
+        :return: False if batch must be sent again later
+        """
+        body = json.dumps({'events': events}).encode('utf-8')
+        body_hash = calc_hash(body)
+        url = '%s?%s' % (self._path, urlencode({
+            'body_hash': body_hash,
+            'sign': make_sign({'body_hash': body_hash})
+        }))
+        # kept connection may be closed by server, then it is opened again
+        for attempt in range(2):
+            if self._conn is None:
+                self._conn = self._conn_class(self._netloc, timeout=60)
+            try:
+                self._conn.request('POST', url, body, {
+                    'Content-Type': 'application/json'
+                })
+                r = self._conn.getresponse()
+                data = r.read()
+            except (OSError, HTTPException) as e:
+                self.close()
+                if attempt > 0:
+                    print('ERROR:', e)
+                    return False
+                continue
+            if r.status >= 500:
+                print('ERROR:', r.status, data[:200])
+                return False
+            if r.status != 200:
+                # batch would be rejected again, so it is dropped
+                print('ERROR:', r.status, data[:200])
+                return True
+            try:
+                results = json.loads(data.decode('utf-8')).get('results', ())
+            except (ValueError, UnicodeDecodeError, AttributeError):
+                results = ()
+            for event, text in zip(events, results):
+                if text:
+                    print('%s %s: %s' % (event.get('cmd'), event.get('client_ip'), text))
+            return True
+        return False
+
+
+def serve(sock_path=LEVER_SOCKET, server=SERVER_DOMAIN, group=LEVER_SOCKET_GROUP):
+    """
+    Receive events from hook and send them to billing by batches.
+    Only last event for each ip is sent, earlier events are replaced.
+    """
+    if os.path.exists(sock_path):
+        os.unlink(sock_path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.bind(sock_path)
+    if group is not None:
+        os.chown(sock_path, -1, grp.getgrnam(group).gr_gid)
+    os.chmod(sock_path, LEVER_SOCKET_MODE)
+    client = BatchClient(server)
+    pending = OrderedDict()
+    send_time = None
+    try:
+        while True:
+            if send_time is None:
+                sock.settimeout(None)
+            else:
+                # zero timeout would make socket non blocking
+                sock.settimeout(max(send_time - monotonic(), 0.001))
+            try:
+                data = sock.recv(4096)
+                event = parse_event(data.decode('utf-8', 'replace').split())
+                if event is None:
+                    print('ERROR: bad event', data[:200])
+                else:
+                    pending.pop(event['client_ip'], None)
+                    pending[event['client_ip']] = event
+                    if send_time is None:
+                        send_time = monotonic() + BATCH_DELAY
+            except (socket.timeout, BlockingIOError):
+                pass
+            if not pending or (len(pending) < BATCH_SIZE and monotonic() < send_time):
+                continue
+            batch = list(pending.values())[:BATCH_SIZE]
+            if client.send(batch):
+                for event in batch:
+                    # event may be replaced by newer one while sending
+                    if pending.get(event['client_ip']) is event:
+                        del pending[event['client_ip']]
+                send_time = monotonic() + BATCH_DELAY if pending else None
+            else:
+                send_time = monotonic() + RETRY_DELAY
+    finally:
+        client.close()
+        sock.close()
+        os.unlink(sock_path)
+
+
 if __name__ == "__main__":
     argv = sys.argv
+    if len(argv) in (2, 3) and argv[1] == 'serve':
+        if API_AUTH_SECRET == 'your api key':
+            raise NotImplementedError('You must specified secret api key')
+        try:
+            serve(group=argv[2] if len(argv) == 3 else LEVER_SOCKET_GROUP)
+        except KeyboardInterrupt:
+            pass
+        exit(0)
     if len(argv) < 3:
         die(
             'Too few arguments, exiting...\n'
             'Usage:\n'
             'COMMIT: ./dhcp_lever.py commit 192.168.1.100 ff:12:c5:9f:12:56 98:45:28:85:25:1a 3\n'
-            'EXPIRY or RELEASE: ./dhcp_lever.py [release |commit]'
+            'EXPIRY or RELEASE: ./dhcp_lever.py [release |commit]\n'
+            'Send events by batches: ./dhcp_lever.py serve [socket group]'
         )
     if API_AUTH_SECRET == 'your api key':
         raise NotImplementedError('You must specified secret api key')
 
-    action = argv[1]
-    if action == 'commit':
-        if len(argv) < 6:
-            die('Too few arguments, exiting...')
-        dat = {
-            'client_ip': argv[2],
-            'client_mac': argv[3],
-            'switch_mac': argv[4],
-            'switch_port': int(argv[5]),
-            'cmd': 'commit'
-        }
-        send_to(dat)
-    elif action == 'expiry' or action == 'release':
-        dat = {
-            'client_ip': argv[2],
-            'cmd': action
-        }
+    dat = parse_event(argv[1:])
+    if dat is None:
+        die('Too few arguments, exiting...')
+    if not send_to_daemon(argv[1:]):
         send_to(dat)
@@ -0,0 +1,66 @@
+/*
+ * Hook of ISC-DHCP server for './dhcp_lever.py serve'.
+ * It writes arguments of event as one datagram to socket of running
+ * daemon, so dhcp server does not start python for each event.
+ * When daemon is not running, dhcp_lever.py is executed with the same
+ * arguments and it sends event to billing by itself.
+ *
+ * Build:
+ *   cc -O2 -o /usr/local/bin/dhcp_lever_send dhcp_lever_send.c
+ * Other paths may be given by -DLEVER_SOCKET=... and -DLEVER_SCRIPT=...
+ *
+ * Usage is the same as of dhcp_lever.py:
+ *   dhcp_lever_send commit 192.168.1.100 ff:12:c5:9f:12:56 98:45:28:85:25:1a 3
+ *   dhcp_lever_send expiry 192.168.1.100
+ */
+#include <string.h>
+#include <sys/socket.h>
+#include <sys/un.h>
+#include <unistd.h>
+
+#ifndef LEVER_SOCKET
+#define LEVER_SOCKET "/run/dhcp_lever.sock"
+#endif
+
+#ifndef LEVER_SCRIPT
+#define LEVER_SCRIPT "/var/www/djing/dhcp_lever.py"
+#endif
+
+/* daemon reads datagrams by 4096 bytes */
+#define MAX_EVENT_SIZE 4096
+
+int main(int argc, char *argv[])
+{
+    char event[MAX_EVENT_SIZE];
+    size_t len = 0;
+    struct sockaddr_un addr;
+    int i, sock, sent = -1;
+
+    if (argc < 3)
+        return 1;
+    for (i = 1; i < argc; i++) {
+        size_t arg_len = strlen(argv[i]);
+        if (len + arg_len + 1 > sizeof(event))
+            return 1;
+        if (len > 0)
+            event[len++] = ' ';
+        memcpy(event + len, argv[i], arg_len);
+        len += arg_len;
+    }
+
+    memset(&addr, 0, sizeof(addr));
+    addr.sun_family = AF_UNIX;
+    strncpy(addr.sun_path, LEVER_SOCKET, sizeof(addr.sun_path) - 1);
+    sock = socket(AF_UNIX, SOCK_DGRAM, 0);
+    if (sock >= 0) {
+        sent = sendto(sock, event, len, 0, (struct sockaddr *) &addr, sizeof(addr));
+        close(sock);
+    }
+    if (sent == (int) len)
+        return 0;
+
+    /* daemon is not running */
+    argv[0] = LEVER_SCRIPT;
+    execv(LEVER_SCRIPT, argv);
+    return 2;
+}
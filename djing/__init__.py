@@ -1,5 +1,4 @@
 import importlib
-import os
 import re
 import typing as t
 from urllib.parse import unquote
@@ -54,10 +53,41 @@ VERSION = __version__  # synonym
 default_app_config = 'abonapp.apps.AbonappConfig'
 
 
+_ping_cache = None
+
+
+def _get_ping_cache():
+    global _ping_cache
+    if _ping_cache is None:
+        from django.conf import settings
+        from djing.lib.icmp import ReachabilityCache
+        # Result of ping is used again for this count of seconds
+        _ping_cache = ReachabilityCache(getattr(settings, 'PING_CACHE_TTL', 5))
+    return _ping_cache
+
+
+def ping_many(hosts: t.Iterable[str], count=1, timeout=1.0) -> dict:
+    """
+    Ping many hosts concurrently
+    :return: dict of host -> djing.lib.icmp.PingResult, with rtt and loss
+    """
+    from djing.lib.icmp import probe
+    hosts = tuple(str(h) for h in hosts if h and re.match(IP_ADDR_REGEX, str(h)))
+    res = probe(hosts, count=count, timeout=timeout)
+    cache = _get_ping_cache()
+    for host, r in res.items():
+        cache.set(host, r.is_alive)
+    return res
+
+
 def ping(ip_addr: str, count=1):
+    ip_addr = str(ip_addr)
     if re.match(IP_ADDR_REGEX, ip_addr):
-        response = os.system("`which ping` -4Anq -c%d -W1 %s > /dev/null" % (count, ip_addr))
-        return True if response == 0 else False
+        is_alive = _get_ping_cache().get(ip_addr)
+        if is_alive is None:
+            r = ping_many((ip_addr,), count=count)
+            is_alive = r[ip_addr].is_alive
+        return is_alive
     else:
         return False
 
@@ -53,19 +53,28 @@ class LazyInitMetaclass(type):
             def wrapped(self, *args, **kwargs):
                 if not self._is_initialized:
                     self._lazy_init(*self._args, **self._kwargs)
+                    self._is_initialized = True
                 return fn(self, *args, **kwargs)
 
             return wrapped
 
+        # Methods that must not initialize object, for example methods
+        # which may be called from another thread
+        skip_methods = attrs.get('lazy_skip_methods', ())
+
         # Apply decorator to all public class methods
-        new_attrs = {k: _lazy_call_decorator(v) for k, v in attrs.items() if not k.startswith('__') and not k.endswith('__') and callable(v)}
+        # static and class methods are callable since python 3.10, skip them
+        new_attrs = {k: _lazy_call_decorator(v) for k, v in attrs.items() if not k.startswith('__') and not k.endswith('__') and callable(v) and not isinstance(v, (staticmethod, classmethod)) and k not in skip_methods}
         if new_attrs:
             attrs.update(new_attrs)
         attrs['_is_initialized'] = False
 
         new_class = new_class_new(mcs, name, bases, attrs)
 
-        real_init = getattr(new_class, '__init__')
+        # __init__ of lazy parent class is already replaced
+        real_init = new_class.__dict__.get('__init__') or getattr(
+            new_class, '_lazy_init', new_class.__init__
+        )
 
         def _lazy_init(self, *args, **kwargs):
             self._args = args
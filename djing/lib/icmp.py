@@ -0,0 +1,209 @@
+import os
+import re
+import select
+import socket
+import struct
+import subprocess
+from threading import Lock
+from time import monotonic
+from typing import Iterable, Dict, Optional, Tuple
+
+ICMP_ECHO_REQUEST = 8
+ICMP_ECHO_REPLY = 0
+
+
+class PingResult(object):
+    __slots__ = ('host', 'sent', 'received', 'rtt_min', 'rtt_avg', 'rtt_max')
+
+    def __init__(self, host: str, sent=0, received=0, rtt_min=None,
+                 rtt_avg=None, rtt_max=None):
+        self.host = host
+        self.sent = sent
+        self.received = received
+        # round trip times in milliseconds
+        self.rtt_min = rtt_min
+        self.rtt_avg = rtt_avg
+        self.rtt_max = rtt_max
+
+    @property
+    def loss(self) -> float:
+        """Part of lost packets, from 0.0 to 1.0"""
+        if self.sent == 0:
+            return 1.0
+        return (self.sent - self.received) / self.sent
+
+    @property
+    def is_alive(self) -> bool:
+        return self.received > 0
+
+    def __bool__(self):
+        return self.is_alive
+
+    def __repr__(self):
+        return '%s: %d/%d received, rtt avg %s ms' % (
+            self.host, self.received, self.sent,
+            '-' if self.rtt_avg is None else '%.3f' % self.rtt_avg
+        )
+
+
+def _checksum(data: bytes) -> int:
+    if len(data) % 2:
+        data += b'\x00'
+    s = sum(struct.unpack('!%dH' % (len(data) // 2), data))
+    s = (s >> 16) + (s & 0xffff)
+    s += s >> 16
+    return ~s & 0xffff
+
+
+def _make_echo_request(ident: int, seq: int) -> bytes:
+    payload = b'djing-ping-' + struct.pack('!d', monotonic())
+    header = struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, 0, ident, seq)
+    chk = _checksum(header + payload)
+    return struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, chk, ident, seq) + payload
+
+
+def _open_icmp_socket() -> Optional[socket.socket]:
+    """
+    Unprivileged icmp socket, it is allowed for groups
+    from sysctl net.ipv4.ping_group_range
+    """
+    try:
+        sk = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
+                           socket.IPPROTO_ICMP)
+    except (OSError, AttributeError):
+        return
+    sk.setblocking(False)
+    return sk
+
+
+def _probe_socket(sk: socket.socket, hosts: Tuple[str, ...], count: int,
+                  timeout: float) -> Dict[str, PingResult]:
+    # kernel sets identifier of request for datagram icmp sockets
+    # itself, so replies are matched by address and sequence number
+    rtts = {h: [] for h in hosts}
+    sent_counts = dict.fromkeys(hosts, 0)
+    seq_base = os.getpid() & 0xff00
+    for attempt in range(count):
+        seq = (seq_base + attempt) & 0xffff
+        send_times = {}
+        for host in hosts:
+            try:
+                sk.sendto(_make_echo_request(0, seq), (host, 0))
+            except OSError:
+                continue
+            send_times[host] = monotonic()
+            sent_counts[host] += 1
+        deadline = monotonic() + timeout
+        while send_times:
+            left = deadline - monotonic()
+            if left <= 0:
+                break
+            r, _, _ = select.select((sk,), (), (), left)
+            if not r:
+                break
+            try:
+                data, (addr, _) = sk.recvfrom(2048)
+            except (BlockingIOError, InterruptedError):
+                continue
+            if len(data) < 8:
+                continue
+            icmp_type, _, _, _, reply_seq = struct.unpack('!BBHHH', data[:8])
+            if icmp_type != ICMP_ECHO_REPLY or reply_seq != seq:
+                continue
+            send_time = send_times.pop(addr, None)
+            if send_time is not None:
+                rtts[addr].append((monotonic() - send_time) * 1000)
+    return {h: _make_result(h, sent_counts[h], rtts[h]) for h in hosts}
+
+
+def _make_result(host: str, sent: int, rtts: list) -> PingResult:
+    if not rtts:
+        return PingResult(host, sent=sent)
+    return PingResult(
+        host, sent=sent, received=len(rtts),
+        rtt_min=min(rtts), rtt_avg=sum(rtts) / len(rtts), rtt_max=max(rtts)
+    )
+
+
+_ping_stat_regexp = re.compile(r'(\d+) packets transmitted, (\d+) (?:packets )?received')
+_ping_rtt_regexp = re.compile(r'= ([\d.]+)/([\d.]+)/([\d.]+)')
+
+
+def _probe_subprocess(hosts: Tuple[str, ...], count: int,
+                      timeout: float) -> Dict[str, PingResult]:
+    """All ping processes are started at once and then are waited"""
+    procs = {}
+    for host in hosts:
+        try:
+            procs[host] = subprocess.Popen(
+                ('ping', '-4nq', '-c%d' % count, '-W%d' % max(int(timeout), 1), host),
+                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+            )
+        except OSError:
+            procs[host] = None
+    res = {}
+    for host, proc in procs.items():
+        if proc is None:
+            res[host] = PingResult(host)
+            continue
+        out = proc.communicate()[0].decode('utf-8', 'replace')
+        stat = _ping_stat_regexp.search(out)
+        if stat is None:
+            res[host] = PingResult(host, sent=count)
+            continue
+        rtt = _ping_rtt_regexp.search(out)
+        res[host] = PingResult(
+            host, sent=int(stat.group(1)), received=int(stat.group(2)),
+            rtt_min=float(rtt.group(1)) if rtt else None,
+            rtt_avg=float(rtt.group(2)) if rtt else None,
+            rtt_max=float(rtt.group(3)) if rtt else None
+        )
+    return res
+
+
+def probe(hosts: Iterable[str], count=1, timeout=1.0) -> Dict[str, PingResult]:
+    """
+    Ping many hosts at the same time
+    :param hosts: ipv4 addresses in text view
+    :param count: count of echo requests to each host
+    :param timeout: time in seconds to wait reply for each request
+    :return: dict of host -> PingResult
+    """
+    hosts = tuple(set(hosts))
+    if not hosts:
+        return {}
+    sk = _open_icmp_socket()
+    if sk is None:
+        return _probe_subprocess(hosts, count, timeout)
+    try:
+        return _probe_socket(sk, hosts, count, timeout)
+    finally:
+        sk.close()
+
+
+class ReachabilityCache(object):
+    """Remembers results of ping for *ttl* seconds"""
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._results = {}
+        self._lock = Lock()
+
+    def get(self, host: str) -> Optional[bool]:
+        with self._lock:
+            r = self._results.get(host)
+            if r is None:
+                return
+            expire_time, is_alive = r
+            if expire_time < monotonic():
+                del self._results[host]
+                return
+            return is_alive
+
+    def set(self, host: str, is_alive: bool):
+        with self._lock:
+            self._results[host] = (monotonic() + self.ttl, is_alive)
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand, CommandError
+from gw_app.models import NASModel
+from gw_app.nas_managers import MikrotikPcqTransmitter, NasFailedResult, NasNetworkError
+
+
+class Command(BaseCommand):
+    help = 'Move subscribers of Mikrotik gateway from simple queues to PCQ for each speed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('nas_id', type=int, help='Id of gateway')
+
+    def handle(self, *args, **options):
+        try:
+            nas = NASModel.objects.get(pk=options['nas_id'])
+        except NASModel.DoesNotExist:
+            raise CommandError('Gateway with id %d does not exist' % options['nas_id'])
+        if nas.nas_type != 'mktk':
+            raise CommandError('Gateway "%s" does not use simple queues' % nas)
+        try:
+            mngr = MikrotikPcqTransmitter(
+                login=nas.auth_login,
+                password=nas.auth_passw,
+                ip=nas.ip_address,
+                port=int(nas.ip_port),
+                enabled=bool(nas.enabled)
+            )
+            stats = mngr.convert_from_simple_queues()
+        except (NasNetworkError, NasFailedResult, ConnectionResetError) as e:
+            raise CommandError(e)
+        if stats.errors:
+            raise CommandError(
+                'Gateway "%s" is not converted, simple queues are left: %s' % (nas, stats)
+            )
+        nas.nas_type = 'mkpq'
+        nas.save(update_fields=('nas_type',))
+        self.stdout.write(self.style.SUCCESS('Gateway "%s" converted: %s' % (nas, stats)))
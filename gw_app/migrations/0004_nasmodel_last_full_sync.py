@@ -0,0 +1,18 @@
+# Generated by Django 2.1 on 2026-10-16 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gw_app', '0003_nasmodel_enabled'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='nasmodel',
+            name='last_full_sync',
+            field=models.DateTimeField(blank=True, editable=False, null=True, verbose_name='Last full sync'),
+        ),
+    ]
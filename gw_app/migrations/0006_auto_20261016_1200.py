@@ -0,0 +1,18 @@
+# Generated by Django 2.1 on 2026-10-16 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gw_app', '0005_auto_20261016_1200'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='nasmodel',
+            name='nas_type',
+            field=models.CharField(choices=[('mktk', 'Mikrotik NAS'), ('mkpq', 'Mikrotik NAS with PCQ for each speed'), ('lnft', 'Linux nftables and tc')], default='mktk', max_length=4, verbose_name='Type'),
+        ),
+    ]
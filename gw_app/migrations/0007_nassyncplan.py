@@ -0,0 +1,28 @@
+# Generated by Django 2.1 on 2026-10-16 12:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+import jsonfield.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gw_app', '0006_auto_20261016_1200'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NasSyncPlan',
+            fields=[
+                ('nas', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='sync_plan', serialize=False, to='gw_app.NASModel')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('operations', jsonfield.fields.JSONField()),
+                ('position', models.PositiveIntegerField(default=0)),
+                ('last_journal_id', models.PositiveIntegerField(blank=True, null=True)),
+            ],
+            options={
+                'db_table': 'nas_sync_plan',
+            },
+        ),
+    ]
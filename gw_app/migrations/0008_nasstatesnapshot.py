@@ -0,0 +1,26 @@
+# Generated by Django 2.1 on 2026-10-16 12:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gw_app', '0007_nassyncplan'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NasStateSnapshot',
+            fields=[
+                ('nas', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='state_snapshot', serialize=False, to='gw_app.NASModel')),
+                ('generation', models.PositiveIntegerField(default=0)),
+                ('data', models.BinaryField()),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'db_table': 'nas_state_snapshot',
+            },
+        ),
+    ]
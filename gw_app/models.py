@@ -1,11 +1,24 @@
+from datetime import timedelta
+from typing import Optional
+
+from django.conf import settings
 from django.contrib.messages import MessageFailure
 from django.db.models.signals import pre_delete
 from django.dispatch import receiver
 from django.shortcuts import resolve_url
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from django.db import models
+from jsonfield import JSONField
 from djing.lib import MyChoicesAdapter
 from gw_app.nas_managers import NAS_TYPES, NasNetworkError
+from gw_app.nas_managers.structs import SyncPlan, GatewaySnapshot
+
+# Not finished plan of sync is continued while it is younger,
+# older plan is made again because gateway may be changed since
+NAS_SYNC_PLAN_TTL = timedelta(
+    seconds=getattr(settings, 'NAS_SYNC_PLAN_TTL', 60 * 60 * 6)
+)
 
 
 class NASModel(models.Model):
@@ -17,6 +30,7 @@ class NASModel(models.Model):
     nas_type = models.CharField(_('Type'), max_length=4, choices=MyChoicesAdapter(NAS_TYPES), default=NAS_TYPES[0][0])
     default = models.BooleanField(_('Is default'), default=False)
     enabled = models.BooleanField(_('Enabled'), default=True)
+    last_full_sync = models.DateTimeField(_('Last full sync'), null=True, blank=True, editable=False)
 
     def get_nas_manager_klass(self):
         try:
@@ -55,6 +69,96 @@ class NASModel(models.Model):
         ordering = 'ip_address',
 
 
+class NasSyncPlanManager(models.Manager):
+    def get_pending(self, nas: NASModel) -> Optional['NasSyncPlan']:
+        """
+        Plan of sync that was not applied to the end,
+        outdated plans are removed
+        """
+        self.filter(nas=nas, created__lt=timezone.now() - NAS_SYNC_PLAN_TTL).delete()
+        return self.filter(nas=nas).first()
+
+    def save_plan(self, nas: NASModel, plan: SyncPlan,
+                  last_journal_id: Optional[int]) -> 'NasSyncPlan':
+        self.filter(nas=nas).delete()
+        return self.create(nas=nas, operations=plan.to_list(),
+                           position=plan.position,
+                           last_journal_id=last_journal_id)
+
+
+class NasSyncPlan(models.Model):
+    """
+    Plan of full sync that is applied to gateway now. Position is
+    saved after each applied batch, so when sync is failed it is
+    continued from there on next run.
+    """
+    nas = models.OneToOneField(NASModel, on_delete=models.CASCADE,
+                               primary_key=True, related_name='sync_plan')
+    created = models.DateTimeField(auto_now_add=True)
+    operations = JSONField()
+    position = models.PositiveIntegerField(default=0)
+    # Changes of subscribers in sync journal up to this id are in plan
+    last_journal_id = models.PositiveIntegerField(null=True, blank=True)
+
+    objects = NasSyncPlanManager()
+
+    def get_sync_plan(self) -> SyncPlan:
+        return SyncPlan(self.operations, self.position)
+
+    def save_position(self, plan: SyncPlan) -> None:
+        self.position = plan.position
+        self.save(update_fields=('position',))
+
+    def __str__(self):
+        return "%s: %d/%d" % (self.nas, self.position, len(self.operations))
+
+    class Meta:
+        db_table = 'nas_sync_plan'
+
+
+class NasStateSnapshotManager(models.Manager):
+    def load(self, nas: NASModel) -> Optional[GatewaySnapshot]:
+        data = self.filter(nas=nas).values_list('data', flat=True).first()
+        if data is not None:
+            return GatewaySnapshot.unpack(bytes(data))
+
+    def store(self, nas: NASModel, snapshot: Optional[GatewaySnapshot]) -> None:
+        """
+        Save snapshot if it was changed, snapshot that was
+        invalidated by gateway manager is removed
+        """
+        if snapshot is None:
+            self.filter(nas=nas).delete()
+            return
+        if self.filter(nas=nas, generation=snapshot.generation).exists():
+            return
+        self.update_or_create(nas=nas, defaults={
+            'generation': snapshot.generation,
+            'data': snapshot.pack()
+        })
+
+
+class NasStateSnapshot(models.Model):
+    """
+    Queues and address lists of gateway as they was last read, so each
+    sync does not read them again while gateway is not changed
+    """
+    nas = models.OneToOneField(NASModel, on_delete=models.CASCADE,
+                               primary_key=True, related_name='state_snapshot')
+    generation = models.PositiveIntegerField(default=0)
+    # packed GatewaySnapshot
+    data = models.BinaryField()
+    updated = models.DateTimeField(auto_now=True)
+
+    objects = NasStateSnapshotManager()
+
+    def __str__(self):
+        return "%s: %d" % (self.nas, self.generation)
+
+    class Meta:
+        db_table = 'nas_state_snapshot'
+
+
 @receiver(pre_delete, sender=NASModel)
 def nas_pre_delete(sender, **kwargs):
     nas = kwargs.get("instance")
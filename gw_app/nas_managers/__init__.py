@@ -1,9 +1,14 @@
 from gw_app.nas_managers.mod_mikrotik import MikrotikTransmitter
+from gw_app.nas_managers.mod_mikrotik_pcq import MikrotikPcqTransmitter
+from gw_app.nas_managers.mod_linux import LinuxTransmitter
 from gw_app.nas_managers.core import NasNetworkError, NasFailedResult
-from gw_app.nas_managers.structs import SubnetQueue
+from gw_app.nas_managers.structs import SubnetQueue, SyncStats
+from gw_app.nas_managers.pool import nas_pool
 
 # Указываем какие реализации шлюзов у нас есть, это будет использоваться в
 # web интерфейсе
 NAS_TYPES = (
     ('mktk', MikrotikTransmitter),
+    ('mkpq', MikrotikPcqTransmitter),
+    ('lnft', LinuxTransmitter),
 )
@@ -0,0 +1,169 @@
+import asyncio
+import binascii
+from hashlib import md5
+from typing import Iterable, Dict, List, Tuple
+
+from gw_app.nas_managers import core
+from gw_app.nas_managers.mod_mikrotik import ApiRos, NAS_SOCKET_TIMEOUT
+
+class AsyncApiRos(object):
+    """
+    Routeros api on asyncio streams.
+    Many commands may be run concurrently on one connection,
+    each of them is marked with .tag and replies are routed by it.
+    """
+
+    def __init__(self, ip: str, port: int, timeout=NAS_SOCKET_TIMEOUT):
+        self.ip = ip
+        self.port = port or 8728
+        self.timeout = timeout
+        self.round_trips = 0
+        self._reader = None
+        self._writer = None
+        self._read_task = None
+        self._error = None
+        # tag -> (future, list of replies)
+        self._pending = {}
+        self._next_tag = 0
+
+    async def connect(self):
+        try:
+            self._reader, self._writer = await asyncio.wait_for(
+                asyncio.open_connection(self.ip, self.port), self.timeout
+            )
+        except asyncio.TimeoutError:
+            raise core.NasNetworkError('Connection to %s timed out' % self.ip)
+        except OSError as e:
+            raise core.NasNetworkError('Connection to %s failed: %s' % (self.ip, e))
+        self._read_task = asyncio.ensure_future(self._read_loop())
+
+    async def login(self, username: str, pwd: str):
+        r = await self.exec_cmd(('/login',))
+        chal = binascii.unhexlify(r['!done']['=ret'])
+        md = md5()
+        md.update(b'\x00')
+        md.update(bytes(pwd, 'utf-8'))
+        md.update(chal)
+        await self.exec_cmd((
+            '/login', '=name=' + username,
+            '=response=00' + binascii.hexlify(md.digest()).decode('utf-8')
+        ))
+
+    def close(self):
+        if self._read_task is not None:
+            self._read_task.cancel()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    async def wait_closed(self):
+        """Waits finish of reader task after close"""
+        task = self._read_task
+        if task is not None:
+            self._read_task = None
+            await asyncio.gather(task, return_exceptions=True)
+
+    @property
+    def is_alive(self) -> bool:
+        return self._writer is not None and self._error is None
+
+    async def _read_len(self) -> int:
+        c = (await self._reader.readexactly(1))[0]
+        if (c & 0x80) == 0x00:
+            return c
+        elif (c & 0xC0) == 0x80:
+            size, c = 1, c & ~0xC0
+        elif (c & 0xE0) == 0xC0:
+            size, c = 2, c & ~0xE0
+        elif (c & 0xF0) == 0xE0:
+            size, c = 3, c & ~0xF0
+        else:
+            size, c = 4, 0
+        for b in await self._reader.readexactly(size):
+            c = (c << 8) + b
+        return c
+
+    async def _read_sentence(self) -> List[str]:
+        r = []
+        while 1:
+            length = await self._read_len()
+            if length == 0:
+                return r
+            r.append((await self._reader.readexactly(length)).decode('utf-8'))
+
+    async def _read_loop(self):
+        try:
+            while 1:
+                sentence = await self._read_sentence()
+                if not sentence:
+                    continue
+                reply, attrs = ApiRos._parse_sentence(sentence)
+                if reply == '!fatal':
+                    raise core.NasFailedResult(attrs.get('=message'))
+                tag = attrs.pop('.tag', None)
+                pending = self._pending.get(tag)
+                if pending is None:
+                    continue
+                fut, replies = pending
+                replies.append((reply, attrs))
+                if reply == '!done':
+                    del self._pending[tag]
+                    if not fut.done():
+                        fut.set_result(replies)
+        except asyncio.CancelledError:
+            err = core.NasNetworkError('Connection closed')
+        except (asyncio.IncompleteReadError, OSError):
+            err = core.NasFailedResult('connection closed by remote end')
+        except core.NasFailedResult as e:
+            err = e
+        self._error = err
+        for fut, replies in self._pending.values():
+            if not fut.done():
+                fut.set_exception(err)
+        self._pending.clear()
+
+    async def talk(self, words: Iterable[str], timeout=None) -> List[Tuple[str, Dict]]:
+        """
+        Send one command and wait all its replies
+        :return: list of (reply, attrs), last one is !done
+        """
+        if self._error is not None:
+            raise self._error
+        if self._writer is None:
+            raise core.NasNetworkError('Not connected')
+        tag = str(self._next_tag)
+        self._next_tag += 1
+        fut = asyncio.get_event_loop().create_future()
+        self._pending[tag] = (fut, [])
+        self._writer.write(ApiRos.encode_sentence(tuple(words) + ('.tag=%s' % tag,)))
+        self.round_trips += 1
+        try:
+            await self._writer.drain()
+            return await asyncio.wait_for(fut, timeout or self.timeout)
+        except asyncio.TimeoutError:
+            raise core.NasNetworkError('Timed out while waiting for gateway')
+        except OSError as e:
+            raise core.NasNetworkError(e)
+        finally:
+            self._pending.pop(tag, None)
+
+    async def exec_cmd(self, words: Iterable[str], timeout=None) -> Dict:
+        """
+        :return: dict like MikrotikTransmitter._exec_cmd, and !done attrs
+        """
+        r = {}
+        for reply, attrs in await self.talk(words, timeout):
+            if reply == '!trap':
+                raise core.NasFailedResult(attrs.get('=message'))
+            r[reply] = attrs or None
+        return r
+
+    async def exec_cmd_list(self, words: Iterable[str], timeout=None) -> List[Dict]:
+        """:return: attrs of all !re replies"""
+        res = []
+        for reply, attrs in await self.talk(words, timeout):
+            if reply == '!trap':
+                raise core.NasFailedResult(attrs.get('=message'))
+            elif reply == '!re':
+                res.append(attrs)
+        return res
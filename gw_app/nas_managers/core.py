@@ -1,7 +1,16 @@
+import socket
+import struct
 from abc import ABC, abstractmethod
-from typing import Iterator, Tuple, Optional
+from time import monotonic
+from typing import Iterator, Iterable, Tuple, Optional, Callable
 from djing import ping
-from gw_app.nas_managers.structs import SubnetQueue, VectorQueue
+from gw_app.nas_managers.structs import (
+    SubnetQueue, VectorQueue, SyncStats, QueueKey, SyncPlan, GatewaySnapshot
+)
+
+SYNC_ADD = 'add'
+SYNC_REMOVE = 'remove'
+SYNC_UPDATE = 'update'
 
 
 # Raised if gw has returned failed result
@@ -23,8 +32,8 @@ class BaseTransmitter(ABC):
         :return: Returnd a description of nas implementation
         """
 
-    def __init__(self, ip: str, *args, **kwargs):
-        if not ping(ip):
+    def __init__(self, ip: str, *args, check_ping=True, **kwargs):
+        if check_ping and not ping(ip):
             raise NasNetworkError('NAS %(ip_addr)s does not pinged' % {
                 'ip_addr': ip
             })
@@ -81,15 +90,182 @@ class BaseTransmitter(ABC):
         pass
 
     @abstractmethod
-    def sync_nas(self, users_from_db: Iterator):
+    def sync_nas(self, users_from_db: Iterator) -> SyncStats:
         """
         Synchronize db with gateway
         :param users_from_db: Queryset of allowed users
-        :return: nothing
+        :return: counters of changes made on gateway
+        """
+
+    def make_sync_plan(self, users_from_db: Iterator) -> SyncPlan:
         """
+        Compute changes that sync_nas would make, gateway is only read
+        :param users_from_db: Queryset of allowed users ordered by ip
+        :return: plan that may be shown or saved and applied later
+        """
+        raise NotImplementedError
+
+    def apply_sync_plan(self, plan: SyncPlan, batch_size: Optional[int] = None,
+                        checkpoint: Optional[Callable[[SyncPlan], None]] = None) -> SyncStats:
+        """
+        Apply not applied operations of plan by batches, position of
+        plan is moved after each batch and *checkpoint* is called
+        with plan, so failed applying may be continued from there.
+        :param batch_size: count of operations in batch, default of
+        gateway type is used when it is None
+        :return: counters of changes made on gateway
+        """
+        raise NotImplementedError
+
+    def get_snapshot(self) -> Optional[GatewaySnapshot]:
+        """
+        Snapshot of gateway state, it is read again only
+        when cheap check shows that gateway was changed
+        :return: None if gateway type does not keep snapshots
+        """
+        return None
+
+    def set_snapshot(self, snapshot: Optional[GatewaySnapshot]):
+        """
+        Give snapshot that was saved before, it is
+        checked by gateway before it is used
+        """
+
+    @property
+    def last_snapshot(self) -> Optional[GatewaySnapshot]:
+        """
+        Snapshot as it is now, without check by gateway.
+        None when it is invalidated after failed write.
+        """
+        return None
+
+    def sync_changes(self, queues_for_update: VectorQueue,
+                     queues_for_remove: VectorQueue) -> SyncStats:
+        """
+        Push to gateway only subscribers that was changed since last sync
+        :param queues_for_update: subscribers that must be on gateway
+        :param queues_for_remove: subscribers that must be removed from gateway
+        :return: counters of changes made on gateway
+        """
+        stats = SyncStats()
+        start_time = monotonic()
+        round_trips = getattr(self, 'round_trips', 0)
+        for q in queues_for_remove:
+            self.remove_user(q)
+            stats.queues_removed += 1
+        for q in queues_for_update:
+            self.update_user(q)
+            stats.queues_updated += 1
+        stats.round_trips = getattr(self, 'round_trips', 0) - round_trips
+        stats.wall_time = monotonic() - start_time
+        return stats
+
+    def cancel(self):
+        """
+        Interrupt current communication with gateway.
+        May be called from another thread, after that
+        all operations raises NasNetworkError.
+        """
+
+    def close(self):
+        """
+        Close connection with gateway
+        """
+
+    @property
+    def is_alive(self) -> bool:
+        """
+        :return: False if connection with gateway may not be used anymore
+        """
+        return True
+
+    def check_alive(self) -> bool:
+        """
+        Make sure that connection with gateway is still usable,
+        it may be a cheap request to gateway
+        """
+        return self.is_alive
 
 
 def diff_set(one: set, two: set) -> Tuple[set, set]:
     list_for_del = (one ^ two) - one
     list_for_add = one - two
     return list_for_add, list_for_del
+
+
+def parse_net(text: str) -> Tuple[int, int]:
+    """
+    '192.168.0.2/32' -> (3232235522, 32)
+    Without allocation of ipaddress objects.
+    """
+    addr, _, prefix = text.partition('/')
+    return struct.unpack('!I', socket.inet_aton(addr))[0], int(prefix or 32)
+
+
+def make_queue_key(name: str, network: str, speed_in: float, speed_out: float,
+                   queue_id=None) -> QueueKey:
+    """
+    :param network: network in text view
+    :param speed_in: speed in Mbit/s
+    :param speed_out: speed in Mbit/s
+    """
+    net, prefix = parse_net(network)
+    return QueueKey(net, prefix, int(round(speed_in * 1000)),
+                    int(round(speed_out * 1000)), name, queue_id)
+
+
+def iter_user_keys(users_from_db: Iterable) -> Iterator[QueueKey]:
+    """
+    Compact queues of subscribers that have access to internet.
+    Gateways shape only ipv4, subscribers with other address are skipped.
+    """
+    for ab in users_from_db:
+        if ab is None or not ab.ip_address or not ab.is_access():
+            continue
+        trf = ab.active_tariff().tariff
+        try:
+            key = make_queue_key("uid%d" % ab.pk, str(ab.ip_address),
+                                 trf.speedIn, trf.speedOut)
+        except (OSError, ValueError):
+            print('Skip subscriber uid%d: %s is not ipv4 address' % (ab.pk, ab.ip_address))
+            continue
+        yield key
+
+
+def merge_diff(desired: Iterable[QueueKey],
+               actual: Iterable[QueueKey]) -> Iterator[Tuple[str, Optional[QueueKey], Optional[QueueKey]]]:
+    """
+    Compare two streams of queues sorted by network and emit
+    operations that turn *actual* into *desired*:
+    (SYNC_ADD, desired, None), (SYNC_REMOVE, None, actual)
+    or (SYNC_UPDATE, desired, actual) when speed or name differs.
+    Streams are read only once, so whole lists are not in memory.
+    Duplicate networks in desired are skipped, duplicates in actual
+    are removed.
+    """
+    desired, actual = iter(desired), iter(actual)
+    d, a = next(desired, None), next(actual, None)
+    d_prev = a_prev = None
+    while d is not None or a is not None:
+        if d is not None and d_prev is not None and d[:2] <= d_prev:
+            if d[:2] < d_prev:
+                raise ValueError('Desired queues must be sorted by network')
+            d = next(desired, None)
+            continue
+        if a is not None and a_prev is not None and a[:2] <= a_prev:
+            if a[:2] < a_prev:
+                raise ValueError('Actual queues must be sorted by network')
+            yield SYNC_REMOVE, None, a
+            a = next(actual, None)
+            continue
+        if a is None or (d is not None and d[:2] < a[:2]):
+            yield SYNC_ADD, d, None
+            d_prev, d = d[:2], next(desired, None)
+        elif d is None or a[:2] < d[:2]:
+            yield SYNC_REMOVE, None, a
+            a_prev, a = a[:2], next(actual, None)
+        else:
+            if d[2:5] != a[2:5]:
+                yield SYNC_UPDATE, d, a
+            d_prev, d = d[:2], next(desired, None)
+            a_prev, a = a[:2], next(actual, None)
@@ -0,0 +1,456 @@
+import binascii
+import os
+import socket
+import socketserver
+from collections import Counter, deque
+from hashlib import md5
+from threading import Thread, Lock, Condition
+from time import monotonic, sleep
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from gw_app.nas_managers.mod_mikrotik import ApiRos, LIST_USERS_ALLOWED
+
+
+"""
+    Stand-in of RouterOS api server for tests and benchmarks of
+    gateway managers, it keeps queues and address lists in memory.
+    Usage:
+        with FakeRouterOS(login='admin', password='pass') as ros:
+            mngr = MikrotikTransmitter(
+                login='admin', password='pass', ip=ros.host,
+                port=ros.port, enabled=True, check_ping=False
+            )
+"""
+
+# path -> (names of fields that must be unique together, default fields)
+TABLES = {
+    '/queue/simple': (('name',), {
+        'parent': 'none', 'priority': '8/8', 'limit-at': '0/0',
+        'max-limit': '0/0', 'invalid': 'false', 'dynamic': 'false',
+        'disabled': 'false'
+    }),
+    '/queue/type': (('name',), {}),
+    '/queue/tree': (('name',), {
+        'parent': 'global', 'invalid': 'false', 'disabled': 'false'
+    }),
+    '/ip/firewall/address-list': (('list', 'address'), {
+        'dynamic': 'false', 'disabled': 'false'
+    }),
+    '/ip/firewall/mangle': ((), {
+        'invalid': 'false', 'dynamic': 'false', 'disabled': 'false'
+    }),
+    '/ip/arp': (('address',), {
+        'dynamic': 'false', 'disabled': 'false'
+    })
+}
+
+_bool_values = {'yes': 'true', 'no': 'false'}
+
+
+def _norm_value(path: str, name: str, value: str) -> str:
+    value = _bool_values.get(value, value)
+    if name == 'address' and path == '/ip/firewall/address-list' and value.endswith('/32'):
+        # host addresses are shown without prefix
+        return value[:-3]
+    if name == 'target' and value and '/' not in value:
+        return value + '/32'
+    return value
+
+
+class _Trap(Exception):
+    pass
+
+
+class _Session(object):
+    """State of one api connection"""
+
+    def __init__(self):
+        self.is_login = False
+        self.challenge = None
+
+
+class FakeRouterOS(object):
+    def __init__(self, login='admin', password='', host='127.0.0.1', port=0,
+                 identity='FakeRouterOS', latency=0.0):
+        self.login = login
+        self.password = password
+        self.identity = identity
+        # delay in seconds of each reply, it is like round trip over network.
+        # Replies are delayed without stopping processing of next commands,
+        # so pipelined commands are waited once
+        self.latency = latency
+        self.tables = {path: {} for path in TABLES}  # type: Dict[str, Dict[str, dict]]
+        # path -> {values of unique fields: id}
+        self._unique = {path: {} for path in TABLES}
+        self.command_counts = Counter()
+        self._traps = []
+        self._next_id = 1
+        self._lock = Lock()
+        server = socketserver.ThreadingTCPServer((host, port), self._make_handler(),
+                                                 bind_and_activate=False)
+        server.daemon_threads = True
+        server.allow_reuse_address = True
+        server.server_bind()
+        server.server_activate()
+        self._server = server
+        self._thread = None
+
+    @property
+    def host(self) -> str:
+        return self._server.server_address[0]
+
+    @property
+    def port(self) -> int:
+        return self._server.server_address[1]
+
+    def start(self):
+        self._thread = Thread(target=self._server.serve_forever, args=(0.05,), daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    #################################################
+    #           Control of state from tests
+    #################################################
+
+    def add_item(self, path: str, fields: Dict[str, str]) -> str:
+        """Put item to table as if it was added by command, :return: id"""
+        with self._lock:
+            try:
+                return self._add(path, fields)
+            except _Trap as e:
+                raise ValueError(e)
+
+    def items(self, path: str) -> List[dict]:
+        with self._lock:
+            return [dict(item) for item in self.tables[path].values()]
+
+    def inject_trap(self, command: str, message='failure: injected error', count=1):
+        """
+        Next *count* commands like '/queue/simple/add' returns !trap
+        with *message* and does not change state
+        """
+        with self._lock:
+            self._traps.append([command, message, count])
+
+    def _take_trap(self, command: str) -> Optional[str]:
+        for trap in self._traps:
+            if trap[0] == command:
+                trap[2] -= 1
+                if trap[2] <= 0:
+                    self._traps.remove(trap)
+                return trap[1]
+
+    #################################################
+    #                Commands
+    #################################################
+
+    def execute(self, sess: _Session, words: Sequence[str]) -> List[List[str]]:
+        """
+        :return: reply sentences for one command
+        """
+        command = words[0]
+        attrs = {}
+        queries = []
+        tag = None
+        for w in words[1:]:
+            if w.startswith('='):
+                k, _, v = w[1:].partition('=')
+                attrs[k] = v
+            elif w.startswith('?'):
+                queries.append(w[1:])
+            elif w.startswith('.tag='):
+                tag = w[5:]
+            # other words, like 'where', are ignored
+        tag_words = [] if tag is None else ['.tag=%s' % tag]
+        try:
+            with self._lock:
+                self.command_counts[command] += 1
+                if command == '/login':
+                    replies = self._login(sess, attrs)
+                elif not sess.is_login:
+                    raise _Trap('not logged in')
+                else:
+                    message = self._take_trap(command)
+                    if message is not None:
+                        raise _Trap(message)
+                    replies = self._run(command, attrs, queries)
+        except _Trap as e:
+            return [['!trap', '=message=%s' % e] + tag_words, ['!done'] + tag_words]
+        return [r + tag_words for r in replies]
+
+    def _login(self, sess: _Session, attrs: Dict[str, str]) -> List[List[str]]:
+        if 'name' not in attrs:
+            sess.challenge = os.urandom(16)
+            return [['!done', '=ret=%s' % binascii.hexlify(sess.challenge).decode()]]
+        if sess.challenge is None:
+            raise _Trap('cannot log in')
+        md = md5()
+        md.update(b'\x00')
+        md.update(bytes(self.password, 'utf-8'))
+        md.update(sess.challenge)
+        expected = '00' + binascii.hexlify(md.digest()).decode()
+        sess.challenge = None
+        if attrs['name'] != self.login or attrs.get('response') != expected:
+            raise _Trap('cannot log in')
+        sess.is_login = True
+        return [['!done']]
+
+    def _run(self, command: str, attrs: Dict[str, str], queries: List[str]) -> List[List[str]]:
+        if command == '/system/identity/print':
+            return [['!re', '=name=%s' % self.identity], ['!done']]
+        if command == '/ping':
+            count = int(attrs.get('count', 4))
+            return [
+                ['!re', '=host=%s' % attrs.get('address'), '=sent=%d' % i, '=received=%d' % i]
+                for i in range(1, count + 1)
+            ] + [['!done']]
+        path, _, action = command.rpartition('/')
+        if path not in self.tables:
+            raise _Trap('no such command prefix')
+        if action == 'print':
+            replies = self._print(path, attrs, queries)
+            if 'count-only' in attrs:
+                return [['!done', '=ret=%d' % len(replies)]]
+            return replies + [['!done']]
+        elif action == 'add':
+            return [['!done', '=ret=%s' % self._add(path, attrs)]]
+        elif action == 'set':
+            self._set(path, attrs)
+        elif action == 'remove':
+            self._remove(path, attrs)
+        else:
+            raise _Trap('no such command')
+        return [['!done']]
+
+    @staticmethod
+    def _match(path: str, item: dict, query: str) -> bool:
+        if query.startswith('-'):
+            return query[1:] not in item
+        if query.startswith('='):
+            query = query[1:]
+        name, eq, value = query.partition('=')
+        if not eq:
+            return name in item
+        return item.get(name) == _norm_value(path, name, value)
+
+    def _print(self, path: str, attrs: Dict[str, str], queries: List[str]) -> List[List[str]]:
+        proplist = attrs.get('.proplist')
+        if proplist is not None:
+            proplist = proplist.split(',')
+        replies = []
+        for item in self.tables[path].values():
+            if not all(self._match(path, item, q) for q in queries):
+                continue
+            names = item.keys() if proplist is None else (n for n in proplist if n in item)
+            replies.append(['!re'] + ['=%s=%s' % (n, item[n]) for n in names])
+        return replies
+
+    def _unique_key(self, path: str, item: dict) -> Optional[tuple]:
+        unique = TABLES[path][0]
+        if unique:
+            return tuple(item.get(n) for n in unique)
+
+    def _check_unique(self, path: str, key: Optional[tuple], item_id=None):
+        if key is None:
+            return
+        other_id = self._unique[path].get(key)
+        if other_id is not None and other_id != item_id:
+            raise _Trap('failure: already have such %s' % TABLES[path][0][-1])
+
+    def _add(self, path: str, attrs: Dict[str, str]) -> str:
+        item_id = '*%X' % self._next_id
+        item = {'.id': item_id}
+        item.update(TABLES[path][1])
+        item.update((k, _norm_value(path, k, v)) for k, v in attrs.items())
+        key = self._unique_key(path, item)
+        self._check_unique(path, key)
+        self._next_id += 1
+        self.tables[path][item_id] = item
+        if key is not None:
+            self._unique[path][key] = item_id
+        return item_id
+
+    def _find_ids(self, path: str, attrs: Dict[str, str]) -> List[str]:
+        ids = attrs.get('.id') or attrs.get('numbers')
+        if not ids:
+            raise _Trap('no such item')
+        ids = ids.split(',')
+        table = self.tables[path]
+        if any(i not in table for i in ids):
+            raise _Trap('no such item')
+        return ids
+
+    def _set(self, path: str, attrs: Dict[str, str]):
+        table = self.tables[path]
+        changes = {
+            k: _norm_value(path, k, v) for k, v in attrs.items()
+            if k not in ('.id', 'numbers')
+        }
+        ids = self._find_ids(path, attrs)
+        for item_id in ids:
+            self._check_unique(path, self._unique_key(path, dict(table[item_id], **changes)), item_id)
+        unique = self._unique[path]
+        for item_id in ids:
+            item = table[item_id]
+            key = self._unique_key(path, item)
+            if key is not None:
+                del unique[key]
+            item.update(changes)
+            key = self._unique_key(path, item)
+            if key is not None:
+                unique[key] = item_id
+
+    def _remove(self, path: str, attrs: Dict[str, str]):
+        table = self.tables[path]
+        for item_id in self._find_ids(path, attrs):
+            key = self._unique_key(path, table.pop(item_id))
+            if key is not None:
+                del self._unique[path][key]
+
+    #################################################
+    #                Network
+    #################################################
+
+    def _make_handler(self):
+        ros = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                sess = _Session()
+                sender = _DelayedSender(self.request) if ros.latency > 0 else None
+                buf = bytearray()
+                try:
+                    while 1:
+                        data = self.request.recv(0x10000)
+                        if not data:
+                            break
+                        buf += data
+                        sentences, pos = _parse_sentences(buf)
+                        del buf[:pos]
+                        # replies for all received commands are sent at once
+                        data = b''.join(
+                            ApiRos.encode_sentence(r)
+                            for words in sentences if words
+                            for r in ros.execute(sess, words)
+                        )
+                        if not data:
+                            continue
+                        if sender is None:
+                            self.request.sendall(data)
+                        else:
+                            sender.send_at(monotonic() + ros.latency, data)
+                except OSError:
+                    pass
+                finally:
+                    if sender is not None:
+                        sender.stop()
+
+        return Handler
+
+
+class _DelayedSender(object):
+    """Sends replies to client after delay, in order of receiving"""
+
+    def __init__(self, sk: socket.socket):
+        self._sk = sk
+        self._queue = deque()
+        self._cond = Condition()
+        self._stopped = False
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def send_at(self, send_time: float, data: bytes):
+        with self._cond:
+            self._queue.append((send_time, data))
+            self._cond.notify()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._thread.join()
+
+    def _run(self):
+        while 1:
+            with self._cond:
+                while not self._queue and not self._stopped:
+                    self._cond.wait()
+                if not self._queue:
+                    return
+                send_time, data = self._queue.popleft()
+            delay = send_time - monotonic()
+            if delay > 0:
+                sleep(delay)
+            try:
+                self._sk.sendall(data)
+            except OSError:
+                return
+
+
+def _parse_sentences(buf: bytearray) -> Tuple[List[List[str]], int]:
+    """
+    :return: complete sentences from buffer and position of
+    first byte after them
+    """
+    sentences = []
+    pos = done = 0
+    end = len(buf)
+    words = []
+    while pos < end:
+        c = buf[pos]
+        if (c & 0x80) == 0x00:
+            size = 0
+        elif (c & 0xC0) == 0x80:
+            size, c = 1, c & ~0xC0
+        elif (c & 0xE0) == 0xC0:
+            size, c = 2, c & ~0xE0
+        elif (c & 0xF0) == 0xE0:
+            size, c = 3, c & ~0xF0
+        else:
+            size, c = 4, 0
+        if pos + 1 + size > end:
+            break
+        for b in buf[pos + 1:pos + 1 + size]:
+            c = (c << 8) + b
+        pos += 1 + size
+        if c == 0:
+            sentences.append(words)
+            words = []
+            done = pos
+            continue
+        if pos + c > end:
+            break
+        words.append(buf[pos:pos + c].decode('utf-8'))
+        pos += c
+    return sentences, done
+
+
+def load_queues(ros: FakeRouterOS, queues: Iterable, list_name=LIST_USERS_ALLOWED):
+    """
+    Fill gateway with simple queues and allowed addresses
+    :param queues: instances of SubnetQueue
+    """
+    for q in queues:
+        ros.add_item('/queue/simple', {
+            'name': q.name,
+            'target': str(q.network),
+            'max-limit': '%.3fM/%.3fM' % q.max_limit,
+            'disabled': 'false' if q.is_access else 'true'
+        })
+        ros.add_item('/ip/firewall/address-list', {
+            'list': list_name,
+            'address': str(q.network)
+        })
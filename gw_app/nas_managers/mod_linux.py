@@ -0,0 +1,500 @@
+import json
+import re
+import shlex
+import socket
+import struct
+import subprocess
+from time import monotonic
+from typing import Iterable, Iterator, Dict, Optional, Sequence, Tuple
+
+from django.conf import settings
+from django.utils.translation import ugettext_lazy as _
+from gw_app.nas_managers import core
+from gw_app.nas_managers import structs as i_structs
+
+# Seconds to wait one command on gateway
+NAS_LINUX_CMD_TIMEOUT = getattr(settings, 'NAS_LINUX_CMD_TIMEOUT', 120)
+
+# Interface to internet, upload of subscribers is shaped on it
+NAS_LINUX_WAN_IFACE = getattr(settings, 'NAS_LINUX_WAN_IFACE', 'eth0')
+
+# Interface to subscribers, download of subscribers is shaped on it
+NAS_LINUX_LAN_IFACE = getattr(settings, 'NAS_LINUX_LAN_IFACE', 'eth1')
+
+NFT_TABLE = 'djing'
+
+# First minor of htb class of subscriber, minor 1 is reserved
+_MIN_CLASS_MINOR = 2
+_MAX_CLASS_MINOR = 0xffff
+
+_ping_stat_regexp = re.compile(r'(\d+) packets transmitted, (\d+) (?:packets )?received')
+_arping_stat_regexp = re.compile(r'Sent (\d+) probes.*\nReceived (\d+) response', re.S)
+
+# Network of subscriber -> QueueKey, queue_id is minor of htb class
+GatewayState = Dict[Tuple[int, int], i_structs.QueueKey]
+
+
+def _net_text(key: i_structs.QueueKey) -> str:
+    addr = socket.inet_ntoa(struct.pack('!I', key.net))
+    if key.prefix == 32:
+        return addr
+    return '%s/%d' % (addr, key.prefix)
+
+
+def _classid(minor: int) -> str:
+    return '1:%x' % minor
+
+
+def _map_elem(key: i_structs.QueueKey) -> str:
+    return '%s comment "%s" : %s' % (_net_text(key), key.name, _classid(key.queue_id))
+
+
+def _elements(items: Sequence[str]) -> str:
+    return ',\n\t\t\t'.join(items)
+
+
+def render_nft_full(keys: Sequence[i_structs.QueueKey], lan_iface=NAS_LINUX_LAN_IFACE) -> str:
+    """
+    Whole table for nft -f, it is replaced atomically
+    :param keys: subscribers sorted by network, queue_id is minor of class
+    """
+    lines = [
+        # table is created when it is absent, so delete does not fail
+        'table ip %s' % NFT_TABLE,
+        'delete table ip %s' % NFT_TABLE,
+        'table ip %s {' % NFT_TABLE,
+        '\tset allowed {',
+        '\t\ttype ipv4_addr',
+        '\t\tflags interval',
+    ]
+    if keys:
+        lines.append('\t\telements = { %s }' % _elements([_net_text(k) for k in keys]))
+    lines.extend((
+        '\t}',
+        '\tmap classes {',
+        '\t\ttype ipv4_addr : classid',
+        '\t\tflags interval',
+    ))
+    if keys:
+        lines.append('\t\telements = { %s }' % _elements([_map_elem(k) for k in keys]))
+    lines.extend((
+        '\t}',
+        '\tchain forward {',
+        '\t\ttype filter hook forward priority 0; policy accept;',
+        '\t\tiifname "%s" ip saddr != @allowed drop' % lan_iface,
+        '\t\tiifname "%s" meta priority set ip saddr map @classes' % lan_iface,
+        '\t\toifname "%s" meta priority set ip daddr map @classes' % lan_iface,
+        '\t}',
+        '}',
+    ))
+    return '\n'.join(lines) + '\n'
+
+
+def render_nft_diff(add: Sequence[i_structs.QueueKey],
+                    remove: Sequence[i_structs.QueueKey]) -> str:
+    """Changes of existing table, nft -f applies them in one transaction"""
+    lines = []
+    if remove:
+        lines.append('delete element ip %s classes { %s }' % (
+            NFT_TABLE, ', '.join(_net_text(k) for k in remove)))
+        lines.append('delete element ip %s allowed { %s }' % (
+            NFT_TABLE, ', '.join(_net_text(k) for k in remove)))
+    if add:
+        lines.append('add element ip %s allowed { %s }' % (
+            NFT_TABLE, ', '.join(_net_text(k) for k in add)))
+        lines.append('add element ip %s classes { %s }' % (
+            NFT_TABLE, ', '.join(_map_elem(k) for k in add)))
+    return ''.join(l + '\n' for l in lines)
+
+
+def render_tc(replace: Sequence[i_structs.QueueKey], remove: Sequence[i_structs.QueueKey],
+              wan_iface=NAS_LINUX_WAN_IFACE, lan_iface=NAS_LINUX_LAN_IFACE,
+              new_roots: Sequence[str] = ()) -> str:
+    """
+    Batch for tc -batch, classes are created or changed by replace.
+    :param new_roots: interfaces without root htb qdisc, it is created
+    there. Traffic that is not classified is not shaped.
+    """
+    # htb does not change itself by replace, so it is done only once
+    lines = ['qdisc replace dev %s root handle 1: htb default 0' % iface
+             for iface in new_roots]
+    for k in replace:
+        for iface, speed in ((wan_iface, k.speed_in), (lan_iface, k.speed_out)):
+            rate = '%dkbit' % max(speed, 1)
+            # classes do not borrow, so quantum of one packet is enough
+            lines.append('class replace dev %s parent 1: classid %s htb rate %s ceil %s quantum 1514' % (
+                iface, _classid(k.queue_id), rate, rate))
+    for k in remove:
+        for iface in (wan_iface, lan_iface):
+            lines.append('class del dev %s classid %s' % (iface, _classid(k.queue_id)))
+    return ''.join(l + '\n' for l in lines)
+
+
+def _parse_classid(text) -> Optional[int]:
+    major, _, minor = str(text).partition(':')
+    try:
+        if major == '1':
+            return int(minor, 16)
+    except ValueError:
+        pass
+
+
+def parse_nft_classes(text: str) -> Dict[Tuple[int, int], Tuple[int, str]]:
+    """
+    Output of `nft -j list map ip djing classes`
+    :return: dict of network -> (minor of class, name of subscriber)
+    """
+    res = {}
+    for obj in json.loads(text).get('nftables', ()):
+        nft_map = obj.get('map')
+        if nft_map is None:
+            continue
+        for elem in nft_map.get('elem', ()):
+            val, classid = elem
+            comment = ''
+            if isinstance(val, dict) and 'elem' in val:
+                comment = val['elem'].get('comment', '')
+                val = val['elem'].get('val')
+            if isinstance(val, dict) and 'prefix' in val:
+                net = '%s/%d' % (val['prefix']['addr'], val['prefix']['len'])
+            else:
+                net = str(val)
+            minor = _parse_classid(classid)
+            if minor is not None:
+                res[core.parse_net(net)] = (minor, comment)
+    return res
+
+
+_tc_class_regexp = re.compile(r'^class htb 1:([0-9a-f]+) .*?\brate (\d+(?:\.\d+)?)([KMG]?)bit', re.M)
+_tc_rate_units = {'': 0.001, 'K': 1, 'M': 1000, 'G': 1000 ** 2}
+
+
+def parse_tc_rates(text: str) -> Dict[int, int]:
+    """
+    Output of `tc class show dev <iface>`, htb classes are
+    not shown as json by tc
+    :return: dict of minor of class -> rate in kbit/s
+    """
+    return {
+        int(minor, 16): int(round(float(rate) * _tc_rate_units[unit]))
+        for minor, rate, unit in _tc_class_regexp.findall(text)
+    }
+
+
+def has_htb_root(text: str) -> bool:
+    """:param text: output of `tc -j qdisc show dev <iface>`"""
+    return any(
+        q.get('root') and q.get('kind') == 'htb' and q.get('handle') == '1:'
+        for q in json.loads(text or '[]')
+    )
+
+
+def make_state(classes: Dict[Tuple[int, int], Tuple[int, str]],
+               rates_in: Dict[int, int], rates_out: Dict[int, int]) -> GatewayState:
+    return {
+        net: i_structs.QueueKey(net[0], net[1], rates_in.get(minor, 0),
+                                rates_out.get(minor, 0), name, minor)
+        for net, (minor, name) in classes.items()
+    }
+
+
+class _MinorAllocator(object):
+    """Gives minors of htb classes that are not used on gateway"""
+
+    def __init__(self, used: Iterable[int]):
+        self._used = set(used)
+        self._next = _MIN_CLASS_MINOR
+
+    def allocate(self) -> int:
+        while self._next in self._used:
+            self._next += 1
+        if self._next > _MAX_CLASS_MINOR:
+            raise core.NasFailedResult(_('No free htb classes on gateway'))
+        minor = self._next
+        self._used.add(minor)
+        return minor
+
+
+class LinuxTransmitter(core.BaseTransmitter):
+    """
+    Linux gateway with nftables and tc. Subscribers are kept in nftables
+    table 'djing': set 'allowed' contains networks with access to internet,
+    map 'classes' gives minor of htb class for each network, and name of
+    subscriber is in comment of map element. Class is set in forward chain,
+    so it is done before masquerade. Each subscriber has htb class with
+    same minor on wan interface (upload, speed_in) and on lan interface
+    (download, speed_out).
+    Commands are run over ssh with key authentication, password is not
+    used. Gateway with address 127.0.0.1 is this host, commands are run
+    without ssh.
+    """
+    description = _('Linux nftables and tc')
+
+    def __init__(self, login: str, password: str, ip: str, port: int,
+                 enabled: bool, *args, **kwargs):
+        if not enabled:
+            raise core.NasFailedResult(_('Gateway disabled'))
+        core.BaseTransmitter.__init__(self, ip=ip, *args, **kwargs)
+        if ip in ('127.0.0.1', 'localhost'):
+            self._ssh = None
+        else:
+            self._ssh = (
+                'ssh', '-p', str(port or 22), '-o', 'BatchMode=yes',
+                '-o', 'ConnectTimeout=10', '%s@%s' % (login, ip)
+            )
+        self.round_trips = 0
+        self._state = None  # type: Optional[GatewayState]
+        # root htb qdiscs are known to exist on both interfaces
+        self._has_roots = False
+
+    def _run(self, cmd: Sequence[str], script: Optional[str] = None) -> str:
+        """
+        Run command on gateway
+        :param script: text for stdin of command
+        :return: stdout of command
+        """
+        if self._ssh is not None:
+            cmd = self._ssh + (' '.join(shlex.quote(c) for c in cmd),)
+        self.round_trips += 1
+        try:
+            r = subprocess.run(
+                cmd, input=None if script is None else script.encode('utf-8'),
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                timeout=NAS_LINUX_CMD_TIMEOUT
+            )
+        except subprocess.TimeoutExpired:
+            raise core.NasNetworkError('Command on gateway timed out')
+        except OSError as e:
+            raise core.NasNetworkError(e)
+        if r.returncode == 255 and self._ssh is not None:
+            raise core.NasNetworkError(r.stderr.decode('utf-8', 'replace').strip())
+        if r.returncode != 0:
+            raise core.NasFailedResult(r.stderr.decode('utf-8', 'replace').strip())
+        return r.stdout.decode('utf-8', 'replace')
+
+    def _apply(self, nft_script: str, tc_replace: Sequence[i_structs.QueueKey],
+               tc_remove: Sequence[i_structs.QueueKey]):
+        """
+        Classes are created before subscribers get them in nft map,
+        and removed after they are removed from map
+        """
+        try:
+            script = render_tc(tc_replace, (), new_roots=self._new_roots() if tc_replace else ())
+            if script:
+                self._run(('tc', '-batch', '-'), script)
+            if nft_script:
+                self._run(('nft', '-f', '-'), nft_script)
+            script = render_tc((), tc_remove)
+            if script:
+                self._run(('tc', '-force', '-batch', '-'), script)
+        except (core.NasFailedResult, core.NasNetworkError):
+            self._state = None
+            self._has_roots = False
+            raise
+        if tc_replace:
+            self._has_roots = True
+
+    def _new_roots(self) -> Tuple[str, ...]:
+        if self._has_roots:
+            return ()
+        return tuple(
+            iface for iface in (NAS_LINUX_WAN_IFACE, NAS_LINUX_LAN_IFACE)
+            if not has_htb_root(self._run(('tc', '-j', 'qdisc', 'show', 'dev', iface)))
+        )
+
+    #################################################
+    #            State of gateway
+    #################################################
+
+    def read_state(self) -> GatewayState:
+        try:
+            classes = parse_nft_classes(self._run((
+                'nft', '-j', 'list', 'map', 'ip', NFT_TABLE, 'classes'
+            )))
+        except core.NasFailedResult:
+            # table is not created yet
+            return {}
+        return make_state(
+            classes,
+            parse_tc_rates(self._run(('tc', 'class', 'show', 'dev', NAS_LINUX_WAN_IFACE))),
+            parse_tc_rates(self._run(('tc', 'class', 'show', 'dev', NAS_LINUX_LAN_IFACE)))
+        )
+
+    def get_state(self) -> GatewayState:
+        if self._state is None:
+            self._state = self.read_state()
+        return self._state
+
+    @staticmethod
+    def _queue_key(queue: i_structs.SubnetQueue, minor=None) -> i_structs.QueueKey:
+        return core.make_queue_key(queue.name, str(queue.network), queue.max_limit[0],
+                                   queue.max_limit[1], minor)
+
+    def _apply_changes(self, update: Iterable[i_structs.SubnetQueue],
+                       remove: Iterable[i_structs.SubnetQueue]) -> i_structs.SyncStats:
+        """Changes of few subscribers in one small batch"""
+        stats = i_structs.SyncStats()
+        state = self.get_state()
+        allocator = _MinorAllocator(k.queue_id for k in state.values())
+        nft_add, nft_remove, tc_replace, tc_remove = [], [], [], []
+        new_state = dict(state)
+        for q in remove:
+            old = new_state.pop(core.parse_net(str(q.network)), None)
+            if old is not None:
+                nft_remove.append(old)
+                tc_remove.append(old)
+                stats.queues_removed += 1
+                stats.ips_removed += 1
+        for q in update:
+            net = core.parse_net(str(q.network))
+            old = new_state.get(net)
+            if old is None:
+                k = self._queue_key(q, allocator.allocate())
+                nft_add.append(k)
+                tc_replace.append(k)
+                stats.queues_added += 1
+                stats.ips_added += 1
+            else:
+                k = self._queue_key(q, old.queue_id)
+                if k.name != old.name:
+                    nft_remove.append(old)
+                    nft_add.append(k)
+                if k[2:5] != old[2:5]:
+                    tc_replace.append(k)
+                    stats.queues_updated += 1
+            new_state[net] = k
+        # minors of removed classes are not reused in same batch
+        self._apply(render_nft_diff(nft_add, nft_remove), tc_replace, tc_remove)
+        self._state = new_state
+        return stats
+
+    #################################################
+    #            BaseTransmitter
+    #################################################
+
+    def add_user_range(self, queue_list: i_structs.VectorQueue):
+        self._apply_changes(queue_list, ())
+
+    def remove_user_range(self, queues: i_structs.VectorQueue):
+        self._apply_changes((), queues)
+
+    def add_user(self, queue: i_structs.SubnetQueue, *args):
+        self._apply_changes((queue,), ())
+
+    def remove_user(self, queue: i_structs.SubnetQueue):
+        self._apply_changes((), (queue,))
+
+    def update_user(self, queue: i_structs.SubnetQueue, *args):
+        if queue.is_access:
+            self._apply_changes((queue,), ())
+        else:
+            self._apply_changes((), (queue,))
+
+    def sync_changes(self, queues_for_update: i_structs.VectorQueue,
+                     queues_for_remove: i_structs.VectorQueue) -> i_structs.SyncStats:
+        start_time = monotonic()
+        round_trips = self.round_trips
+        update, remove = [], list(queues_for_remove)
+        for q in queues_for_update:
+            (update if q.is_access else remove).append(q)
+        stats = self._apply_changes(update, remove)
+        stats.round_trips = self.round_trips - round_trips
+        stats.wall_time = monotonic() - start_time
+        return stats
+
+    def sync_nas(self, users_from_db: Iterator) -> i_structs.SyncStats:
+        return self.apply_sync_plan(self.make_sync_plan(users_from_db))
+
+    def make_sync_plan(self, users_from_db: Iterator) -> i_structs.SyncPlan:
+        """
+        Subscribers keep their htb classes, minors for new
+        subscribers are chosen here and are kept in item_id
+        """
+        state = self.get_state()
+        allocator = _MinorAllocator(k.queue_id for k in state.values())
+        ops = []
+        for op, d, a in core.merge_diff(core.iter_user_keys(users_from_db),
+                                        sorted(state.values())):
+            if op == core.SYNC_REMOVE:
+                k = a
+            elif op == core.SYNC_ADD:
+                k = d._replace(queue_id=allocator.allocate())
+            else:
+                k = d._replace(queue_id=a.queue_id)
+            ops.append(i_structs.PlanOp('queue', op, k.name, _net_text(k),
+                                        k.speed_in, k.speed_out, k.queue_id))
+        return i_structs.SyncPlan(ops)
+
+    def apply_sync_plan(self, plan: i_structs.SyncPlan, batch_size: Optional[int] = None,
+                        checkpoint=None) -> i_structs.SyncStats:
+        """
+        Whole nft table is rendered from state of gateway with plan
+        applied and replaced by one atomic nft -f, so plan is applied
+        in one batch and *batch_size* is not used. Only classes of
+        changed subscribers are touched by tc.
+        """
+        stats = i_structs.SyncStats()
+        start_time = monotonic()
+        round_trips = self.round_trips
+        new_state = dict(self.get_state())
+        tc_replace, tc_remove = [], []
+        for op in plan.pending():
+            net = core.parse_net(op.net)
+            old = new_state.pop(net, None)
+            if op.op == core.SYNC_REMOVE:
+                if old is not None:
+                    tc_remove.append(old)
+                stats.queues_removed += 1
+                stats.ips_removed += 1
+                continue
+            k = i_structs.QueueKey(net[0], net[1], op.speed_in, op.speed_out,
+                                   op.name, op.item_id)
+            if old is not None and old.queue_id != k.queue_id:
+                # gateway was changed after plan was made
+                tc_remove.append(old)
+                old = None
+            if old is None or old[2:4] != k[2:4]:
+                tc_replace.append(k)
+            if op.op == core.SYNC_ADD:
+                stats.queues_added += 1
+                stats.ips_added += 1
+            else:
+                stats.queues_updated += 1
+            new_state[net] = k
+        keys = sorted(new_state.values())
+        self._apply(render_nft_full(keys), tc_replace, tc_remove)
+        self._state = {k[:2]: k for k in keys}
+        plan.position = len(plan)
+        if checkpoint is not None:
+            checkpoint(plan)
+        stats.round_trips = self.round_trips - round_trips
+        stats.wall_time = monotonic() - start_time
+        return stats
+
+    def ping(self, host: str, count=10, arp=False) -> Optional[Tuple[int, int]]:
+        if arp:
+            cmd = ('arping', '-c', str(count), '-w', str(count), '-I', NAS_LINUX_LAN_IFACE, host)
+            regexp = _arping_stat_regexp
+        else:
+            cmd = ('ping', '-4nq', '-c', str(count), '-i', '0.2', '-W', '1', host)
+            regexp = _ping_stat_regexp
+        try:
+            out = self._run(cmd)
+        except core.NasFailedResult:
+            # ping exits with error when there is no replies
+            return
+        m = regexp.search(out)
+        if m is not None:
+            return int(m.group(2)), int(m.group(1))
+
+    def read_users(self) -> i_structs.VectorQueue:
+        return [
+            i_structs.SubnetQueue(
+                name=k.name, network=_net_text(k),
+                max_limit=(k.speed_in / 1000, k.speed_out / 1000),
+                queue_id=k.queue_id
+            ) for k in sorted(self.get_state().values())
+        ]
+
+    def close(self):
+        self._state = None
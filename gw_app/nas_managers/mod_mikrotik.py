@@ -1,10 +1,14 @@
 import binascii
 import re
 import socket
+import struct
+from array import array
 from abc import ABCMeta
 from hashlib import md5
+from threading import Event
+from time import monotonic, time
 from ipaddress import ip_network, _BaseNetwork
-from typing import Iterable, Optional, Tuple, Generator, Dict, Iterator
+from typing import Iterable, Optional, Tuple, Generator, Dict, Iterator, List, Sequence
 
 from django.conf import settings
 from django.utils.translation import ugettext_lazy as _
@@ -14,21 +18,97 @@ from gw_app.nas_managers import structs as i_structs
 
 DEBUG = getattr(settings, 'DEBUG', False)
 
+# Timeout in seconds for each socket operation with gateway
+NAS_SOCKET_TIMEOUT = getattr(settings, 'NAS_SOCKET_TIMEOUT', 30)
+
+# How many tagged commands may be sent to gateway without waiting replies
+NAS_PIPELINE_WINDOW = getattr(settings, 'NAS_PIPELINE_WINDOW', 64)
+
+# Seconds while index of gateway queues and address list is used
+NAS_INDEX_TTL = getattr(settings, 'NAS_INDEX_TTL', 60)
+
+# Seconds while snapshot of gateway state is used since it was read,
+# it is read again earlier when cheap check shows that gateway was changed.
+# The check compares counts only, so edit of item, or remove and add of
+# the same count of items, is not seen in this time. Full sync plans
+# always read gateway again, and sync error drops the snapshot.
+NAS_SNAPSHOT_TTL = getattr(settings, 'NAS_SNAPSHOT_TTL', 60 * 10)
+
+# How many operations of sync plan are sent to gateway between checkpoints
+NAS_SYNC_BATCH_SIZE = getattr(settings, 'NAS_SYNC_BATCH_SIZE', 1000)
+
+# Initial size in bytes of buffer for data received from gateway
+NAS_READ_BUFFER_SIZE = getattr(settings, 'NAS_READ_BUFFER_SIZE', 64 * 1024)
+
 LIST_USERS_ALLOWED = 'DjingUsersAllowed'
 LIST_DEVICES_ALLOWED = 'DjingDevicesAllowed'
 
+# Beginning of trap message when added item is already on gateway
+_TRAP_ALREADY_HAVE = 'failure: already have such'
+
 
 class ApiRos(object):
     """Routeros api"""
     __sk = None
+    _cancelled = None
+    _broken = False
     is_login = False
+    round_trips = 0
+    # received data is in _rbuf[_rstart:_rend]
+    _rbuf = None
+    _rview = None
+    _rstart = 0
+    _rend = 0
 
-    def __init__(self, ip: str, port: int):
+    def __init__(self, ip: str, port: int, timeout=NAS_SOCKET_TIMEOUT):
+        if self._cancelled is None:
+            self._cancelled = Event()
         if self.__sk is None:
             sk = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sk.connect((ip, port or 8728))
+            sk.settimeout(timeout)
+            try:
+                sk.connect((ip, port or 8728))
+            except socket.timeout:
+                sk.close()
+                raise core.NasNetworkError('Connection to %s timed out' % ip)
+            except OSError as e:
+                # refused, unreachable host and others
+                sk.close()
+                raise core.NasNetworkError('Connection to %s failed: %s' % (ip, e))
             self.__sk = sk
 
+    def cancel(self):
+        """
+        Interrupts all current and future operations on socket.
+        Thread safe, blocked recv in other thread is returned immediately.
+        """
+        if self._cancelled is None:
+            self._cancelled = Event()
+        self._cancelled.set()
+        if self.__sk is not None:
+            try:
+                self.__sk.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    @property
+    def is_cancelled(self) -> bool:
+        return self._cancelled is not None and self._cancelled.is_set()
+
+    @property
+    def is_alive(self) -> bool:
+        """
+        False if socket is not opened yet, or if stream of words
+        may be out of sync with gateway after network error
+        """
+        return self.__sk is not None and not self._broken and not self.is_cancelled
+
+    def close(self):
+        if self.__sk is not None:
+            self.__sk.close()
+            self.__sk = None
+        self.is_login = False
+
     def login(self, username, pwd):
         if self.is_login:
             return
@@ -45,41 +125,157 @@ class ApiRos(object):
             pass
         self.is_login = True
 
+    @staticmethod
+    def _parse_sentence(sentence: Sequence[str]) -> Tuple[str, Dict]:
+        reply = sentence[0]
+        attrs = {}
+        for w in sentence[1:]:
+            j = w.find('=', 1)
+            if j == -1:
+                attrs[w] = ''
+            else:
+                attrs[w[:j]] = w[j + 1:]
+        return reply, attrs
+
     def talk_iter(self, words: Iterable):
+        if self.is_cancelled:
+            raise core.NasNetworkError('Operation cancelled')
         if self.write_sentence(words) == 0:
             return
-        while 1:
+        self.round_trips += 1
+        for i in self.iter_sentences():
+            reply, attrs = self._parse_sentence(i)
+            yield (reply, attrs)
+            if reply == '!done':
+                return
+
+    def talk_pipelined(self, sentences: Iterable[Sequence[str]],
+                       window=NAS_PIPELINE_WINDOW) -> List[Dict]:
+        """
+        Send many commands without waiting reply for each of them.
+        Each command is marked with .tag word, and replies are matched
+        back to commands by this tag. No more than *window* commands
+        are in flight at the same time.
+        :param sentences: commands, each of them is a sequence of words
+        :param window: max count of commands that waits its replies
+        :return: list of results in order of commands, each result is
+        dict like {'!re': attrs, '!trap': attrs}. Trap of one command
+        does not interrupt others, it is left in result for caller.
+        """
+        if self.is_cancelled:
+            raise core.NasNetworkError('Operation cancelled')
+        sentences = iter(sentences)
+        results = []
+        in_flight = 0
+        buf = bytearray()
+        exhausted = False
+        while not exhausted or in_flight > 0:
+            # refill pipe when half of window is done, so commands
+            # are sent in large bursts instead of one by one
+            if not exhausted and in_flight <= window // 2:
+                for words in sentences:
+                    tag = len(results)
+                    results.append({})
+                    buf += self.encode_sentence(
+                        tuple(words) + ('.tag=%d' % tag,)
+                    )
+                    in_flight += 1
+                    if in_flight >= window:
+                        break
+                else:
+                    exhausted = True
+                if buf:
+                    self.write_bytes(bytes(buf))
+                    buf.clear()
+                    self.round_trips += 1
+                if in_flight == 0:
+                    break
             i = self.read_sentence()
             if len(i) == 0:
                 continue
-            reply = i[0]
-            attrs = {}
-            for w in i[1:]:
-                j = w.find('=', 1)
-                if j == -1:
-                    attrs[w] = ''
-                else:
-                    attrs[w[:j]] = w[j + 1:]
-            yield (reply, attrs)
+            reply, attrs = self._parse_sentence(i)
+            if reply == '!fatal':
+                raise core.NasFailedResult(attrs.get('=message'))
+            tag = attrs.pop('.tag', None)
+            if tag is None:
+                continue
+            try:
+                res = results[int(tag)]
+            except (ValueError, IndexError):
+                continue
             if reply == '!done':
-                return
+                in_flight -= 1
+                if attrs:
+                    res[reply] = attrs
+            else:
+                res[reply] = attrs or None
+        return results
 
-    def write_sentence(self, words: Iterable):
-        ret = 0
+    @staticmethod
+    def encode_len(l: int) -> bytes:
+        if l < 0x80:
+            return bytes((l,))
+        elif l < 0x4000:
+            l |= 0x8000
+            return bytes(((l >> 8) & 0xff, l & 0xff))
+        elif l < 0x200000:
+            l |= 0xC00000
+            return bytes(((l >> 16) & 0xff, (l >> 8) & 0xff, l & 0xff))
+        elif l < 0x10000000:
+            l |= 0xE0000000
+            return bytes(((l >> 24) & 0xff, (l >> 16) & 0xff,
+                          (l >> 8) & 0xff, l & 0xff))
+        return bytes((0xf0, (l >> 24) & 0xff, (l >> 16) & 0xff,
+                      (l >> 8) & 0xff, l & 0xff))
+
+    @classmethod
+    def encode_sentence(cls, words: Iterable[str]) -> bytes:
+        ret = bytearray()
         for w in words:
-            self.write_word(w)
-            ret += 1
-        self.write_word('')
-        return ret
+            if DEBUG:
+                print("<<< " + w)
+            b = bytes(w, "utf-8")
+            ret += cls.encode_len(len(b))
+            ret += b
+        ret += b'\x00'
+        return bytes(ret)
+
+    def write_sentence(self, words: Iterable):
+        words = tuple(words)
+        self.write_bytes(self.encode_sentence(words))
+        return len(words)
 
     def read_sentence(self):
         r = []
         while 1:
+            # fast path for short words that are already in buffer
+            pos = self._rstart
+            if pos < self._rend:
+                length = self._rbuf[pos]
+                if length < 0x80 and pos + 1 + length <= self._rend:
+                    self._rstart = pos + 1 + length
+                    if length == 0:
+                        return r
+                    w = str(self._rview[pos + 1:self._rstart], 'utf-8')
+                    if DEBUG:
+                        print(">>> " + w)
+                    r.append(w)
+                    continue
             w = self.read_word()
             if w == '':
                 return r
             r.append(w)
 
+    def iter_sentences(self) -> Generator:
+        """
+        Stream of not empty sentences received from gateway.
+        Words are decoded straight from receive buffer.
+        """
+        while 1:
+            r = self.read_sentence()
+            if r:
+                yield r
+
     def write_word(self, w):
         if DEBUG:
             print("<<< " + w)
@@ -88,90 +284,147 @@ class ApiRos(object):
         self.write_bytes(b)
 
     def read_word(self):
-        ret = self.read_bytes(self.read_len()).decode('utf-8')
+        length = self.read_len()
+        self._fill(length)
+        start = self._rstart
+        self._rstart += length
+        ret = str(self._rview[start:start + length], 'utf-8')
         if DEBUG:
             print(">>> " + ret)
         return ret
 
     def write_len(self, l):
-        if l < 0x80:
-            self.write_bytes(bytes((l,)))
-        elif l < 0x4000:
-            l |= 0x8000
-            self.write_bytes(bytes(((l >> 8) & 0xff, l & 0xff)))
-        elif l < 0x200000:
-            l |= 0xC00000
-            self.write_bytes(
-                bytes(((l >> 16) & 0xff, (l >> 8) & 0xff, l & 0xff)))
-        elif l < 0x10000000:
-            l |= 0xE0000000
-            self.write_bytes(bytes(((l >> 24) & 0xff, (l >> 16) & 0xff,
-                                    (l >> 8) & 0xff, l & 0xff)))
-        else:
-            self.write_bytes(bytes((0xf0, (l >> 24) & 0xff, (l >> 16) & 0xff,
-                                    (l >> 8) & 0xff, l & 0xff)))
+        self.write_bytes(self.encode_len(l))
 
     def read_len(self):
-        c = self.read_bytes(1)[0]
+        self._fill(1)
+        buf = self._rbuf
+        pos = self._rstart
+        c = buf[pos]
         if (c & 0x80) == 0x00:
-            pass
+            self._rstart += 1
+            return c
         elif (c & 0xC0) == 0x80:
-            c &= ~0xC0
-            c <<= 8
-            c += self.read_bytes(1)[0]
+            size, c = 2, c & ~0xC0
         elif (c & 0xE0) == 0xC0:
-            c &= ~0xE0
-            c <<= 8
-            c += self.read_bytes(1)[0]
-            c <<= 8
-            c += self.read_bytes(1)[0]
+            size, c = 3, c & ~0xE0
         elif (c & 0xF0) == 0xE0:
-            c &= ~0xF0
-            c <<= 8
-            c += self.read_bytes(1)[0]
-            c <<= 8
-            c += self.read_bytes(1)[0]
-            c <<= 8
-            c += self.read_bytes(1)[0]
-        elif (c & 0xF8) == 0xF0:
-            c = self.read_bytes(1)[0]
-            c <<= 8
-            c += self.read_bytes(1)[0]
-            c <<= 8
-            c += self.read_bytes(1)[0]
-            c <<= 8
-            c += self.read_bytes(1)[0]
+            size, c = 4, c & ~0xF0
+        else:
+            size, c = 5, 0
+        self._fill(size)
+        buf = self._rbuf
+        pos = self._rstart
+        for i in range(pos + 1, pos + size):
+            c = (c << 8) + buf[i]
+        self._rstart += size
         return c
 
     def write_bytes(self, s):
         n = 0
         while n < len(s):
-            r = self.__sk.send(s[n:])
+            try:
+                r = self.__sk.send(s[n:])
+            except socket.timeout:
+                self._broken = True
+                raise core.NasNetworkError('Timed out while sending to gateway')
+            except OSError as e:
+                self._broken = True
+                if self.is_cancelled:
+                    raise core.NasNetworkError('Operation cancelled')
+                raise core.NasNetworkError(e)
             if r == 0:
+                self._broken = True
                 raise core.NasFailedResult("connection closed by remote end")
             n += r
 
-    def read_bytes(self, length):
-        ret = b''
-        while len(ret) < length:
-            s = self.__sk.recv(length - len(ret))
-            if len(s) == 0:
+    def _fill(self, length: int):
+        """
+        Receive from socket until at least *length* bytes is in buffer.
+        Socket is read by large pieces with recv_into, so many small
+        words are decoded from memory without syscall for each of them.
+        """
+        avail = self._rend - self._rstart
+        if avail >= length:
+            return
+        buf = self._rbuf
+        if buf is None or length > len(buf):
+            new_buf = bytearray(max(NAS_READ_BUFFER_SIZE, length * 2))
+            if buf is not None:
+                new_buf[:avail] = self._rview[self._rstart:self._rend]
+            buf = self._rbuf = new_buf
+            self._rview = memoryview(buf)
+            self._rstart, self._rend = 0, avail
+        elif self._rstart + length > len(buf):
+            # move unread tail to the beginning of buffer
+            buf[:avail] = buf[self._rstart:self._rend]
+            self._rstart, self._rend = 0, avail
+        view = self._rview
+        while self._rend - self._rstart < length:
+            try:
+                n = self.__sk.recv_into(view[self._rend:])
+            except socket.timeout:
+                self._broken = True
+                raise core.NasNetworkError('Timed out while waiting for gateway')
+            except OSError as e:
+                self._broken = True
+                if self.is_cancelled:
+                    raise core.NasNetworkError('Operation cancelled')
+                raise core.NasNetworkError(e)
+            if n == 0:
+                self._broken = True
+                if self.is_cancelled:
+                    raise core.NasNetworkError('Operation cancelled')
                 raise core.NasFailedResult("connection closed by remote end")
-            ret += s
-        return ret
+            self._rend += n
+
+    def read_bytes(self, length):
+        self._fill(length)
+        start = self._rstart
+        self._rstart += length
+        return bytes(self._rview[start:start + length])
 
     def __del__(self):
         if self.__sk is not None:
             self.__sk.close()
 
 
+class _GatewayIndex(object):
+    """Ids of queues by name and of allowed addresses by address"""
+    __slots__ = ('queues', 'ips', 'expire_time')
+
+    def __init__(self, ttl: float):
+        self.queues = {}
+        self.ips = {}
+        self.expire_time = monotonic() + ttl
+
+
+def _addr_key(net) -> str:
+    # RouterOS shows host addresses in address list without prefix
+    if net.prefixlen == net.max_prefixlen:
+        return str(net.network_address)
+    return net.with_prefixlen
+
+
+def _key_addr(key: i_structs.QueueKey) -> str:
+    addr = socket.inet_ntoa(struct.pack('!I', key.net))
+    if key.prefix != 32:
+        addr = '%s/%d' % (addr, key.prefix)
+    return addr
+
+
 class MikrotikTransmitter(core.BaseTransmitter, ApiRos,
                           metaclass=type('_ABC_Lazy_mcs',
                                          (ABCMeta, LazyInitMetaclass), {})):
     description = _('Mikrotik NAS')
+    lazy_skip_methods = ('cancel', 'close', 'invalidate_index')
+    _index = None
+    _snapshot = None
+    _snapshot_checked = 0.0
+    _generation = 0
 
     def __init__(self, login: str, password: str, ip: str, port: int,
-                 enabled: bool, *args, **kwargs):
+                 enabled: bool, timeout=NAS_SOCKET_TIMEOUT, *args, **kwargs):
         if not enabled:
             raise core.NasFailedResult(_('Gateway disabled'))
         try:
@@ -181,33 +434,185 @@ class MikrotikTransmitter(core.BaseTransmitter, ApiRos,
                 ip=ip, port=port,
                 *args, **kwargs
             )
-            ApiRos.__init__(self, ip, port)
+            ApiRos.__init__(self, ip, port, timeout)
             self.login(username=login, pwd=password)
         except ConnectionRefusedError:
             raise core.NasNetworkError('Connection to %s is Refused' % ip)
 
+    # After !trap gateway sends !done too, it must be read before raise,
+    # else reply for next command will be taken from stale !done
     def _exec_cmd(self, cmd: Iterable) -> Dict:
         if not isinstance(cmd, (list, tuple)):
             raise TypeError
         r = dict()
+        trap = None
         for k, v in self.talk_iter(cmd):
             if k == '!done':
                 break
             elif k == '!trap':
-                raise core.NasFailedResult(v.get('=message'))
+                trap = v
             r[k] = v or None
+        if trap is not None:
+            self.invalidate_index()
+            raise core.NasFailedResult(trap.get('=message'))
         return r
 
+    def _exec_cmd_ret(self, cmd: Iterable, exist_ok=False) -> Optional[str]:
+        """
+        :param exist_ok: trap about already existing item is not an error
+        :return: value of =ret from !done, it is id of added item
+        """
+        ret = None
+        trap = None
+        for k, v in self.talk_iter(cmd):
+            if k == '!done':
+                ret = v.get('=ret')
+                break
+            elif k == '!trap':
+                trap = v
+        if trap is not None:
+            message = trap.get('=message')
+            if exist_ok and message and message.startswith(_TRAP_ALREADY_HAVE):
+                return None
+            self.invalidate_index()
+            raise core.NasFailedResult(message)
+        return ret
+
     def _exec_cmd_iter(self, cmd: Iterable) -> Generator:
         if not isinstance(cmd, (list, tuple)):
             raise TypeError
+        trap = None
         for k, v in self.talk_iter(cmd):
             if k == '!done':
                 break
             elif k == '!trap':
-                raise core.NasFailedResult(v.get('=message'))
-            if v:
+                trap = v
+            elif v and trap is None:
                 yield v
+        if trap is not None:
+            self.invalidate_index()
+            raise core.NasFailedResult(trap.get('=message'))
+
+    def _exec_cmd_batch(self, cmds: Iterable[Sequence[str]]) -> List[Optional[str]]:
+        """
+        Execute many commands pipelined.
+        :return: list with error message for each failed
+        command and None for each successful command
+        """
+        errors = [
+            r['!trap'].get('=message') if '!trap' in r else None
+            for r in self.talk_pipelined(cmds)
+        ]
+        if any(err is not None for err in errors):
+            self.invalidate_index()
+        return errors
+
+    #################################################
+    #         Index of queues and address list
+    #################################################
+
+    def invalidate_index(self):
+        self._index = None
+        self._snapshot = None
+
+    def _remove_indexed(self, cmd: str, index_name: str, key: str):
+        item_id = getattr(self.get_index(), index_name).get(key)
+        if item_id is None:
+            return
+        try:
+            self._exec_cmd((cmd, '=.id=%s' % item_id))
+        except core.NasFailedResult:
+            # item may be changed by somebody else, then index was
+            # outdated and it is rebuilt after error
+            new_id = getattr(self.get_index(), index_name).get(key)
+            if new_id is None:
+                return
+            if new_id == item_id:
+                raise
+            self._exec_cmd((cmd, '=.id=%s' % new_id))
+        if self._index is not None:
+            getattr(self._index, index_name).pop(key, None)
+
+    def _fill_queue_index(self, index: _GatewayIndex, snapshot: i_structs.GatewaySnapshot):
+        for k in snapshot.queues.values():
+            index.queues[k.name] = k.queue_id
+
+    def get_index(self) -> _GatewayIndex:
+        """
+        Ids of all queues and allowed addresses, made from snapshot
+        of gateway and kept while NAS_INDEX_TTL or until
+        any command returns error
+        """
+        index = self._index
+        if index is not None and index.expire_time > monotonic():
+            return index
+        snapshot = self.get_snapshot()
+        index = _GatewayIndex(NAS_INDEX_TTL)
+        self._fill_queue_index(index, snapshot)
+        for k in snapshot.nets.values():
+            index.ips[_key_addr(k)] = k.queue_id
+        self._index = index
+        return index
+
+    #################################################
+    #            Snapshot of gateway state
+    #################################################
+
+    def read_stamp(self) -> Tuple[int, ...]:
+        """
+        Counts of queues and of address list entries, they are
+        read by one round trip without transfer of items.
+        It does not change on edit of item, see NAS_SNAPSHOT_TTL.
+        """
+        replies = self.talk_pipelined((
+            ('/queue/simple/print', '=count-only='),
+            ('/ip/firewall/address-list/print', '=count-only=', 'where', '?dynamic=no')
+        ))
+        try:
+            return tuple(int(r['!done']['=ret']) for r in replies)
+        except (KeyError, TypeError, ValueError):
+            raise core.NasFailedResult(_('Gateway does not count items'))
+
+    def read_snapshot(self) -> i_structs.GatewaySnapshot:
+        # stamp is read first, so changes made while items are
+        # read are found by next check
+        stamp = self.read_stamp()
+        self._generation += 1
+        return i_structs.GatewaySnapshot(
+            self.read_queue_keys(), self.read_net_keys(LIST_USERS_ALLOWED),
+            stamp, self._generation, time()
+        )
+
+    def get_snapshot(self) -> i_structs.GatewaySnapshot:
+        """
+        Snapshot is checked by stamp not more often than once
+        in NAS_INDEX_TTL, it is read again when stamp is changed,
+        when it is older than NAS_SNAPSHOT_TTL or when any
+        command returned error
+        """
+        snapshot = self._snapshot
+        if snapshot is not None:
+            if monotonic() - self._snapshot_checked < NAS_INDEX_TTL:
+                return snapshot
+            if time() - snapshot.read_time < NAS_SNAPSHOT_TTL and \
+                    self.read_stamp() == snapshot.stamp:
+                self._snapshot_checked = monotonic()
+                return snapshot
+        snapshot = self.read_snapshot()
+        self._snapshot = snapshot
+        self._snapshot_checked = monotonic()
+        return snapshot
+
+    def set_snapshot(self, snapshot: Optional[i_structs.GatewaySnapshot]):
+        self._snapshot = snapshot
+        self._snapshot_checked = 0.0
+        self._index = None
+        if snapshot is not None:
+            self._generation = max(self._generation, snapshot.generation)
+
+    @property
+    def last_snapshot(self) -> Optional[i_structs.GatewaySnapshot]:
+        return self._snapshot
 
     @staticmethod
     def _build_shape_obj(info: Dict) -> i_structs.SubnetQueue:
@@ -262,10 +667,11 @@ class MikrotikTransmitter(core.BaseTransmitter, ApiRos,
         if r:
             return self._build_shape_obj(r.get('!re'))
 
-    def add_queue(self, queue: i_structs.SubnetQueue) -> None:
+    @staticmethod
+    def _add_queue_cmd(queue: i_structs.SubnetQueue) -> Tuple:
         if not isinstance(queue, i_structs.SubnetQueue):
             raise TypeError('queue must be instance of SubnetQueue')
-        return self._exec_cmd((
+        return (
             '/queue/simple/add',
             '=name=%s' % queue.name,
             # FIXME: тут в разных микротиках или =target-addresses или =target
@@ -275,47 +681,111 @@ class MikrotikTransmitter(core.BaseTransmitter, ApiRos,
             '=burst-time=5/5',
             '=burst-limit=%.3fM/%.3fM' % tuple(i * 2 for i in queue.max_limit),
             '=burst-threshold=%.3fM/%.3fM' % tuple(i / 1.2 for i in queue.max_limit)
-        ))
+        )
+
+    def add_queue(self, queue: i_structs.SubnetQueue) -> None:
+        index = self._index
+        queue_id = self._exec_cmd_ret(self._add_queue_cmd(queue))
+        if index is not None and queue_id:
+            index.queues[queue.name] = queue_id
 
     def remove_queue(self, queue: i_structs.SubnetQueue) -> None:
         if not isinstance(queue, i_structs.SubnetQueue):
             raise TypeError
-        if not queue.queue_id:
-            queue = self.find_queue(queue.name)
-        if queue is not None:
-            if queue.queue_id:
-                self._exec_cmd((
-                    '/queue/simple/remove',
-                    '=.id=%s' % queue.queue_id
-                ))
+        if queue.queue_id:
+            self._exec_cmd((
+                '/queue/simple/remove',
+                '=.id=%s' % queue.queue_id
+            ))
+        else:
+            self._remove_indexed('/queue/simple/remove', 'queues', queue.name)
 
     def remove_queue_range(self, q_ids: Iterable[str]):
         ids = ','.join(q_ids)
         if len(ids) > 1:
             self._exec_cmd(('/queue/simple/remove', '=numbers=%s' % ids))
 
+    @staticmethod
+    def _set_queue_cmd(queue: i_structs.SubnetQueue, queue_id: str) -> Tuple:
+        return (
+            '/queue/simple/set',
+            '=name=%s' % queue.name,
+            '=max-limit=%.3fM/%.3fM' % queue.max_limit,
+            # FIXME: тут в разных версиях прошивки микротика
+            # или =target-addresses или =target
+            '=target=%s' % queue.network,
+            '=queue=Djing_pcq_up/Djing_pcq_down',
+            '=burst-time=5/5',
+            '=burst-limit=%.3fM/%.3fM' % tuple(i * 2 for i in queue.max_limit),
+            '=burst-threshold=%.3fM/%.3fM' % tuple(i / 1.2 for i in queue.max_limit),
+            '=numbers=%s' % queue_id
+        )
+
     def update_queue(self, queue: i_structs.SubnetQueue):
         if not isinstance(queue, i_structs.SubnetQueue):
             raise TypeError
-        queue_gw = self.find_queue(queue.name)
-        if queue_gw is None:
+        queue_id = self.get_index().queues.get(queue.name)
+        if queue_id is None:
             return self.add_queue(queue)
-        else:
-            cmd = (
-                '/queue/simple/set',
-                '=name=%s' % queue.name,
-                '=max-limit=%.3fM/%.3fM' % queue.max_limit,
-                # FIXME: тут в разных версиях прошивки микротика
-                # или =target-addresses или =target
-                '=target=%s' % queue.network,
-                '=queue=Djing_pcq_up/Djing_pcq_down',
-                '=burst-time=5/5',
-                '=burst-limit=%.3fM/%.3fM' % tuple(i * 2 for i in queue.max_limit),
-                '=burst-threshold=%.3fM/%.3fM' % tuple(i / 1.2 for i in queue.max_limit),
-                '=numbers=%s' % queue_gw.queue_id
-            )
-            r = self._exec_cmd(cmd)
-            return r
+        try:
+            return self._exec_cmd(self._set_queue_cmd(queue, queue_id))
+        except core.NasFailedResult:
+            # queue may be removed or made again by somebody else,
+            # then index was outdated and it is rebuilt after error
+            new_id = self.get_index().queues.get(queue.name)
+            if new_id is None:
+                return self.add_queue(queue)
+            if new_id == queue_id:
+                raise
+            return self._exec_cmd(self._set_queue_cmd(queue, new_id))
+
+    @staticmethod
+    def _queue_key_cmd(cmd: str, key: i_structs.QueueKey, *args) -> Tuple:
+        max_limit = key.speed_in / 1000, key.speed_out / 1000
+        return (
+            cmd,
+            '=name=%s' % key.name,
+            '=target=%s/%d' % (socket.inet_ntoa(struct.pack('!I', key.net)), key.prefix),
+            '=max-limit=%.3fM/%.3fM' % max_limit,
+            '=queue=Djing_pcq_up/Djing_pcq_down',
+            '=burst-time=5/5',
+            '=burst-limit=%.3fM/%.3fM' % tuple(i * 2 for i in max_limit),
+            '=burst-threshold=%.3fM/%.3fM' % tuple(i / 1.2 for i in max_limit)
+        ) + args
+
+    @staticmethod
+    def _parse_speed_kbit(text_speed: str) -> int:
+        suffix = text_speed[-1:]
+        if suffix == 'M':
+            return int(round(float(text_speed[:-1]) * 1000))
+        elif suffix == 'k':
+            return int(round(float(text_speed[:-1])))
+        elif suffix == 'G':
+            return int(round(float(text_speed[:-1]) * 1000 ** 2))
+        return int(round(float(text_speed) / 1000))
+
+    def read_queue_keys(self) -> Generator:
+        """Compact queues from gateway, only needed fields are requested"""
+        for dat in self._exec_cmd_iter((
+            '/queue/simple/print',
+            '=.proplist=.id,name,target,max-limit'
+        )):
+            target = dat.get('=target')
+            name = dat.get('=name')
+            if not target or not name:
+                continue
+            # target may be '192.168.0.3/32,192.168.0.2/32'
+            target = target.split(',')[0]
+            try:
+                net, prefix = core.parse_net(target)
+                # speeds are written as in/out by _queue_key_cmd
+                speed_in, speed_out = dat.get('=max-limit', '0/0').split('/')
+                yield i_structs.QueueKey(
+                    net, prefix, self._parse_speed_kbit(speed_in),
+                    self._parse_speed_kbit(speed_out), name, dat.get('=.id')
+                )
+            except (ValueError, OSError) as e:
+                print('ValueError:', e)
 
     def read_queue_iter(self) -> Generator:
         for dat in self._exec_cmd_iter(('/queue/simple/print', '=detail')):
@@ -327,15 +797,34 @@ class MikrotikTransmitter(core.BaseTransmitter, ApiRos,
     #         Ip->firewall->address list
     #################################################
 
-    def add_ip(self, list_name: str, net):
+    @staticmethod
+    def _add_ip_cmd(list_name: str, net) -> Tuple:
         if not issubclass(net.__class__, _BaseNetwork):
             raise TypeError
-        commands = (
+        return (
             '/ip/firewall/address-list/add',
             '=list=%s' % list_name,
             '=address=%s' % net
         )
-        return self._exec_cmd(commands)
+
+    def add_ip(self, list_name: str, net, exist_ok=False):
+        index = self._index
+        ip_id = self._exec_cmd_ret(self._add_ip_cmd(list_name, net), exist_ok=exist_ok)
+        if index is not None and ip_id and list_name == LIST_USERS_ALLOWED:
+            index.ips[_addr_key(net)] = ip_id
+
+    def add_ip_range(self, list_name: str, nets: Iterable) -> int:
+        """
+        Add many networks to address list in one pipelined batch
+        :return: count of networks that was failed to add
+        """
+        errors = self._exec_cmd_batch(
+            self._add_ip_cmd(list_name, n) for n in nets
+        )
+        for err in errors:
+            if err is not None:
+                print('Error:', err)
+        return sum(1 for err in errors if err is not None)
 
     def remove_ip(self, mk_id):
         return self._exec_cmd((
@@ -374,31 +863,77 @@ class MikrotikTransmitter(core.BaseTransmitter, ApiRos,
             n.queue_id = dat.get('=.id')
             yield n
 
+    def read_net_keys(self, list_name: str) -> Generator:
+        for dat in self._exec_cmd_iter((
+            '/ip/firewall/address-list/print',
+            '=.proplist=.id,address', 'where',
+            '?list=%s' % list_name,
+            '?dynamic=no'
+        )):
+            try:
+                net, prefix = core.parse_net(dat.get('=address'))
+            except (ValueError, OSError, AttributeError) as e:
+                print('ValueError:', e)
+                continue
+            yield i_structs.QueueKey(net, prefix, 0, 0, '', dat.get('=.id'))
+
     def update_ip(self, net):
+        """
+        Allow network. Index may be outdated when entry was removed
+        by somebody else, so add is always sent and entry that is
+        already in list is not an error
+        """
         if not issubclass(net.__class__, _BaseNetwork):
             raise TypeError
-        res_net_gw = self.find_ip(net, LIST_USERS_ALLOWED)
-        if not res_net_gw:
-            self.add_ip(LIST_USERS_ALLOWED, net)
+        self.add_ip(LIST_USERS_ALLOWED, net, exist_ok=True)
+
+    def remove_allowed_ip(self, net):
+        """Remove network from list of allowed by id from index"""
+        if not issubclass(net.__class__, _BaseNetwork):
+            raise TypeError
+        self._remove_indexed('/ip/firewall/address-list/remove', 'ips',
+                             _addr_key(net))
 
     #################################################
     #         BaseTransmitter implementation
     #################################################
 
+    def add_queue_range(self, queues: Iterable[i_structs.SubnetQueue]) -> int:
+        """
+        Add many queues in one pipelined batch
+        :return: count of queues that was failed to add
+        """
+        errors = self._exec_cmd_batch(
+            self._add_queue_cmd(q) for q in queues
+        )
+        for err in errors:
+            if err is not None:
+                print('Error:', err)
+        return sum(1 for err in errors if err is not None)
+
     def add_user_range(self, queue_list: i_structs.VectorQueue):
-        for q in queue_list:
-            self.add_user(q)
+        queue_list = tuple(queue_list)
+        self.add_queue_range(queue_list)
+        self.add_ip_range(LIST_USERS_ALLOWED, (q.network for q in queue_list))
+        # ids of added items are not known
+        self.invalidate_index()
 
     def remove_user_range(self, queues: i_structs.VectorQueue):
         if not isinstance(queues, (tuple, list, set)):
             raise ValueError('*users* is used twice, generator does not fit')
-        queue_ids = (q.queue_id for q in queues if q)
-        self.remove_queue_range(queue_ids)
-        for q in queues:
-            if isinstance(q, i_structs.SubnetQueue):
-                ip_list_entity = self.find_ip(q.network, LIST_USERS_ALLOWED)
-                if ip_list_entity:
-                    self.remove_ip(ip_list_entity.get('=.id'))
+        index = self.get_index()
+        queues = tuple(q for q in queues if isinstance(q, i_structs.SubnetQueue))
+        queue_ids = tuple(filter(None, (
+            q.queue_id or index.queues.get(q.name) for q in queues
+        )))
+        ip_ids = tuple(filter(None, (
+            index.ips.get(_addr_key(q.network)) for q in queues
+        )))
+        if queue_ids:
+            self.remove_queue_range(queue_ids)
+        if ip_ids:
+            self.remove_ip_range(ip_ids)
+        self.invalidate_index()
 
     def add_user(self, queue: i_structs.SubnetQueue, *args):
         try:
@@ -415,10 +950,7 @@ class MikrotikTransmitter(core.BaseTransmitter, ApiRos,
 
     def remove_user(self, queue: i_structs.SubnetQueue):
         self.remove_queue(queue)
-        r = self.find_ip(queue.network, LIST_USERS_ALLOWED)
-        if r:
-            ip_id = r.get('=.id')
-            self.remove_ip(ip_id)
+        self.remove_allowed_ip(queue.network)
 
     def update_user(self, queue: i_structs.SubnetQueue, *args):
         if queue.is_access:
@@ -426,9 +958,7 @@ class MikrotikTransmitter(core.BaseTransmitter, ApiRos,
             self.update_ip(queue.network)
         else:
             self.remove_queue(queue)
-            res_ips = self.find_ip(queue.network, LIST_USERS_ALLOWED)
-            if res_ips:
-                self.remove_ip(res_ips.get('=.id'))
+            self.remove_allowed_ip(queue.network)
 
     def ping(self, host, count=10, arp=False) -> Optional[Tuple[int, int]]:
         params = [
@@ -456,30 +986,238 @@ class MikrotikTransmitter(core.BaseTransmitter, ApiRos,
     def read_users(self) -> i_structs.VectorQueue:
         return self.read_queue_iter()
 
-    def sync_nas(self, users_from_db: Iterator):
-        queues_from_db = (
-            ab.build_agent_struct() for ab in users_from_db
-            if ab is not None and ab.is_access()
-        )
-        queues_from_db = set(filter(lambda x: x is not None, queues_from_db))
-        queues_from_gw = self.read_queue_iter()
+    def cancel(self):
+        ApiRos.cancel(self)
 
-        user_q_for_add, user_q_for_del = core.diff_set(queues_from_db,
-                                                       set(queues_from_gw))
+    def close(self):
+        ApiRos.close(self)
 
-        self.remove_queue_range(
-            (q.queue_id for q in user_q_for_del)
-        )
-        for q in user_q_for_add:
-            self.add_queue(q)
-        del user_q_for_add, user_q_for_del
-
-        # sync ip addrs list
-        db_nets = set(net.network for net in queues_from_db)
-        gw_nets = set(self.read_nets_iter(LIST_USERS_ALLOWED))
-        nets_add, nets_del = core.diff_set(db_nets, gw_nets)
-        self.remove_ip_range(
-            (q.queue_id for q in nets_del)
+    is_alive = ApiRos.is_alive
+
+    def check_alive(self) -> bool:
+        if not self.is_alive:
+            return False
+        try:
+            self._exec_cmd(('/system/identity/print',))
+            return True
+        except (core.NasNetworkError, core.NasFailedResult):
+            return False
+
+    def sync_nas(self, users_from_db: Iterator) -> i_structs.SyncStats:
+        return self.apply_sync_plan(self.make_sync_plan(users_from_db))
+
+    def make_sync_plan(self, users_from_db: Iterator) -> i_structs.SyncPlan:
+        """
+        Subscribers must be ordered by ip address, queues from gateway
+        are sorted once, then both sorted lists are merged into
+        operations. Removes of queues go first, so added queue
+        does not meet removed queue with the same name.
+        """
+        # networks of users with access, for address list sync
+        db_nets = array('Q')
+
+        def queues_from_db():
+            for k in core.iter_user_keys(users_from_db):
+                db_nets.append(k.net << 8 | k.prefix)
+                yield k
+
+        # full sync repairs changes that stamp does not show,
+        # so gateway is always read for plan
+        self.invalidate_index()
+        ops = self._plan_queues(queues_from_db())
+        ops.extend(self._plan_allowed_nets(db_nets))
+        return i_structs.SyncPlan(ops)
+
+    @staticmethod
+    def _key_op(kind: str, op: str, key: i_structs.QueueKey, item_id=None) -> i_structs.PlanOp:
+        return i_structs.PlanOp(kind, op, key.name, _key_addr(key), key.speed_in,
+                                key.speed_out, item_id)
+
+    def _merge_queue_ops(self, desired: Iterable[i_structs.QueueKey],
+                         actual: Iterable[i_structs.QueueKey]) -> List[i_structs.PlanOp]:
+        removes, changes = [], []
+        for op, d, a in core.merge_diff(desired, actual):
+            if op == core.SYNC_REMOVE:
+                removes.append(self._key_op('queue', op, a, a.queue_id))
+            else:
+                changes.append(self._key_op('queue', op, d, a and a.queue_id))
+        removes.extend(changes)
+        return removes
+
+    def _plan_queues(self, queues_from_db: Iterator[i_structs.QueueKey]) -> List[i_structs.PlanOp]:
+        return self._merge_queue_ops(queues_from_db, self.get_snapshot().sorted_queues())
+
+    def _plan_allowed_nets(self, db_nets: array) -> Generator:
+        def nets_from_db():
+            for n in db_nets:
+                yield i_structs.QueueKey(n >> 8, n & 0xff, 0, 0, '', None)
+
+        nets_from_gw = self.get_snapshot().sorted_nets()
+        for op, d, a in core.merge_diff(nets_from_db(), nets_from_gw):
+            if op == core.SYNC_ADD:
+                yield self._key_op('ip', op, d)
+            else:
+                yield self._key_op('ip', op, a, a.queue_id)
+
+    def _plan_changes(self, queues_for_update: Sequence[i_structs.SubnetQueue],
+                      queues_for_remove: Sequence[i_structs.SubnetQueue]) -> List[i_structs.PlanOp]:
+        """
+        Operations for changed subscribers only, they are compared with
+        snapshot of gateway. Queues of other subscribers are touched
+        only when they take network of changed subscriber.
+        """
+        desired, names, remove_addrs = [], set(), set()
+        for q in queues_for_update:
+            names.add(q.name)
+            try:
+                desired.append(core.make_queue_key(q.name, str(q.network), *q.max_limit))
+            except (OSError, ValueError):
+                print('Skip subscriber %s: %s is not ipv4 address' % (q.name, q.network))
+        for q in queues_for_remove:
+            names.add(q.name)
+            remove_addrs.add(_addr_key(q.network))
+        desired.sort(key=lambda k: k[:2])
+        desired_nets = {k[:2] for k in desired}
+        snapshot = self.get_snapshot()
+        ops = self._merge_queue_ops(desired, sorted((
+            k for k in snapshot.queues.values()
+            if k.name in names or k[:2] in desired_nets
+        ), key=lambda k: k[:2]))
+        allowed = {_key_addr(k): k for k in snapshot.nets.values()}
+        desired_addrs = {_key_addr(k): k for k in desired}
+        for addr in sorted(remove_addrs - desired_addrs.keys()):
+            k = allowed.get(addr)
+            if k is not None:
+                ops.append(self._key_op('ip', core.SYNC_REMOVE, k, k.queue_id))
+        ops.extend(
+            self._key_op('ip', core.SYNC_ADD, k)
+            for addr, k in desired_addrs.items() if addr not in allowed
         )
-        for q in nets_add:
-            self.add_ip(LIST_USERS_ALLOWED, q)
+        return ops
+
+    def sync_changes(self, queues_for_update: i_structs.VectorQueue,
+                     queues_for_remove: i_structs.VectorQueue) -> i_structs.SyncStats:
+        """
+        Changes of all subscribers are sent as one pipelined batch.
+        When some of them fail, snapshot was outdated, it is read
+        again and only operations that are still needed are sent
+        once more.
+        """
+        update, remove = [], list(queues_for_remove)
+        for q in queues_for_update:
+            (update if q.is_access else remove).append(q)
+        plan = i_structs.SyncPlan(self._plan_changes(update, remove))
+        stats = self.apply_sync_plan(plan, batch_size=len(plan))
+        if stats.errors:
+            plan = i_structs.SyncPlan(self._plan_changes(update, remove))
+            retry_stats = self.apply_sync_plan(plan, batch_size=len(plan))
+            errors = retry_stats.errors
+            for f in i_structs.SyncStats.__slots__:
+                setattr(stats, f, getattr(stats, f) + getattr(retry_stats, f))
+            stats.errors = errors
+        return stats
+
+    def _plan_cmd(self, op: i_structs.PlanOp) -> Tuple:
+        if op.kind == 'ip':
+            if op.op == core.SYNC_ADD:
+                return (
+                    '/ip/firewall/address-list/add',
+                    '=list=%s' % LIST_USERS_ALLOWED,
+                    '=address=%s' % op.net
+                )
+            return '/ip/firewall/address-list/remove', '=.id=%s' % op.item_id
+        if op.op == core.SYNC_REMOVE:
+            return '/queue/simple/remove', '=.id=%s' % op.item_id
+        key = core.make_queue_key(op.name, op.net, op.speed_in / 1000,
+                                  op.speed_out / 1000)
+        if op.op == core.SYNC_ADD:
+            return self._queue_key_cmd('/queue/simple/add', key)
+        return self._queue_key_cmd('/queue/simple/set', key, '=.id=%s' % op.item_id)
+
+    def _apply_plan_batch(self, ops: Sequence[i_structs.PlanOp]) -> List[Tuple[Optional[str], Optional[str]]]:
+        """
+        :return: list with pair for each operation, error message or
+        None, and id of added item on gateway
+        """
+        replies = [
+            (r['!trap'].get('=message'), None) if '!trap' in r
+            else (None, r.get('!done', {}).get('=ret'))
+            for r in self.talk_pipelined(self._plan_cmd(op) for op in ops)
+        ]
+        if any(err is not None for err, ret in replies):
+            self.invalidate_index()
+        return replies
+
+    def _update_snapshot(self, op: i_structs.PlanOp, item_id: Optional[str]):
+        """Keep snapshot same as gateway after operation was made"""
+        snapshot = self._snapshot
+        if snapshot is None or op.kind not in ('queue', 'ip'):
+            return
+        if op.op == core.SYNC_REMOVE:
+            snapshot.drop(op.kind, op.item_id)
+            return
+        item_id = item_id or op.item_id
+        if item_id is None:
+            self._snapshot = None
+            return
+        net, prefix = core.parse_net(op.net)
+        snapshot.put(op.kind, i_structs.QueueKey(
+            net, prefix, op.speed_in, op.speed_out, op.name, item_id
+        ))
+
+    def apply_sync_plan(self, plan: i_structs.SyncPlan, batch_size: Optional[int] = None,
+                        checkpoint=None) -> i_structs.SyncStats:
+        """
+        Each batch is sent pipelined. When connection is lost in the
+        middle of batch, the whole batch is repeated on next applying,
+        operations that was already made fail then and are counted
+        as errors only. Snapshot of gateway is changed together with
+        gateway, and it is dropped after any error.
+        """
+        stats = i_structs.SyncStats()
+        start_time = monotonic()
+        round_trips = self.round_trips
+        batch_size = batch_size or NAS_SYNC_BATCH_SIZE
+        while not plan.is_done:
+            ops = plan.ops[plan.position:plan.position + batch_size]
+            try:
+                replies = self._apply_plan_batch(ops)
+            except (core.NasNetworkError, core.NasFailedResult):
+                # part of batch may be made on gateway
+                self.invalidate_index()
+                raise
+            for op, (err, item_id) in zip(ops, replies):
+                if err is None:
+                    self._count_plan_op(stats, op)
+                    self._update_snapshot(op, item_id)
+                else:
+                    print('Error:', err)
+                    stats.errors += 1
+            plan.position += len(ops)
+            if checkpoint is not None:
+                checkpoint(plan)
+        self._index = None
+        if self._snapshot is not None:
+            self._snapshot.stamp = self.read_stamp()
+        stats.round_trips = self.round_trips - round_trips
+        stats.wall_time = monotonic() - start_time
+        return stats
+
+    @classmethod
+    def _count_plan_op(cls, stats: i_structs.SyncStats, op: i_structs.PlanOp):
+        if op.kind == 'queue':
+            cls._count_queue_op(stats, op.op)
+        elif op.kind == 'ip':
+            if op.op == core.SYNC_ADD:
+                stats.ips_added += 1
+            else:
+                stats.ips_removed += 1
+
+    @staticmethod
+    def _count_queue_op(stats: i_structs.SyncStats, op: str):
+        if op == core.SYNC_ADD:
+            stats.queues_added += 1
+        elif op == core.SYNC_UPDATE:
+            stats.queues_updated += 1
+        else:
+            stats.queues_removed += 1
@@ -0,0 +1,325 @@
+import re
+from typing import Iterator, Generator, Optional, Set, Tuple, List, Sequence
+
+from django.utils.translation import ugettext_lazy as _
+from gw_app.nas_managers import core
+from gw_app.nas_managers import structs as i_structs
+from gw_app.nas_managers.mod_mikrotik import (
+    MikrotikTransmitter, _GatewayIndex, _addr_key, _key_addr
+)
+
+SPEED_LIST_PREFIX = 'DjingSpeed_'
+
+_speed_list_regexp = re.compile(r'^%s(\d+)_(\d+)$' % SPEED_LIST_PREFIX)
+_speed_tree_regexp = re.compile(r'^djing_up_(\d+)_(\d+)$')
+
+# speeds of class in kbit/s, (in, out)
+SpeedClass = Tuple[int, int]
+
+
+def speed_list_name(speed: SpeedClass) -> str:
+    return '%s%d_%d' % ((SPEED_LIST_PREFIX,) + speed)
+
+
+def _speed_of(queue: i_structs.SubnetQueue) -> SpeedClass:
+    return tuple(int(round(s * 1000)) for s in queue.max_limit)
+
+
+class MikrotikPcqTransmitter(MikrotikTransmitter):
+    """
+    Subscribers are shaped by one pair of pcq queues for each speed
+    of services. Speed of subscriber is defined by address list it is
+    in, so gateway has no queue for each subscriber.
+    """
+    description = _('Mikrotik NAS with PCQ for each speed')
+    lazy_skip_methods = ('cancel', 'close', 'invalidate_index')
+    _speed_classes = None
+
+    def invalidate_index(self):
+        MikrotikTransmitter.invalidate_index(self)
+        self._speed_classes = None
+
+    #################################################
+    #            Speed classes on gateway
+    #################################################
+
+    @staticmethod
+    def _speed_class_cmds(speed: SpeedClass) -> Generator:
+        up_name, down_name = 'djing_up_%d_%d' % speed, 'djing_down_%d_%d' % speed
+        list_name = speed_list_name(speed)
+        comment = '=comment=djing_speed_%d_%d' % speed
+        yield ('/queue/type/add', '=name=%s' % up_name, '=kind=pcq',
+               '=pcq-rate=%dk' % speed[0], '=pcq-classifier=src-address')
+        yield ('/queue/type/add', '=name=%s' % down_name, '=kind=pcq',
+               '=pcq-rate=%dk' % speed[1], '=pcq-classifier=dst-address')
+        yield ('/ip/firewall/mangle/add', '=chain=forward',
+               '=src-address-list=%s' % list_name, '=action=mark-packet',
+               '=new-packet-mark=%s' % up_name, '=passthrough=no', comment)
+        yield ('/ip/firewall/mangle/add', '=chain=forward',
+               '=dst-address-list=%s' % list_name, '=action=mark-packet',
+               '=new-packet-mark=%s' % down_name, '=passthrough=no', comment)
+        yield ('/queue/tree/add', '=name=%s' % up_name, '=parent=global',
+               '=packet-mark=%s' % up_name, '=queue=%s' % up_name, comment)
+        yield ('/queue/tree/add', '=name=%s' % down_name, '=parent=global',
+               '=packet-mark=%s' % down_name, '=queue=%s' % down_name, comment)
+
+    def get_speed_classes(self) -> Set[SpeedClass]:
+        if self._speed_classes is None:
+            classes = set()
+            for dat in self._exec_cmd_iter(('/queue/tree/print', '=.proplist=name')):
+                m = _speed_tree_regexp.match(dat.get('=name', ''))
+                if m is not None:
+                    classes.add((int(m.group(1)), int(m.group(2))))
+            self._speed_classes = classes
+        return self._speed_classes
+
+    def ensure_speed_class(self, speed: SpeedClass):
+        if speed in self.get_speed_classes():
+            return
+        for cmd in self._speed_class_cmds(speed):
+            self._exec_cmd(cmd)
+        self.get_speed_classes().add(speed)
+
+    def _remove_where(self, path: str, *filters):
+        ids = tuple(dat.get('=.id') for dat in self._exec_cmd_iter(
+            ('%s/print' % path, '=.proplist=.id', 'where') + filters
+        ))
+        if ids:
+            self._exec_cmd(('%s/remove' % path, '=numbers=%s' % ','.join(ids)))
+
+    def remove_speed_class(self, speed: SpeedClass):
+        comment = '?comment=djing_speed_%d_%d' % speed
+        self._remove_where('/queue/tree', comment)
+        self._remove_where('/ip/firewall/mangle', comment)
+        for name in ('djing_up_%d_%d' % speed, 'djing_down_%d_%d' % speed):
+            self._remove_where('/queue/type', '?name=%s' % name)
+        self.get_speed_classes().discard(speed)
+
+    #################################################
+    #   Membership of subscribers in speed classes
+    #################################################
+
+    def _fill_queue_index(self, index: _GatewayIndex, snapshot: i_structs.GatewaySnapshot):
+        # address -> (speed list, id of list entry)
+        for k in snapshot.queues.values():
+            index.queues[_key_addr(k)] = (
+                speed_list_name((k.speed_in, k.speed_out)), k.queue_id
+            )
+
+    def add_queue(self, queue: i_structs.SubnetQueue) -> None:
+        if not isinstance(queue, i_structs.SubnetQueue):
+            raise TypeError('queue must be instance of SubnetQueue')
+        speed = _speed_of(queue)
+        self.ensure_speed_class(speed)
+        index = self._index
+        list_name = speed_list_name(speed)
+        entry_id = self._exec_cmd_ret((
+            '/ip/firewall/address-list/add',
+            '=list=%s' % list_name,
+            '=address=%s' % _addr_key(queue.network),
+            '=comment=%s' % queue.name
+        ))
+        if index is not None and entry_id:
+            index.queues[_addr_key(queue.network)] = (list_name, entry_id)
+
+    def remove_queue(self, queue: i_structs.SubnetQueue) -> None:
+        if not isinstance(queue, i_structs.SubnetQueue):
+            raise TypeError
+        addr = _addr_key(queue.network)
+        member = self.get_index().queues.get(addr)
+        if member is None:
+            return
+        self._exec_cmd(('/ip/firewall/address-list/remove', '=.id=%s' % member[1]))
+        if self._index is not None:
+            self._index.queues.pop(addr, None)
+
+    def update_queue(self, queue: i_structs.SubnetQueue):
+        if not isinstance(queue, i_structs.SubnetQueue):
+            raise TypeError
+        addr = _addr_key(queue.network)
+        member = self.get_index().queues.get(addr)
+        if member is None:
+            return self.add_queue(queue)
+        speed = _speed_of(queue)
+        list_name = speed_list_name(speed)
+        if member[0] == list_name:
+            return
+        self.ensure_speed_class(speed)
+        self._exec_cmd((
+            '/ip/firewall/address-list/set', '=.id=%s' % member[1],
+            '=list=%s' % list_name, '=comment=%s' % queue.name
+        ))
+        if self._index is not None:
+            self._index.queues[addr] = (list_name, member[1])
+
+    def remove_queue_range(self, q_ids):
+        ids = ','.join(q_ids)
+        if len(ids) > 1:
+            self._exec_cmd(('/ip/firewall/address-list/remove', '=numbers=%s' % ids))
+
+    def remove_user_range(self, queues: i_structs.VectorQueue):
+        if not isinstance(queues, (tuple, list, set)):
+            raise ValueError('*users* is used twice, generator does not fit')
+        index = self.get_index()
+        addrs = tuple(_addr_key(q.network) for q in queues
+                      if isinstance(q, i_structs.SubnetQueue))
+        # speed membership and access are both address list entries
+        ids = [index.queues[a][1] for a in addrs if a in index.queues]
+        ids.extend(index.ips[a] for a in addrs if a in index.ips)
+        if ids:
+            self.remove_queue_range(ids)
+        self.invalidate_index()
+
+    def find_queue(self, name: str) -> Optional[i_structs.SubnetQueue]:
+        r = self._exec_cmd((
+            '/ip/firewall/address-list/print', 'where', '?comment=%s' % name
+        ))
+        if r:
+            return self._build_member(r.get('!re'))
+
+    @staticmethod
+    def _build_member(info) -> Optional[i_structs.SubnetQueue]:
+        m = _speed_list_regexp.match(info.get('=list', ''))
+        if m is None:
+            return
+        try:
+            return i_structs.SubnetQueue(
+                name=info.get('=comment'),
+                network=info.get('=address'),
+                max_limit=(int(m.group(1)) / 1000, int(m.group(2)) / 1000),
+                is_access=info.get('=disabled') != 'true',
+                queue_id=info.get('=.id')
+            )
+        except ValueError as e:
+            print('ValueError:', e)
+
+    def read_queue_keys(self) -> Generator:
+        for dat in self._exec_cmd_iter((
+            '/ip/firewall/address-list/print',
+            '=.proplist=.id,list,address,comment', 'where', '?dynamic=no'
+        )):
+            m = _speed_list_regexp.match(dat.get('=list', ''))
+            if m is None:
+                continue
+            try:
+                net, prefix = core.parse_net(dat.get('=address'))
+            except (ValueError, OSError, AttributeError) as e:
+                print('ValueError:', e)
+                continue
+            yield i_structs.QueueKey(net, prefix, int(m.group(1)), int(m.group(2)),
+                                     dat.get('=comment', ''), dat.get('=.id'))
+
+    def read_queue_iter(self) -> Generator:
+        for dat in self._exec_cmd_iter((
+            '/ip/firewall/address-list/print', 'where', '?dynamic=no'
+        )):
+            q = self._build_member(dat)
+            if q is not None:
+                yield q
+
+    def _plan_queues(self, queues_from_db: Iterator[i_structs.QueueKey]) -> List[i_structs.PlanOp]:
+        """
+        Membership of subscribers is changed first, then shaping for
+        new speeds is created and shaping of not used speeds is
+        removed. Traffic of new members is not shaped only while
+        plan is applied.
+        """
+        used_classes = set()
+
+        def desired():
+            # classes of members that was not changed are used too
+            for k in queues_from_db:
+                used_classes.add((k.speed_in, k.speed_out))
+                yield k
+
+        ops = MikrotikTransmitter._plan_queues(self, desired())
+        classes = self.get_speed_classes()
+        ops.extend(
+            i_structs.PlanOp('class', core.SYNC_ADD, speed_list_name(speed),
+                             '', speed[0], speed[1], None)
+            for speed in sorted(used_classes - classes)
+        )
+        ops.extend(
+            i_structs.PlanOp('class', core.SYNC_REMOVE, speed_list_name(speed),
+                             '', speed[0], speed[1], None)
+            for speed in sorted(classes - used_classes)
+        )
+        return ops
+
+    def _plan_changes(self, queues_for_update: Sequence[i_structs.SubnetQueue],
+                      queues_for_remove: Sequence[i_structs.SubnetQueue]) -> List[i_structs.PlanOp]:
+        # not used speed classes are removed by full sync only
+        ops = MikrotikTransmitter._plan_changes(self, queues_for_update, queues_for_remove)
+        speeds = {(op.speed_in, op.speed_out) for op in ops
+                  if op.kind == 'queue' and op.op != core.SYNC_REMOVE}
+        ops.extend(
+            i_structs.PlanOp('class', core.SYNC_ADD, speed_list_name(speed),
+                             '', speed[0], speed[1], None)
+            for speed in sorted(speeds - self.get_speed_classes())
+        )
+        return ops
+
+    def _plan_cmd(self, op: i_structs.PlanOp) -> Tuple:
+        if op.kind != 'queue':
+            return MikrotikTransmitter._plan_cmd(self, op)
+        if op.op == core.SYNC_ADD:
+            return (
+                '/ip/firewall/address-list/add',
+                '=list=%s' % speed_list_name((op.speed_in, op.speed_out)),
+                '=address=%s' % op.net,
+                '=comment=%s' % op.name
+            )
+        elif op.op == core.SYNC_UPDATE:
+            return (
+                '/ip/firewall/address-list/set', '=.id=%s' % op.item_id,
+                '=list=%s' % speed_list_name((op.speed_in, op.speed_out)),
+                '=comment=%s' % op.name
+            )
+        return '/ip/firewall/address-list/remove', '=.id=%s' % op.item_id
+
+    def _apply_plan_batch(self, ops: Sequence[i_structs.PlanOp]) -> List[Tuple[Optional[str], Optional[str]]]:
+        # speed class is many objects on gateway, so it is
+        # made by separate commands and not pipelined
+        replies = iter(MikrotikTransmitter._apply_plan_batch(
+            self, [op for op in ops if op.kind != 'class']
+        ))
+        result = []
+        for op in ops:
+            if op.kind != 'class':
+                result.append(next(replies))
+                continue
+            speed = op.speed_in, op.speed_out
+            try:
+                if op.op == core.SYNC_ADD:
+                    self.ensure_speed_class(speed)
+                else:
+                    self.remove_speed_class(speed)
+                result.append((None, None))
+            except core.NasFailedResult as e:
+                self.invalidate_index()
+                result.append((str(e), None))
+        return result
+
+    def convert_from_simple_queues(self) -> i_structs.SyncStats:
+        """
+        Move subscribers from simple queues, which was made by
+        MikrotikTransmitter, into address lists of speed classes.
+        Simple queues are removed when all subscribers are moved.
+        """
+        simple_queues = sorted((
+            k for k in MikrotikTransmitter.read_queue_keys(self)
+            if k.name.startswith('uid')
+        ), key=lambda k: k[:2])
+        stats = self.apply_sync_plan(
+            i_structs.SyncPlan(self._plan_queues(iter(simple_queues)))
+        )
+        if stats.errors == 0:
+            q_ids = [k.queue_id for k in simple_queues]
+            for i in range(0, len(q_ids), 1000):
+                self._exec_cmd((
+                    '/queue/simple/remove',
+                    '=numbers=%s' % ','.join(q_ids[i:i + 1000])
+                ))
+            stats.queues_removed += len(q_ids)
+        self.invalidate_index()
+        return stats
@@ -0,0 +1,136 @@
+from contextlib import contextmanager
+from threading import Lock
+from time import monotonic
+from typing import Dict
+
+from django.conf import settings
+from gw_app.nas_managers.core import BaseTransmitter, NasNetworkError
+
+# Session that is not used this count of seconds is closed
+NAS_POOL_IDLE_TIMEOUT = getattr(settings, 'NAS_POOL_IDLE_TIMEOUT', 300)
+
+# Session that is not used this count of seconds is checked before use
+NAS_POOL_CHECK_INTERVAL = getattr(settings, 'NAS_POOL_CHECK_INTERVAL', 30)
+
+
+class _NasSession(object):
+    __slots__ = ('key', 'mngr', 'lock', 'last_used')
+
+    def __init__(self, key: tuple):
+        self.key = key
+        self.mngr = None
+        self.lock = Lock()
+        self.last_used = monotonic()
+
+    def close(self):
+        if self.mngr is not None:
+            self.mngr.close()
+            self.mngr = None
+
+
+class NasSessionPool(object):
+    """
+    Process wide pool of logged in gateway connections.
+    One connection for each gateway, it is used by one thread at a time.
+    Connection is reopened when gateway settings was changed, when it is
+    broken, or when it does not respond on check after long idle.
+    """
+
+    def __init__(self, idle_timeout=NAS_POOL_IDLE_TIMEOUT,
+                 check_interval=NAS_POOL_CHECK_INTERVAL):
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        self._sessions = {}  # type: Dict[int, _NasSession]
+        self._lock = Lock()
+
+    @staticmethod
+    def _make_key(nas) -> tuple:
+        return (nas.nas_type, nas.ip_address, int(nas.ip_port),
+                nas.auth_login, nas.auth_passw, bool(nas.enabled))
+
+    @staticmethod
+    def _connect(nas) -> BaseTransmitter:
+        klass = nas.get_nas_manager_klass()
+        # tcp connection is a check of availability, so ping is not needed
+        return klass(
+            login=nas.auth_login,
+            password=nas.auth_passw,
+            ip=nas.ip_address,
+            port=int(nas.ip_port),
+            enabled=bool(nas.enabled),
+            check_ping=False
+        )
+
+    def _get_session(self, nas) -> _NasSession:
+        key = self._make_key(nas)
+        with self._lock:
+            sess = self._sessions.get(nas.pk)
+            if sess is None or sess.key != key:
+                # settings of gateway was changed, old session is closed
+                # by thread that uses it now or by expire_idle
+                sess = _NasSession(key)
+                self._sessions[nas.pk] = sess
+            return sess
+
+    def _is_healthy(self, sess: _NasSession) -> bool:
+        mngr = sess.mngr
+        if not mngr.is_alive:
+            return False
+        if monotonic() - sess.last_used < self.check_interval:
+            return True
+        return mngr.check_alive()
+
+    @contextmanager
+    def session(self, nas):
+        """
+        Gives logged in manager of gateway for exclusive use
+        :param nas: instance of gw_app.models.NASModel
+        """
+        self.expire_idle()
+        sess = self._get_session(nas)
+        with sess.lock:
+            if sess.mngr is not None and not self._is_healthy(sess):
+                sess.close()
+            if sess.mngr is None:
+                sess.mngr = self._connect(nas)
+            try:
+                yield sess.mngr
+            except (NasNetworkError, ConnectionResetError):
+                sess.close()
+                raise
+            finally:
+                sess.last_used = monotonic()
+                if sess.mngr is not None and not sess.mngr.is_alive:
+                    sess.close()
+                with self._lock:
+                    if self._sessions.get(nas.pk) is not sess:
+                        sess.close()
+
+    def expire_idle(self):
+        """Closes sessions which was not used more than idle_timeout"""
+        now = monotonic()
+        with self._lock:
+            expired = [
+                (nas_id, sess) for nas_id, sess in self._sessions.items()
+                if now - sess.last_used > self.idle_timeout
+            ]
+            for nas_id, sess in expired:
+                # session is in use now
+                if not sess.lock.acquire(blocking=False):
+                    continue
+                try:
+                    sess.close()
+                    del self._sessions[nas_id]
+                finally:
+                    sess.lock.release()
+
+    def close_all(self):
+        with self._lock:
+            sessions = tuple(self._sessions.values())
+            self._sessions.clear()
+        for sess in sessions:
+            with sess.lock:
+                sess.close()
+
+
+nas_pool = NasSessionPool()
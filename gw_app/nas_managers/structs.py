@@ -1,6 +1,9 @@
+import json
+import zlib
 from abc import ABCMeta
+from collections import namedtuple
 from ipaddress import ip_network, _BaseNetwork
-from typing import Iterable
+from typing import Iterable, List, Optional
 
 
 class BaseStruct(object, metaclass=ABCMeta):
@@ -60,3 +63,130 @@ class SubnetQueue(BaseStruct):
 
 
 VectorQueue = Iterable[SubnetQueue]
+
+
+# Compact view of queue for reconciliation of large lists.
+# net is integer value of network address, speeds are in kbit/s,
+# queue_id is id of object on gateway when it is known
+QueueKey = namedtuple('QueueKey', ('net', 'prefix', 'speed_in', 'speed_out',
+                                   'name', 'queue_id'))
+
+
+# One change on gateway in plan of sync. kind is 'queue' or 'ip', op is
+# core.SYNC_ADD, SYNC_REMOVE or SYNC_UPDATE, net is network in text view,
+# item_id is id of changed object on gateway. Other kinds of operations
+# may be used by gateway managers for their own objects.
+PlanOp = namedtuple('PlanOp', ('kind', 'op', 'name', 'net', 'speed_in',
+                               'speed_out', 'item_id'))
+
+
+class SyncPlan(BaseStruct):
+    """
+    Operations that turns gateway into state from db. Plan is computed
+    once and applied by batches, *position* is count of applied
+    operations, so applying may be continued after failure.
+    """
+    __slots__ = ('ops', 'position')
+
+    def __init__(self, ops: Iterable = (), position=0):
+        super().__init__()
+        self.ops = [PlanOp(*op) for op in ops]
+        self.position = position
+
+    @property
+    def is_done(self) -> bool:
+        return self.position >= len(self.ops)
+
+    def pending(self):
+        return self.ops[self.position:]
+
+    def to_list(self) -> list:
+        """Operations in view for json"""
+        return [list(op) for op in self.ops]
+
+    def __len__(self):
+        return len(self.ops)
+
+    def __repr__(self):
+        return 'plan %d/%d' % (self.position, len(self.ops))
+
+
+class SyncStats(BaseStruct):
+    """Counters of changes that was made on gateway while sync"""
+    __slots__ = ('queues_added', 'queues_removed', 'queues_updated',
+                 'ips_added', 'ips_removed', 'errors', 'round_trips',
+                 'wall_time')
+
+    def __init__(self):
+        super().__init__()
+        self.queues_added = 0
+        self.queues_removed = 0
+        self.queues_updated = 0
+        self.ips_added = 0
+        self.ips_removed = 0
+        self.errors = 0
+        self.round_trips = 0
+        self.wall_time = 0.0
+
+    def __repr__(self):
+        return ("queues +%d -%d ~%d, ips +%d -%d, %d errors, "
+                "%d round trips, %.3f sec") % (
+            self.queues_added, self.queues_removed, self.queues_updated,
+            self.ips_added, self.ips_removed, self.errors,
+            self.round_trips, self.wall_time
+        )
+
+
+class GatewaySnapshot(BaseStruct):
+    """
+    Queues and allowed networks that was read from gateway, they are
+    kept by ids of items on gateway. *stamp* is result of cheap check
+    of gateway, snapshot is valid while gateway returns the same stamp.
+    *generation* is increased on each change of snapshot.
+    """
+    __slots__ = ('queues', 'nets', 'stamp', 'generation', 'read_time')
+
+    def __init__(self, queues: Iterable, nets: Iterable, stamp: tuple,
+                 generation=1, read_time=0.0):
+        super().__init__()
+        self.queues = {k[5]: QueueKey(*k) for k in queues}
+        self.nets = {k[5]: QueueKey(*k) for k in nets}
+        self.stamp = tuple(stamp)
+        self.generation = generation
+        # unix time of full read of gateway
+        self.read_time = read_time
+
+    def sorted_queues(self) -> List[QueueKey]:
+        return sorted(self.queues.values(), key=lambda k: k[:2])
+
+    def sorted_nets(self) -> List[QueueKey]:
+        return sorted(self.nets.values(), key=lambda k: k[:2])
+
+    def put(self, kind: str, key: QueueKey):
+        """Add or replace item, key.queue_id is id of item on gateway"""
+        items = self.queues if kind == 'queue' else self.nets
+        items[key.queue_id] = key
+        self.generation += 1
+
+    def drop(self, kind: str, item_id: str):
+        items = self.queues if kind == 'queue' else self.nets
+        items.pop(item_id, None)
+        self.generation += 1
+
+    def pack(self) -> bytes:
+        return zlib.compress(json.dumps((
+            list(self.queues.values()), list(self.nets.values()),
+            self.stamp, self.generation, self.read_time
+        ), separators=(',', ':')).encode())
+
+    @classmethod
+    def unpack(cls, data: bytes) -> Optional['GatewaySnapshot']:
+        try:
+            return cls(*json.loads(zlib.decompress(data).decode()))
+        except (ValueError, TypeError, zlib.error):
+            return None
+
+    def __repr__(self):
+        return 'snapshot %d: %d queues, %d nets' % (
+            self.generation, len(self.queues), len(self.nets)
+        )
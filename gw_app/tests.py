@@ -1,13 +1,26 @@
+import asyncio
+import socket
 from abc import ABCMeta
+from threading import Event
+from time import monotonic
+from unittest import mock
 
 from abonapp.models import Abon
 from accounts_app.models import UserProfile
 from django.conf import settings
 from django.shortcuts import resolve_url
-from django.test import TestCase, override_settings
+from django.test import TestCase, SimpleTestCase, override_settings
 from group_app.models import Group
 from gw_app.models import NASModel
-from gw_app.nas_managers import MikrotikTransmitter
+from gw_app.nas_managers import MikrotikTransmitter, MikrotikPcqTransmitter, SubnetQueue
+from gw_app.nas_managers.mod_mikrotik import ApiRos
+from gw_app.nas_managers.aio_mikrotik import AsyncApiRos
+from gw_app.nas_managers.pool import NasSessionPool
+from gw_app.nas_managers.fake_ros import FakeRouterOS, load_queues
+from gw_app.nas_managers import mod_linux
+from gw_app.nas_managers import NasNetworkError, NasFailedResult, core
+from gw_app.nas_managers.structs import SyncPlan, GatewaySnapshot
+from djing.lib import icmp
 
 
 class MyBaseTestCase(metaclass=ABCMeta):
@@ -226,3 +239,716 @@ class NASModelTestCase(MyBaseTestCase, TestCase):
         self.assertIs(r, MikrotikTransmitter)
         r = self.nas.get_nas_manager()
         self.assertIsInstance(r, MikrotikTransmitter)
+
+
+class ApiRosProtocolTestCase(SimpleTestCase):
+    def setUp(self):
+        self.api = ApiRos.__new__(ApiRos)
+        self.sk, self.gw_sk = socket.socketpair()
+        self.sk.settimeout(5)
+        self.api._ApiRos__sk = self.sk
+
+    def tearDown(self):
+        self.gw_sk.close()
+
+    def test_replies_matched_by_tag(self):
+        # gateway replies not in order of commands
+        self.gw_sk.sendall(
+            ApiRos.encode_sentence(('!trap', '.tag=1', '=message=failure: already have such address')) +
+            ApiRos.encode_sentence(('!done', '.tag=1')) +
+            ApiRos.encode_sentence(('!done', '.tag=2', '=ret=*3')) +
+            ApiRos.encode_sentence(('!done', '.tag=0', '=ret=*1'))
+        )
+        res = self.api.talk_pipelined((
+            ('/ip/firewall/address-list/add', '=address=10.0.0.1'),
+            ('/ip/firewall/address-list/add', '=address=10.0.0.2'),
+            ('/ip/firewall/address-list/add', '=address=10.0.0.3'),
+        ), window=2)
+        self.assertEqual(len(res), 3)
+        self.assertNotIn('!trap', res[0])
+        self.assertEqual(res[1]['!trap']['=message'], 'failure: already have such address')
+        self.assertNotIn('!trap', res[2])
+
+    def test_encode_len(self):
+        for l in (0x7f, 0x80, 0x3fff, 0x4000, 0x1fffff, 0x200000, 0xfffffff, 0x10000000):
+            self.gw_sk.sendall(ApiRos.encode_len(l))
+            self.assertEqual(self.api.read_len(), l)
+
+    def test_read_sentences(self):
+        long_word = '=comment=' + 'x' * 20000
+        self.gw_sk.sendall(
+            ApiRos.encode_sentence(('!re', '=name=uid1', long_word)) +
+            ApiRos.encode_sentence(('!re', '=name=uid2')) +
+            ApiRos.encode_sentence(('!done',))
+        )
+        sentences = self.api.iter_sentences()
+        self.assertEqual(next(sentences), ['!re', '=name=uid1', long_word])
+        self.assertEqual(next(sentences), ['!re', '=name=uid2'])
+        self.assertEqual(next(sentences), ['!done'])
+
+
+class AsyncApiRosTestCase(SimpleTestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.sk, self.gw_sk = socket.socketpair()
+        self.api = AsyncApiRos('127.0.0.1', 8728, timeout=5)
+
+    def tearDown(self):
+        self.api.close()
+        self.loop.run_until_complete(self.api.wait_closed())
+        self.loop.close()
+        self.gw_sk.close()
+
+    async def _connect(self):
+        self.api._reader, self.api._writer = await asyncio.open_connection(sock=self.sk)
+        self.api._read_task = asyncio.ensure_future(self.api._read_loop())
+
+    def test_concurrent_commands(self):
+        async def run():
+            await self._connect()
+            tasks = [
+                asyncio.ensure_future(self.api.exec_cmd_list(('/queue/simple/print',))),
+                asyncio.ensure_future(self.api.exec_cmd(('/ip/firewall/address-list/add',)))
+            ]
+            # both commands are sent before any reply
+            await asyncio.sleep(0.01)
+            self.gw_sk.sendall(
+                ApiRos.encode_sentence(('!done', '.tag=1', '=ret=*5')) +
+                ApiRos.encode_sentence(('!re', '.tag=0', '=name=uid1')) +
+                ApiRos.encode_sentence(('!done', '.tag=0'))
+            )
+            return await asyncio.gather(*tasks)
+
+        queues, add_res = self.loop.run_until_complete(run())
+        self.assertEqual(queues, [{'=name': 'uid1'}])
+        self.assertEqual(add_res['!done'], {'=ret': '*5'})
+        self.assertEqual(self.api.round_trips, 2)
+
+    def test_closed_connection_fails_commands(self):
+        async def run():
+            await self._connect()
+            task = asyncio.ensure_future(self.api.exec_cmd(('/queue/simple/print',)))
+            await asyncio.sleep(0.01)
+            self.gw_sk.close()
+            return await task
+
+        with self.assertRaises(core.NasFailedResult):
+            self.loop.run_until_complete(run())
+        self.assertFalse(self.api.is_alive)
+
+
+class _FakeManager(object):
+    def __init__(self):
+        self.is_alive = True
+        self.checks = 0
+
+    def check_alive(self):
+        self.checks += 1
+        return self.is_alive
+
+    def close(self):
+        self.is_alive = False
+
+
+class _FakePool(NasSessionPool):
+    connects = 0
+
+    def _connect(self, nas):
+        self.connects += 1
+        return _FakeManager()
+
+
+class NasSessionPoolTestCase(SimpleTestCase):
+    def setUp(self):
+        self.nas = NASModel(
+            pk=1, title='nas', ip_address='192.168.8.12', ip_port=8728,
+            auth_login='admin', auth_passw='admin', nas_type='mktk'
+        )
+        self.pool = _FakePool(idle_timeout=300, check_interval=30)
+
+    def test_reuse_session(self):
+        with self.pool.session(self.nas) as m1:
+            pass
+        with self.pool.session(self.nas) as m2:
+            pass
+        self.assertIs(m1, m2)
+        self.assertEqual(self.pool.connects, 1)
+        self.assertEqual(m2.checks, 0)
+
+    def test_reconnect_after_network_error(self):
+        with self.assertRaises(NasNetworkError):
+            with self.pool.session(self.nas) as m1:
+                raise NasNetworkError('Timed out')
+        self.assertFalse(m1.is_alive)
+        with self.pool.session(self.nas) as m2:
+            pass
+        self.assertIsNot(m1, m2)
+        self.assertEqual(self.pool.connects, 2)
+
+    def test_check_after_idle(self):
+        self.pool.check_interval = 0
+        with self.pool.session(self.nas):
+            pass
+        with self.pool.session(self.nas) as m:
+            pass
+        self.assertEqual(m.checks, 1)
+        self.assertEqual(self.pool.connects, 1)
+
+    def test_changed_settings(self):
+        with self.pool.session(self.nas) as m1:
+            pass
+        self.nas.auth_passw = 'new'
+        with self.pool.session(self.nas) as m2:
+            pass
+        self.assertIsNot(m1, m2)
+
+    def test_idle_expire(self):
+        with self.pool.session(self.nas) as m:
+            pass
+        self.pool.idle_timeout = -1
+        self.pool.expire_idle()
+        self.assertFalse(m.is_alive)
+
+
+class _StubSyncJob(object):
+    """Job for periodic.sync_gateways, behaviour is taken from nas title"""
+
+    def __init__(self, nas):
+        self.nas = nas
+        self.cancelled = False
+        self.start_time = None
+        self._cancel_event = Event()
+
+    def __call__(self):
+        self.start_time = monotonic()
+        if self.nas == 'hang':
+            # like a socket that is shut down by cancel
+            if not self._cancel_event.wait(10):
+                return 'not cancelled'
+            raise NasNetworkError('cancelled')
+        if self.nas == 'broken':
+            raise ValueError('unexpected')
+        if self.nas == 'refused':
+            raise NasNetworkError('refused')
+        return 'ok'
+
+    def is_expired(self, timeout: float) -> bool:
+        return self.start_time is not None and monotonic() - self.start_time > timeout
+
+    def cancel(self):
+        self.cancelled = True
+        self._cancel_event.set()
+
+
+class SyncGatewaysTestCase(SimpleTestCase):
+    def test_errors_and_deadline(self):
+        from periodic import sync_gateways
+        start = monotonic()
+        results = sync_gateways(
+            ('broken', 'hang', 'refused', 'good'), workers=2,
+            timeout=0.5, job_class=_StubSyncJob
+        )
+        self.assertLess(monotonic() - start, 5)
+        self.assertIsInstance(results['broken'], ValueError)
+        self.assertIsInstance(results['hang'], NasNetworkError)
+        self.assertIsInstance(results['refused'], NasNetworkError)
+        self.assertEqual(results['good'], 'ok')
+
+    def test_connection_refused(self):
+        sk = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sk.bind(('127.0.0.1', 0))
+        port = sk.getsockname()[1]
+        # port is not listened, so connection is refused
+        sk.close()
+        with self.assertRaises(NasNetworkError):
+            ApiRos('127.0.0.1', port)
+
+
+class _FakePingProcess(object):
+    def __init__(self, out: str):
+        self.out = out.encode()
+
+    def communicate(self):
+        return self.out, None
+
+
+class IcmpTestCase(SimpleTestCase):
+    def test_checksum(self):
+        # example from RFC 1071
+        self.assertEqual(icmp._checksum(b'\x00\x01\xf2\x03\xf4\xf5\xf6\xf7'), 0x220d)
+        # odd length is padded by zero byte
+        self.assertEqual(icmp._checksum(b'\x01'), icmp._checksum(b'\x01\x00'))
+
+    def test_echo_request(self):
+        packet = icmp._make_echo_request(5, 7)
+        self.assertEqual(packet[:2], bytes((icmp.ICMP_ECHO_REQUEST, 0)))
+        self.assertEqual(packet[4:8], b'\x00\x05\x00\x07')
+        # checksum of packet with its checksum is zero
+        self.assertEqual(icmp._checksum(packet), 0)
+
+    def test_make_result(self):
+        r = icmp._make_result('10.0.0.1', 2, [])
+        self.assertFalse(r)
+        self.assertEqual(r.loss, 1.0)
+        self.assertIsNone(r.rtt_avg)
+        r = icmp._make_result('10.0.0.1', 3, [1.0, 3.0])
+        self.assertTrue(r)
+        self.assertEqual((r.rtt_min, r.rtt_avg, r.rtt_max), (1.0, 2.0, 3.0))
+        self.assertAlmostEqual(r.loss, 1 / 3)
+
+    def test_parse_ping_output(self):
+        outputs = {
+            '10.0.0.1': '3 packets transmitted, 2 received, 33% packet loss, time 2003ms\n'
+                        'rtt min/avg/max/mdev = 0.045/0.050/0.055/0.004 ms\n',
+            # busybox
+            '10.0.0.2': '3 packets transmitted, 0 packets received, 100% packet loss\n',
+            '10.0.0.3': 'ping: unknown host\n',
+        }
+
+        def popen(args, **kwargs):
+            host = args[-1]
+            if host == '10.0.0.4':
+                raise OSError('no ping')
+            return _FakePingProcess(outputs[host])
+
+        with mock.patch.object(icmp.subprocess, 'Popen', popen):
+            res = icmp._probe_subprocess(('10.0.0.1', '10.0.0.2', '10.0.0.3', '10.0.0.4'), 3, 1.0)
+        r = res['10.0.0.1']
+        self.assertEqual((r.sent, r.received), (3, 2))
+        self.assertEqual((r.rtt_min, r.rtt_avg, r.rtt_max), (0.045, 0.05, 0.055))
+        r = res['10.0.0.2']
+        self.assertEqual((r.sent, r.received, r.rtt_avg), (3, 0, None))
+        r = res['10.0.0.3']
+        self.assertEqual((r.sent, r.received), (3, 0))
+        r = res['10.0.0.4']
+        self.assertEqual((r.sent, r.received), (0, 0))
+
+    def test_reachability_cache(self):
+        cache = icmp.ReachabilityCache(5)
+        with mock.patch.object(icmp, 'monotonic', return_value=100.0):
+            cache.set('10.0.0.1', True)
+            self.assertTrue(cache.get('10.0.0.1'))
+            self.assertIsNone(cache.get('10.0.0.2'))
+        with mock.patch.object(icmp, 'monotonic', return_value=106.0):
+            self.assertIsNone(cache.get('10.0.0.1'))
+
+    def test_ping_from_cache(self):
+        from djing import ping, _get_ping_cache
+        cache = _get_ping_cache()
+        cache.clear()
+        self.addCleanup(cache.clear)
+        probe = mock.Mock(return_value={
+            '10.0.0.1': icmp.PingResult('10.0.0.1', sent=1, received=1)
+        })
+        with mock.patch.object(icmp, 'probe', probe):
+            self.assertTrue(ping('10.0.0.1'))
+            # second call is answered from cache
+            self.assertTrue(ping('10.0.0.1'))
+            self.assertFalse(ping('not ip'))
+        self.assertEqual(probe.call_count, 1)
+
+
+class MergeDiffTestCase(SimpleTestCase):
+    def test_merge(self):
+        desired = (
+            core.make_queue_key('uid1', '10.0.0.1', 10, 10),
+            core.make_queue_key('uid2', '10.0.0.2', 10, 10),
+            core.make_queue_key('uid2', '10.0.0.2', 10, 10),
+            core.make_queue_key('uid3', '10.0.0.3', 20, 20),
+            core.make_queue_key('uid5', '10.0.0.5', 10, 10),
+        )
+        actual = (
+            core.make_queue_key('uid2', '10.0.0.2', 10, 10, '*2'),
+            core.make_queue_key('uid3', '10.0.0.3', 10, 10, '*3'),
+            core.make_queue_key('uid4', '10.0.0.4', 10, 10, '*4'),
+            core.make_queue_key('uid4', '10.0.0.4', 10, 10, '*5'),
+        )
+        ops = [(op, d and d.name, a and a.queue_id)
+               for op, d, a in core.merge_diff(desired, actual)]
+        self.assertListEqual(ops, [
+            (core.SYNC_ADD, 'uid1', None),
+            (core.SYNC_UPDATE, 'uid3', '*3'),
+            (core.SYNC_REMOVE, None, '*4'),
+            (core.SYNC_REMOVE, None, '*5'),
+            (core.SYNC_ADD, 'uid5', None),
+        ])
+
+    def test_not_sorted(self):
+        desired = (
+            core.make_queue_key('uid2', '10.0.0.2', 10, 10),
+            core.make_queue_key('uid1', '10.0.0.1', 10, 10),
+        )
+        with self.assertRaises(ValueError):
+            tuple(core.merge_diff(desired, ()))
+
+    def test_parse_net(self):
+        self.assertEqual(core.parse_net('192.168.0.2'), (3232235522, 32))
+        self.assertEqual(core.parse_net('10.0.0.0/8'), (167772160, 8))
+
+    def test_iter_user_keys_skip_ipv6(self):
+        users = (_SyncAbon(1, '10.0.0.1', 10.0), _SyncAbon(2, '2001:db8::1', 10.0),
+                 _SyncAbon(3, '10.0.0.3', 10.0))
+        self.assertListEqual([k.name for k in core.iter_user_keys(users)], ['uid1', 'uid3'])
+
+
+class _SyncAbon(object):
+    """Subscriber with tariff, how it is read by core.iter_user_keys"""
+
+    def __init__(self, pk: int, ip: str, speed: float):
+        self.pk = pk
+        self.ip_address = ip
+        self.speedIn = self.speedOut = speed
+
+    def is_access(self):
+        return True
+
+    def active_tariff(self):
+        return self
+
+    @property
+    def tariff(self):
+        return self
+
+
+class FakeRouterOSTestCase(SimpleTestCase):
+    def setUp(self):
+        self.ros = FakeRouterOS(password='pass').start()
+        self.mngr = self._connect(MikrotikTransmitter)
+
+    def tearDown(self):
+        self.mngr.close()
+        self.ros.stop()
+
+    def _connect(self, klass, password='pass'):
+        return klass(
+            login='admin', password=password, ip=self.ros.host,
+            port=self.ros.port, enabled=True, check_ping=False
+        )
+
+    def test_add_remove_user(self):
+        q = SubnetQueue(name='uid1', network='10.0.0.1/32', max_limit=(10.0, 10.0))
+        self.mngr.add_user(q)
+        self.assertEqual(self.mngr.find_queue('uid1').network, q.network)
+        self.assertEqual(self.ros.items('/ip/firewall/address-list')[0]['address'], '10.0.0.1')
+        self.mngr.remove_user(q)
+        self.assertIsNone(self.mngr.find_queue('uid1'))
+        self.assertListEqual(self.ros.items('/ip/firewall/address-list'), [])
+
+    def test_update_ip_outdated_index(self):
+        q = SubnetQueue(name='uid1', network='10.0.0.1/32', max_limit=(10.0, 10.0))
+        self.mngr.add_user(q)
+        index = self.mngr.get_index()
+        self.assertEqual(len(index.ips), 1)
+        # entry is removed by somebody else, index still has it
+        other = self._connect(MikrotikTransmitter)
+        other.remove_ip(self.ros.items('/ip/firewall/address-list')[0]['.id'])
+        other.close()
+        self.assertListEqual(self.ros.items('/ip/firewall/address-list'), [])
+        self.mngr.update_user(q)
+        self.assertEqual(self.ros.items('/ip/firewall/address-list')[0]['address'], '10.0.0.1')
+        # existing entry is not an error and does not drop index
+        self.mngr.update_user(q)
+        self.assertIs(self.mngr.get_index(), index)
+        self.assertEqual(len(self.ros.items('/ip/firewall/address-list')), 1)
+
+    def test_update_queue_outdated_index(self):
+        q = SubnetQueue(name='uid1', network='10.0.0.1/32', max_limit=(10.0, 10.0))
+        self.mngr.add_user(q)
+        self.mngr.get_index()
+        # queue is made again by somebody else, index has old id
+        other = self._connect(MikrotikTransmitter)
+        other.remove_queue(other.find_queue('uid1'))
+        other.add_queue(q)
+        q = SubnetQueue(name='uid1', network='10.0.0.1/32', max_limit=(20.0, 20.0))
+        self.mngr.update_queue(q)
+        self.assertEqual(other.find_queue('uid1').max_limit, (20.0, 20.0))
+        # queue is removed, it is added again
+        self.mngr.get_index()
+        other.remove_queue(other.find_queue('uid1'))
+        other.close()
+        self.mngr.update_queue(q)
+        self.assertEqual(len(self.ros.items('/queue/simple')), 1)
+        self.assertEqual(self.mngr.find_queue('uid1').max_limit, (20.0, 20.0))
+
+    def test_wrong_password(self):
+        mngr = self._connect(MikrotikTransmitter, password='wrong')
+        with self.assertRaises(NasFailedResult):
+            mngr.find_queue('uid1')
+        mngr.close()
+
+    def test_sync_nas(self):
+        load_queues(self.ros, (
+            SubnetQueue(name='uid1', network='10.0.0.1/32', max_limit=(10.0, 10.0)),
+            SubnetQueue(name='uid2', network='10.0.0.2/32', max_limit=(10.0, 10.0)),
+            SubnetQueue(name='uid3', network='10.0.0.3/32', max_limit=(10.0, 10.0)),
+        ))
+        users = (
+            _SyncAbon(2, '10.0.0.2', 10.0),
+            _SyncAbon(3, '10.0.0.3', 20.0),
+            _SyncAbon(4, '10.0.0.4', 10.0),
+        )
+        stats = self.mngr.sync_nas(users)
+        self.assertEqual((stats.queues_added, stats.queues_removed, stats.queues_updated), (1, 1, 1))
+        self.assertEqual((stats.ips_added, stats.ips_removed), (1, 1))
+        self.assertEqual(stats.errors, 0)
+        names = sorted(i['name'] for i in self.ros.items('/queue/simple'))
+        self.assertListEqual(names, ['uid2', 'uid3', 'uid4'])
+        # nothing to change on second sync
+        stats = self.mngr.sync_nas(users)
+        self.assertEqual(stats.queues_added + stats.queues_removed + stats.queues_updated, 0)
+
+    def test_trap_in_batch(self):
+        self.ros.inject_trap('/queue/simple/add', 'failure: already have such name')
+        self.mngr.add_user_range([
+            SubnetQueue(name='uid%d' % i, network='10.0.0.%d/32' % i, max_limit=(10.0, 10.0))
+            for i in range(1, 4)
+        ])
+        self.assertEqual(len(self.ros.items('/queue/simple')), 2)
+        self.assertEqual(len(self.ros.items('/ip/firewall/address-list')), 3)
+
+    def test_sync_plan_resume(self):
+        load_queues(self.ros, (
+            SubnetQueue(name='uid1', network='10.0.0.1/32', max_limit=(10.0, 10.0)),
+        ))
+        users = tuple(_SyncAbon(i, '10.0.0.%d' % i, 10.0) for i in range(2, 7))
+        plan = self.mngr.make_sync_plan(users)
+        # dry run does not change gateway
+        self.assertEqual(len(self.ros.items('/queue/simple')), 1)
+        self.assertEqual(plan.ops[0][:3], ('queue', core.SYNC_REMOVE, 'uid1'))
+        self.assertEqual(len(plan), 12)
+
+        saved = []
+
+        def checkpoint(p):
+            saved.append(p.position)
+            if len(saved) == 2:
+                raise NasNetworkError('connection lost')
+
+        with self.assertRaises(NasNetworkError):
+            self.mngr.apply_sync_plan(plan, batch_size=4, checkpoint=checkpoint)
+        self.assertListEqual(saved, [4, 8])
+        self.assertEqual(len(self.ros.items('/queue/simple')), 5)
+
+        # plan is continued from saved position by another session
+        restored = SyncPlan(plan.to_list(), saved[-1])
+        mngr = self._connect(MikrotikTransmitter)
+        stats = mngr.apply_sync_plan(restored, batch_size=4)
+        mngr.close()
+        self.assertTrue(restored.is_done)
+        self.assertEqual(stats.errors, 0)
+        self.assertEqual(stats.queues_added + stats.ips_added, 4)
+        names = sorted(i['name'] for i in self.ros.items('/queue/simple'))
+        self.assertListEqual(names, ['uid%d' % i for i in range(2, 7)])
+        self.assertEqual(len(self.ros.items('/ip/firewall/address-list')), 5)
+
+    def test_snapshot(self):
+        load_queues(self.ros, (
+            SubnetQueue(name='uid1', network='10.0.0.1/32', max_limit=(10.0, 10.0)),
+        ))
+        users = (_SyncAbon(1, '10.0.0.1', 10.0), _SyncAbon(2, '10.0.0.2', 10.0))
+        self.mngr.sync_nas(users)
+        snapshot = GatewaySnapshot.unpack(self.mngr.last_snapshot.pack())
+        self.assertEqual(len(snapshot.queues), 2)
+        self.assertEqual(snapshot.stamp, (2, 2))
+
+        # gateway is not changed, snapshot gives index without reading of items
+        mngr = self._connect(MikrotikTransmitter)
+        mngr.set_snapshot(snapshot)
+        self.assertEqual(mngr.get_index().queues['uid2'], snapshot.sorted_queues()[1].queue_id)
+        self.assertEqual(mngr.last_snapshot.read_time, snapshot.read_time)
+
+        # edit from outside keeps counts, but full sync reads gateway again
+        other = self._connect(MikrotikTransmitter)
+        other._exec_cmd(('/queue/simple/set', '=numbers=%s' % snapshot.sorted_queues()[1].queue_id,
+                         '=max-limit=1.000M/1.000M'))
+        other.close()
+        mngr.set_snapshot(snapshot)
+        stats = mngr.sync_nas(users)
+        self.assertEqual(stats.queues_updated, 1)
+        self.assertGreater(mngr.last_snapshot.generation, snapshot.generation)
+
+        # queue from outside changes stamp, gateway is read again
+        self.ros.add_item('/queue/simple', {'name': 'other', 'target': '10.0.0.9/32'})
+        mngr.set_snapshot(snapshot)
+        mngr.get_index()
+        self.assertGreater(mngr.last_snapshot.generation, snapshot.generation)
+        self.assertEqual(mngr.last_snapshot.stamp, (3, 2))
+
+        # failed write drops snapshot
+        self.ros.inject_trap('/queue/simple/add')
+        mngr.add_user(SubnetQueue(name='uid3', network='10.0.0.3/32', max_limit=(10.0, 10.0)))
+        self.assertIsNone(mngr.last_snapshot)
+        mngr.close()
+
+    def test_sync_changes(self):
+        load_queues(self.ros, (
+            SubnetQueue(name='uid1', network='10.0.0.1/32', max_limit=(10.0, 10.0)),
+            SubnetQueue(name='uid2', network='10.0.0.2/32', max_limit=(10.0, 10.0)),
+            SubnetQueue(name='uid3', network='10.0.0.3/32', max_limit=(10.0, 10.0)),
+            SubnetQueue(name='uid5', network='10.0.0.5/32', max_limit=(10.0, 10.0)),
+        ))
+        self.mngr.get_snapshot()
+        round_trips = self.mngr.round_trips
+        stats = self.mngr.sync_changes((
+            SubnetQueue(name='uid1', network='10.0.0.1/32', max_limit=(20.0, 20.0)),
+            # ip of subscriber is changed
+            SubnetQueue(name='uid2', network='10.0.0.12/32', max_limit=(10.0, 10.0)),
+            SubnetQueue(name='uid3', network='10.0.0.3/32', is_access=False),
+            SubnetQueue(name='uid4', network='10.0.0.4/32', max_limit=(10.0, 10.0)),
+        ), (
+            SubnetQueue(name='uid2', network='10.0.0.2/32', is_access=False),
+        ))
+        self.assertEqual(stats.errors, 0)
+        # one pipelined batch and check of stamp
+        self.assertEqual(self.mngr.round_trips - round_trips, 2)
+        self.assertEqual(stats.round_trips, 2)
+        queues = {i['name']: i for i in self.ros.items('/queue/simple')}
+        self.assertListEqual(sorted(queues.keys()), ['uid1', 'uid2', 'uid4', 'uid5'])
+        self.assertEqual(queues['uid2']['target'], '10.0.0.12/32')
+        self.assertEqual(self.mngr.find_queue('uid1').max_limit, (20.0, 20.0))
+        addrs = sorted(i['address'] for i in self.ros.items('/ip/firewall/address-list'))
+        self.assertListEqual(addrs, ['10.0.0.1', '10.0.0.12', '10.0.0.4', '10.0.0.5'])
+
+    def test_sync_changes_outdated_snapshot(self):
+        q = SubnetQueue(name='uid1', network='10.0.0.1/32', max_limit=(10.0, 10.0))
+        load_queues(self.ros, (q,))
+        self.mngr.get_snapshot()
+        # queue is removed by somebody else, snapshot still has it
+        other = self._connect(MikrotikTransmitter)
+        other.remove_queue(other.find_queue('uid1'))
+        other.close()
+        stats = self.mngr.sync_changes((
+            SubnetQueue(name='uid1', network='10.0.0.1/32', max_limit=(20.0, 20.0)),
+        ), ())
+        self.assertEqual(stats.errors, 0)
+        self.assertEqual(stats.queues_added, 1)
+        self.assertEqual(self.mngr.find_queue('uid1').max_limit, (20.0, 20.0))
+
+    def test_pcq_sync_changes(self):
+        mngr = self._connect(MikrotikPcqTransmitter)
+        mngr.sync_nas((_SyncAbon(1, '10.0.0.1', 10.0),))
+        stats = mngr.sync_changes((
+            SubnetQueue(name='uid1', network='10.0.0.1/32', max_limit=(20.0, 20.0)),
+        ), ())
+        mngr.close()
+        self.assertEqual((stats.queues_updated, stats.errors), (1, 0))
+        lists = sorted(i['list'] for i in self.ros.items('/ip/firewall/address-list'))
+        self.assertListEqual(lists, ['DjingSpeed_20000_20000', 'DjingUsersAllowed'])
+        # not used speed class is left for full sync
+        self.assertEqual(len(self.ros.items('/queue/tree')), 4)
+
+    def test_pcq_sync(self):
+        mngr = self._connect(MikrotikPcqTransmitter)
+        stats = mngr.sync_nas((
+            _SyncAbon(1, '10.0.0.1', 10.0),
+            _SyncAbon(2, '10.0.0.2', 20.0),
+        ))
+        mngr.close()
+        self.assertEqual(stats.queues_added, 2)
+        self.assertEqual(len(self.ros.items('/queue/tree')), 4)
+        lists = sorted(i['list'] for i in self.ros.items('/ip/firewall/address-list'))
+        self.assertIn('DjingSpeed_10000_10000', lists)
+        self.assertIn('DjingSpeed_20000_20000', lists)
+
+
+class _RecordingLinuxTransmitter(mod_linux.LinuxTransmitter):
+    """Commands are not run, they are recorded with their scripts"""
+
+    def __init__(self, outputs: dict):
+        super().__init__(login='root', password='', ip='127.0.0.1', port=22,
+                         enabled=True, check_ping=False)
+        self.outputs = outputs
+        self.commands = []
+
+    def _run(self, cmd, script=None):
+        self.round_trips += 1
+        self.commands.append((cmd[0], script))
+        return self.outputs.get(cmd[:2], '')
+
+
+class LinuxRendererTestCase(SimpleTestCase):
+    def setUp(self):
+        self.keys = [
+            core.make_queue_key('uid1', '10.0.0.1', 10, 5)._replace(queue_id=2),
+            core.make_queue_key('uid2', '10.0.1.0/24', 20, 20)._replace(queue_id=0x1f),
+        ]
+
+    def test_nft_full(self):
+        script = mod_linux.render_nft_full(self.keys, lan_iface='lan0')
+        self.assertTrue(script.startswith('table ip djing\ndelete table ip djing\n'))
+        self.assertIn('elements = { 10.0.0.1,\n\t\t\t10.0.1.0/24 }', script)
+        self.assertIn('10.0.0.1 comment "uid1" : 1:2', script)
+        self.assertIn('10.0.1.0/24 comment "uid2" : 1:1f', script)
+        self.assertIn('iifname "lan0" ip saddr != @allowed drop', script)
+
+    def test_nft_full_empty(self):
+        self.assertNotIn('elements', mod_linux.render_nft_full(()))
+
+    def test_nft_diff(self):
+        script = mod_linux.render_nft_diff(self.keys[1:], self.keys[:1])
+        self.assertListEqual(script.splitlines(), [
+            'delete element ip djing classes { 10.0.0.1 }',
+            'delete element ip djing allowed { 10.0.0.1 }',
+            'add element ip djing allowed { 10.0.1.0/24 }',
+            'add element ip djing classes { 10.0.1.0/24 comment "uid2" : 1:1f }',
+        ])
+
+    def test_tc(self):
+        script = mod_linux.render_tc(self.keys[:1], self.keys[1:], wan_iface='wan0',
+                                     lan_iface='lan0', new_roots=('lan0',))
+        self.assertListEqual(script.splitlines(), [
+            'qdisc replace dev lan0 root handle 1: htb default 0',
+            'class replace dev wan0 parent 1: classid 1:2 htb rate 10000kbit ceil 10000kbit quantum 1514',
+            'class replace dev lan0 parent 1: classid 1:2 htb rate 5000kbit ceil 5000kbit quantum 1514',
+            'class del dev wan0 classid 1:1f',
+            'class del dev lan0 classid 1:1f',
+        ])
+
+    def test_parse_state(self):
+        classes = mod_linux.parse_nft_classes(
+            '{"nftables": [{"metainfo": {}}, {"map": {"name": "classes", "elem": ['
+            '[{"elem": {"val": "10.0.0.1", "comment": "uid1"}}, "1:2"], '
+            '[{"prefix": {"addr": "10.0.1.0", "len": 24}}, "1:1f"]]}}]}'
+        )
+        self.assertDictEqual(classes, {
+            core.parse_net('10.0.0.1'): (2, 'uid1'),
+            core.parse_net('10.0.1.0/24'): (0x1f, ''),
+        })
+        rates = mod_linux.parse_tc_rates(
+            'class htb 1:2 root prio 0 rate 10Mbit ceil 10Mbit burst 1600b cburst 1600b \n'
+            'class htb 1:1f root prio 0 rate 512Kbit ceil 512Kbit burst 1600b cburst 1600b \n'
+        )
+        self.assertDictEqual(rates, {2: 10000, 0x1f: 512})
+        self.assertTrue(mod_linux.has_htb_root('[{"kind": "htb", "handle": "1:", "root": true}]'))
+        self.assertFalse(mod_linux.has_htb_root('[{"kind": "noqueue", "handle": "0:", "root": true}]'))
+
+    def test_sync_nas(self):
+        mngr = _RecordingLinuxTransmitter({
+            ('nft', '-j'): '{"nftables": [{"map": {"elem": ['
+                           '[{"elem": {"val": "10.0.0.1", "comment": "uid1"}}, "1:2"], '
+                           '[{"elem": {"val": "10.0.0.2", "comment": "uid2"}}, "1:3"]]}}]}',
+            ('tc', 'class'): 'class htb 1:2 root prio 0 rate 10Mbit ceil 10Mbit\n'
+                             'class htb 1:3 root prio 0 rate 10Mbit ceil 10Mbit\n',
+            ('tc', '-j'): '[{"kind": "htb", "handle": "1:", "root": true}]'
+        })
+        stats = mngr.sync_nas((
+            _SyncAbon(1, '10.0.0.1', 10.0),
+            _SyncAbon(3, '10.0.0.3', 10.0),
+        ))
+        self.assertEqual((stats.queues_added, stats.queues_removed), (1, 1))
+        # one read of map, two reads of classes, two reads of
+        # root qdiscs, then three batches
+        self.assertListEqual([c for c, s in mngr.commands],
+                             ['nft', 'tc', 'tc', 'tc', 'tc', 'tc', 'nft', 'tc'])
+        tc_add, nft_full, tc_del = (s for c, s in mngr.commands[5:])
+        self.assertNotIn('qdisc', tc_add)
+        self.assertIn('classid 1:4 htb rate 10000kbit', tc_add)
+        self.assertNotIn('classid 1:2 ', tc_add)
+        self.assertIn('10.0.0.3 comment "uid3" : 1:4', nft_full)
+        self.assertNotIn('10.0.0.2', nft_full)
+        self.assertIn('class del dev %s classid 1:3' % mod_linux.NAS_LINUX_WAN_IFACE, tc_del)
+        # state is kept, changes are rendered as small batch
+        mngr.commands.clear()
+        mngr.remove_user(SubnetQueue(name='uid1', network='10.0.0.1/32', max_limit=(10.0, 10.0)))
+        self.assertEqual(mngr.commands[0], ('nft', 'delete element ip djing classes { 10.0.0.1 }\n'
+                                                   'delete element ip djing allowed { 10.0.0.1 }\n'))
@@ -10,4 +10,5 @@ urlpatterns = [
     path('add/', view=views.NasCreateView.as_view(), name='add'),
     path('<int:nas_id>/del/', views.NasDeleteView.as_view(), name='del'),
     path('<int:nas_id>/edit/', views.NasUpdateView.as_view(), name='edit'),
+    path('<int:nas_id>/plan/', views.NasSyncPlanView.as_view(), name='plan'),
 ]
@@ -6,11 +6,13 @@ from django.shortcuts import resolve_url
 from django.utils.decorators import method_decorator
 from django.utils.translation import gettext_lazy as _
 from django.urls import reverse_lazy
-from django.views.generic import ListView, CreateView, DeleteView, UpdateView
+from django.views.generic import ListView, CreateView, DeleteView, UpdateView, DetailView
 from guardian.decorators import permission_required_or_403 as permission_required
 from guardian.shortcuts import assign_perm
+from abonapp.models import Abon
 from gw_app.forms import NasForm
-from gw_app.models import NASModel
+from gw_app.models import NASModel, NasSyncPlan, NasStateSnapshot
+from gw_app.nas_managers import NasFailedResult, NasNetworkError
 from djing.lib.decorators import only_admins
 
 
@@ -80,3 +82,42 @@ class NasUpdateView(UpdateView):
         r = super(NasUpdateView, self).form_valid(form)
         messages.success(self.request, _('Update successfully'))
         return r
+
+
+@method_decorator(login_decs, name='dispatch')
+@method_decorator(permission_required('gw_app.change_nasmodel'), name='dispatch')
+class NasSyncPlanView(DetailView):
+    """
+    Dry run of full sync, changes are computed
+    from gateway and db but are not applied
+    """
+    model = NASModel
+    pk_url_kwarg = 'nas_id'
+    template_name = 'gw_app/nasmodel_plan.html'
+    # How many operations of plan are shown
+    show_limit = 500
+
+    def get_context_data(self, **kwargs):
+        context = super(NasSyncPlanView, self).get_context_data(**kwargs)
+        nas = self.object
+        context['saved_plan'] = NasSyncPlan.objects.filter(nas=nas).first()
+        try:
+            mngr = nas.get_nas_manager()
+            mngr.set_snapshot(NasStateSnapshot.objects.load(nas))
+            plan = mngr.make_sync_plan(Abon.objects.for_nas_sync(nas.pk))
+            NasStateSnapshot.objects.store(nas, mngr.last_snapshot)
+        except NotImplementedError:
+            messages.error(self.request, _('Gateway type does not support sync plans'))
+            return context
+        except (NasFailedResult, NasNetworkError, ConnectionResetError) as e:
+            messages.error(self.request, e)
+            return context
+        counts = {}
+        for op in plan.ops:
+            counts[(op.kind, op.op)] = counts.get((op.kind, op.op), 0) + 1
+        context.update({
+            'plan': plan,
+            'plan_counts': sorted(counts.items()),
+            'plan_ops': plan.ops[:self.show_limit]
+        })
+        return context
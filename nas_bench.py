@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+import os
+import socket
+import sys
+from threading import Thread
+from time import monotonic
+import django
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "djing.settings")
+django.setup()
+from gw_app.nas_managers.mod_mikrotik import ApiRos, MikrotikTransmitter
+from gw_app.nas_managers.fake_ros import FakeRouterOS
+from gw_app.nas_managers.structs import SubnetQueue
+
+
+"""
+    Micro benchmark of RouterOS api protocol reader.
+    Usage:
+        ./nas_bench.py [count of queues]
+        ./nas_bench.py --file dump.bin
+    Dump is raw bytes received from gateway on command
+    /queue/simple/print =detail, for example saved by tcpdump.
+    Without dump the response for given count of queues is generated.
+
+    Benchmark of gateway manager against fake RouterOS:
+        ./nas_bench.py --gateway [--latency ms] [count of subscribers ...]
+    By default it is run for 1000, 10000 and 50000 subscribers.
+"""
+
+
+def make_queue_print_response(count: int) -> bytes:
+    data = bytearray()
+    for i in range(count):
+        data += ApiRos.encode_sentence((
+            '!re',
+            '=.id=*%X' % (i + 1),
+            '=name=uid%d' % (i + 1),
+            '=target=10.%d.%d.%d/32' % (i >> 16 & 0xff, i >> 8 & 0xff, i & 0xff),
+            '=parent=none',
+            '=packet-marks=',
+            '=priority=8/8',
+            '=queue=Djing_pcq_up/Djing_pcq_down',
+            '=limit-at=0/0',
+            '=max-limit=10.000M/10.000M',
+            '=burst-limit=20.000M/20.000M',
+            '=burst-threshold=8.333M/8.333M',
+            '=burst-time=5s/5s',
+            '=bucket-size=0.1/0.1',
+            '=invalid=false',
+            '=dynamic=false',
+            '=disabled=false'
+        ))
+    data += ApiRos.encode_sentence(('!done',))
+    return bytes(data)
+
+
+class LegacyReader(ApiRos):
+    """Byte by byte reader how it was before buffered reading"""
+
+    def __init__(self, sk):
+        self.sk = sk
+
+    def read_len(self):
+        c = self.read_bytes(1)[0]
+        if (c & 0x80) == 0x00:
+            return c
+        elif (c & 0xC0) == 0x80:
+            size, c = 1, c & ~0xC0
+        elif (c & 0xE0) == 0xC0:
+            size, c = 2, c & ~0xE0
+        elif (c & 0xF0) == 0xE0:
+            size, c = 3, c & ~0xF0
+        else:
+            size, c = 4, 0
+        for i in range(size):
+            c = (c << 8) + self.read_bytes(1)[0]
+        return c
+
+    def read_word(self):
+        return self.read_bytes(self.read_len()).decode('utf-8')
+
+    def read_bytes(self, length):
+        ret = b''
+        while len(ret) < length:
+            s = self.sk.recv(length - len(ret))
+            if len(s) == 0:
+                raise ConnectionResetError
+            ret += s
+        return ret
+
+
+class BufferedReader(ApiRos):
+    def __init__(self, sk):
+        self._ApiRos__sk = sk
+
+
+def measure(reader_class, data: bytes):
+    sk, gw_sk = socket.socketpair()
+    sender = Thread(target=gw_sk.sendall, args=(data,))
+    sender.start()
+    reader = reader_class(sk)
+    count = 0
+    start_time = monotonic()
+    while 1:
+        sentence = reader.read_sentence()
+        if not sentence:
+            continue
+        count += 1
+        if sentence[0] == '!done':
+            break
+    wall_time = monotonic() - start_time
+    sender.join()
+    sk.close()
+    gw_sk.close()
+    return count, wall_time
+
+
+def make_address(i: int) -> str:
+    return '10.%d.%d.%d' % (i >> 16 & 0xff, i >> 8 & 0xff, i & 0xff)
+
+
+class _BenchTariff(object):
+    def __init__(self, speed_in: float, speed_out: float):
+        self.speedIn = speed_in
+        self.speedOut = speed_out
+
+
+class _BenchAbon(object):
+    """Looks like abonapp.models.Abon for sync_nas"""
+
+    def __init__(self, pk: int, speed: float):
+        self.pk = pk
+        self.ip_address = make_address(pk)
+        self._tariff = _BenchTariff(speed, speed)
+
+    def is_access(self):
+        return True
+
+    def active_tariff(self):
+        return self
+
+    @property
+    def tariff(self):
+        return self._tariff
+
+
+def measure_gateway(count: int, latency: float):
+    queues = [
+        SubnetQueue(name='uid%d' % i, network='%s/32' % make_address(i), max_limit=(10.0, 10.0))
+        for i in range(1, count + 1)
+    ]
+    # 5% of subscribers is gone, 5% is new and 10% has changed speed
+    users = [
+        _BenchAbon(i, 20.0 if i % 10 == 0 else 10.0)
+        for i in range(count // 20 + 1, count + count // 20 + 1)
+    ]
+    with FakeRouterOS(password='bench', latency=latency) as ros:
+        mngr = MikrotikTransmitter(
+            login='admin', password='bench', ip=ros.host, port=ros.port,
+            enabled=True, check_ping=False
+        )
+        try:
+            for name, fn in (
+                ('add_user_range', lambda: mngr.add_user_range(queues)),
+                ('sync_nas', lambda: mngr.sync_nas(users)),
+                ('remove_user_range', lambda: mngr.remove_user_range(queues))
+            ):
+                round_trips = mngr.round_trips
+                start_time = monotonic()
+                res = fn()
+                print('%d subscribers, %s: %.3f sec, %d round trips%s' % (
+                    count, name, monotonic() - start_time,
+                    mngr.round_trips - round_trips,
+                    '' if res is None else ', %s' % res
+                ))
+        finally:
+            mngr.close()
+
+
+def main(argv):
+    if len(argv) > 1 and argv[1] == '--gateway':
+        args = argv[2:]
+        latency = 0.0
+        if len(args) > 1 and args[0] == '--latency':
+            latency = float(args[1]) / 1000
+            args = args[2:]
+        for count in map(int, args or (1000, 10000, 50000)):
+            measure_gateway(count, latency)
+        return
+    if len(argv) > 2 and argv[1] == '--file':
+        with open(argv[2], 'rb') as f:
+            data = f.read()
+    else:
+        count = int(argv[1]) if len(argv) > 1 else 10000
+        data = make_queue_print_response(count)
+    print('Response size %d bytes' % len(data))
+    for reader_class in (LegacyReader, BufferedReader):
+        count, wall_time = measure(reader_class, data)
+        print('%s: %d sentences in %.3f sec, %.1f MB/s' % (
+            reader_class.__name__, count, wall_time,
+            len(data) / wall_time / 1024 ** 2
+        ))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -1,99 +1,346 @@
 #!/usr/bin/env python3
 import os
-from threading import Thread
+from collections import defaultdict
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from threading import Lock
+from time import monotonic
+from typing import Iterator, Sequence, Iterable, Tuple
 import django
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "djing.settings")
 django.setup()
+from django.conf import settings
 from django.utils import timezone
-from django.db import transaction
-from django.db.models import Count
-from abonapp.models import Abon, AbonTariff, PeriodicPayForId, AbonLog
+from django.db import transaction, connection
+from django.db.models import Count, F
+from abonapp.models import Abon, AbonTariff, PeriodicPayForId, AbonLog, AbonSyncJournal, AbonLease
+from tariff_app.models import Tariff
 from gw_app.nas_managers import NasNetworkError, NasFailedResult
-from gw_app.models import NASModel
+from gw_app.models import NASModel, NasSyncPlan, NasStateSnapshot
 from djing.lib import LogicError
 
+# How many services is processed in one transaction
+BILLING_CHUNK_SIZE = getattr(settings, 'BILLING_CHUNK_SIZE', 1000)
+
+# How many gateways is synchronizing at the same time
+NAS_SYNC_WORKERS = getattr(settings, 'NAS_SYNC_WORKERS', 4)
+
+# Time in seconds for sync one gateway
+NAS_SYNC_TIMEOUT = getattr(settings, 'NAS_SYNC_TIMEOUT', 600)
+
+# Between full reconciles only changed subscribers are pushed to gateway
+NAS_FULL_SYNC_INTERVAL = timedelta(
+    seconds=getattr(settings, 'NAS_FULL_SYNC_INTERVAL', 60 * 60 * 24)
+)
+
+
+class NasSyncJob(object):
+    """
+    Sync subscribers on one gateway, it is executed in worker thread.
+    Job may be cancelled from another thread when deadline is reached.
+    """
 
-class NasSyncThread(Thread):
     def __init__(self, nas):
-        super(NasSyncThread, self).__init__()
         self.nas = nas
+        self.start_time = None
+        self.cancelled = False
+        self._mngr = None
+        self._lock = Lock()
 
-    def run(self):
+    def __call__(self):
+        with self._lock:
+            self.start_time = monotonic()
+            self._mngr = self.nas.get_nas_manager()
         try:
-            tm = self.nas.get_nas_manager()
-            users = Abon.objects \
-                .filter(is_active=True, nas=self.nas) \
-                .exclude(current_tariff=None, ip_address=None) \
-                .iterator()
-            tm.sync_nas(users)
-        except NasNetworkError as er:
-            print('NetworkTrouble:', er)
-        except NASModel.DoesNotExist:
-            raise NotImplementedError
+            nas = self.nas
+            # gateway is not read again if it was not changed since last run
+            self._mngr.set_snapshot(NasStateSnapshot.objects.load(nas))
+            try:
+                return self._sync(nas)
+            except Exception:
+                # state of gateway is not known after error,
+                # it is read again on next run
+                self._mngr.set_snapshot(None)
+                raise
+            finally:
+                NasStateSnapshot.objects.store(nas, self._mngr.last_snapshot)
+        finally:
+            connection.close()
 
+    def _sync(self, nas: NASModel):
+        last_id = AbonSyncJournal.objects.get_last_id(nas=nas)
+        now = timezone.now()
+        # plan of interrupted full sync is continued
+        saved_plan = NasSyncPlan.objects.get_pending(nas)
+        if saved_plan is None and (
+                nas.last_full_sync is None or
+                nas.last_full_sync + NAS_FULL_SYNC_INTERVAL < now):
+            plan = self._mngr.make_sync_plan(
+                Abon.objects.for_nas_sync(nas.pk)
+            )
+            saved_plan = NasSyncPlan.objects.save_plan(nas, plan, last_id)
+        if saved_plan is not None:
+            # changes made after plan are pushed on next run
+            last_id = saved_plan.last_journal_id
+            stats = self._mngr.apply_sync_plan(
+                saved_plan.get_sync_plan(),
+                checkpoint=saved_plan.save_position
+            )
+            saved_plan.delete()
+            nas.last_full_sync = saved_plan.created
+            nas.save(update_fields=('last_full_sync',))
+        elif last_id is not None:
+            queues_for_update, queues_for_remove = \
+                AbonSyncJournal.objects.get_changes(nas.pk, last_id)
+            stats = self._mngr.sync_changes(queues_for_update,
+                                            queues_for_remove)
+        else:
+            return 'nothing changed'
+        if last_id is not None:
+            AbonSyncJournal.objects.filter(nas=nas, id__lte=last_id).delete()
+        return stats
 
-def main():
-    AbonTariff.objects.filter(abon=None).delete()
-    now = timezone.now()
+    def is_expired(self, timeout: float) -> bool:
+        with self._lock:
+            return self.start_time is not None and \
+                   monotonic() - self.start_time > timeout
+
+    def cancel(self):
+        with self._lock:
+            if self._mngr is not None:
+                self._mngr.cancel()
+            self.cancelled = True
+
+
+def sync_gateways(nas_list: Iterable[NASModel], workers=NAS_SYNC_WORKERS,
+                  timeout=NAS_SYNC_TIMEOUT, job_class=NasSyncJob) -> dict:
+    """
+    Sync subscribers on many gateways with bounded count of threads.
+    Each gateway has *timeout* seconds from the start of its sync,
+    then communication with it is cancelled. Error of one gateway
+    does not stop waiting for others.
+    :return: gateway -> result of sync or its exception
+    """
+    jobs = {}
+    results = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for nas in nas_list:
+            job = job_class(nas)
+            jobs[executor.submit(job)] = job
+        not_done = set(jobs.keys())
+        while not_done:
+            done, not_done = wait(not_done, timeout=1,
+                                  return_when=FIRST_COMPLETED)
+            for future in done:
+                nas = jobs[future].nas
+                try:
+                    stats = future.result()
+                    print('NAS "%s" synced: %s' % (nas, stats))
+                except (NasNetworkError, ConnectionResetError) as er:
+                    print('NetworkTrouble on "%s":' % nas, er)
+                    stats = er
+                except NasFailedResult as er:
+                    print('Error while sync nas "%s":' % nas, er)
+                    stats = er
+                except Exception as er:
+                    print('Unexpected error while sync nas "%s": %r' % (nas, er))
+                    stats = er
+                results[nas] = stats
+            for future in not_done:
+                job = jobs[future]
+                if not job.cancelled and job.is_expired(timeout):
+                    print('NAS "%s" sync deadline has reached, cancel' % job.nas)
+                    job.cancel()
+    return results
+
+
+def _chunks(items: Sequence, size: int) -> Iterator[Sequence]:
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def finish_services_chunk(ids: Sequence[int], now) -> int:
+    """
+    Finish services of chunk that are still expired and without
+    autoconnect, service that was renewed or switched since its id
+    was selected is left
+    :return: count of finished services
+    """
     fields = ('id', 'tariff__title', 'abon__id', 'abon__username')
-    expired_services = AbonTariff.objects.exclude(abon=None).filter(
+    with transaction.atomic():
+        rows = tuple(AbonTariff.objects.select_for_update().filter(
+            pk__in=ids, deadline__lt=now, abon__autoconnect_service=False
+        ).values(*fields))
+        ids = tuple(ex_srv['id'] for ex_srv in rows)
+        AbonLog.objects.bulk_create([AbonLog(
+            abon_id=ex_srv['abon__id'],
+            amount=0,
+            author=None,
+            date=now,
+            comment="Срок действия услуги '%(service_name)s' для '%(username)s' истёк" % {
+                'service_name': ex_srv['tariff__title'],
+                'username': ex_srv['abon__username']
+            }
+        ) for ex_srv in rows])
+        expired_abons = Abon.objects.filter(current_tariff__in=ids)
+        AbonSyncJournal.objects.mark_changed(expired_abons)
+        expired_abons.update(current_tariff=None)
+        AbonTariff.objects.filter(pk__in=ids).delete()
+    return len(ids)
+
+
+def finish_expired_services(now, chunk_size=BILLING_CHUNK_SIZE):
+    """
+    Finishing expired services for subscribers without autoconnect.
+    Services are processed in chunks, each chunk is one transaction
+    with one bulk insert of logs and one bulk delete of services.
+    """
+    service_ids = tuple(AbonTariff.objects.exclude(abon=None).filter(
         deadline__lt=now,
         abon__autoconnect_service=False
-    )
+    ).values_list('id', flat=True))
+    for chunk_num, ids in enumerate(_chunks(service_ids, chunk_size), 1):
+        start_time = monotonic()
+        count = finish_services_chunk(ids, now)
+        print('Expired chunk %(num)d: %(count)d services finished in %(time).3f sec' % {
+            'num': chunk_num,
+            'count': count,
+            'time': monotonic() - start_time
+        })
 
-    # finishing expires services
-    with transaction.atomic():
-        for ex_srv in expired_services.only(*fields).values(*fields):
-            log = AbonLog.objects.create(
-                abon_id=ex_srv['abon__id'],
-                amount=0,
-                author=None,
-                date=now,
-                comment="Срок действия услуги '%(service_name)s' для '%(username)s' истёк" % {
-                    'service_name': ex_srv['tariff__title'],
-                    'username': ex_srv['abon__username']
-                }
-            )
-            print(log)
-        expired_services.delete()
 
-    # Automatically connect new service
-    for ex in AbonTariff.objects.filter(
-        deadline__lt=now,
-        abon__autoconnect_service=True
-    ).exclude(abon=None).iterator():
-        abon = ex.abon
-        trf = ex.tariff
-        amount = round(trf.amount, 2)
-        if abon.ballance >= amount:
-            # can continue service
-            with transaction.atomic():
-                abon.ballance -= amount
-                ex.time_start = now
-                ex.deadline = None  # Deadline sets automatically in signal pre_save
-                ex.save(update_fields=('time_start', 'deadline'))
-                abon.save(update_fields=('ballance',))
-                # make log about it
-                l = AbonLog.objects.create(
-                    abon=abon, amount=-amount,
-                    comment="Автоматическое продление услуги '%s' для %s" % (trf.title, abon)
-                )
-                print(l.comment)
-        else:
-            # finish service
-            with transaction.atomic():
-                ex.delete()
-                l = AbonLog.objects.create(
-                    abon_id=ex.abon.id,
+def renew_services_chunk(ids: Sequence[int], now, deadlines: dict) -> Tuple[int, int]:
+    """
+    Renew or finish services of chunk that are still expired and with
+    autoconnect, service that was renewed or switched since its id
+    was selected is left
+    :param deadlines: cache of tariff id -> new deadline
+    :return: count of renewed and of finished services
+    """
+    fields = ('id', 'tariff_id', 'tariff__title', 'tariff__amount',
+              'abon__id', 'abon__username', 'abon__fio', 'abon__ballance')
+    with transaction.atomic():
+        rows = AbonTariff.objects.select_for_update().filter(
+            pk__in=ids, deadline__lt=now, abon__autoconnect_service=True
+        ).values(*fields)
+        renew_by_tariff = defaultdict(list)
+        finish_ids = []
+        logs = []
+        for ex in rows:
+            amount = round(ex['tariff__amount'], 2)
+            if ex['abon__ballance'] >= amount:
+                # can continue service
+                renew_by_tariff[ex['tariff_id']].append(ex)
+                logs.append(AbonLog(
+                    abon_id=ex['abon__id'], amount=-amount,
+                    comment="Автоматическое продление услуги '%s' для %s" % (
+                        ex['tariff__title'],
+                        ex['abon__fio'] or ex['abon__username']
+                    )
+                ))
+            else:
+                # finish service
+                finish_ids.append(ex['id'])
+                logs.append(AbonLog(
+                    abon_id=ex['abon__id'],
                     amount=0,
                     author=None,
                     date=now,
                     comment="Срок действия услуги '%(service_name)s' истёк" % {
-                        'service_name': ex.tariff.title
+                        'service_name': ex['tariff__title']
                     }
-                )
-                print(l.comment)
+                ))
+
+        tariffs = Tariff.objects.in_bulk(
+            tuple(t for t in renew_by_tariff if t not in deadlines)
+        )
+        for tariff_id, tariff in tariffs.items():
+            deadlines[tariff_id] = tariff.calc_deadline()
+
+        for tariff_id, services in renew_by_tariff.items():
+            amount = round(services[0]['tariff__amount'], 2)
+            Abon.objects.filter(
+                pk__in=tuple(ex['abon__id'] for ex in services)
+            ).update(ballance=F('ballance') - amount)
+            AbonTariff.objects.filter(
+                pk__in=tuple(ex['id'] for ex in services)
+            ).update(time_start=now, deadline=deadlines[tariff_id])
+
+        if finish_ids:
+            expired_abons = Abon.objects.filter(current_tariff__in=finish_ids)
+            AbonSyncJournal.objects.mark_changed(expired_abons)
+            expired_abons.update(current_tariff=None)
+            AbonTariff.objects.filter(pk__in=finish_ids).delete()
+        AbonLog.objects.bulk_create(logs)
+    return len(logs) - len(finish_ids), len(finish_ids)
+
+
+def renew_autoconnect_services(now, chunk_size=BILLING_CHUNK_SIZE):
+    """
+    Automatically continue expired services for subscribers with autoconnect.
+    If subscriber have enough money then service is renewed and
+    ballance is charged with F() expression, else service is finished.
+    """
+    service_ids = tuple(AbonTariff.objects.filter(
+        deadline__lt=now,
+        abon__autoconnect_service=True
+    ).exclude(abon=None).values_list('id', flat=True))
+    # deadline depends only on tariff calculation type and current time
+    deadlines = {}
+    for chunk_num, ids in enumerate(_chunks(service_ids, chunk_size), 1):
+        start_time = monotonic()
+        renewed, finished = renew_services_chunk(ids, now, deadlines)
+        print('Autoconnect chunk %(num)d: %(renewed)d services renewed, '
+              '%(finished)d finished in %(time).3f sec' % {
+                  'num': chunk_num,
+                  'renewed': renewed,
+                  'finished': finished,
+                  'time': monotonic() - start_time
+              })
+
+
+def close_stale_leases(lease_ids: Sequence[int], now, lease_time=None) -> int:
+    """
+    Close leases that are still stale, lease that was renewed
+    since its id was selected is left open. Subscribers lose
+    their ip by AbonLease.objects.apply_pending.
+    :return: count of closed leases
+    """
+    # staleness is checked again by the same update
+    return AbonLease.objects.stale(now, lease_time).filter(
+        pk__in=lease_ids
+    ).update(lease_end=now, applied=False)
+
+
+def expire_stale_leases(now, chunk_size=BILLING_CHUNK_SIZE):
+    """
+    Close leases that was not renewed, dhcp server may lose
+    expiry events while it is restarted. Then all leases that
+    was not applied yet, also after lost background task, are
+    moved into subscribers, and they are pushed to gateways
+    by sync journal.
+    """
+    lease_ids = tuple(AbonLease.objects.stale(now).values_list('id', flat=True))
+    for ids in _chunks(lease_ids, chunk_size):
+        closed = close_stale_leases(ids, now)
+        print('Stale leases: %d checked, %d closed' % (len(ids), closed))
+    nas_ids = AbonLease.objects.apply_pending()
+    print('Leases applied, %d gateways changed' % len(nas_ids))
+
+
+def main():
+    AbonTariff.objects.filter(abon=None).delete()
+    now = timezone.now()
+
+    # finishing expires services
+    finish_expired_services(now)
+
+    # Automatically connect new service
+    renew_autoconnect_services(now)
+
+    # free ip of leases that was not renewed
+    expire_stale_leases(now)
 
     # Post connect service
     # connect service when autoconnect is True, and user have enough money
@@ -120,13 +367,9 @@ def main():
         pay.payment_for_service(now=now)
 
     # sync subscribers on GW
-    threads = tuple(NasSyncThread(nas) for nas in NASModel.objects.
-                    annotate(usercount=Count('abon')).
-                    filter(usercount__gt=0, enabled=True))
-    for t in threads:
-        t.start()
-    for t in threads:
-        t.join()
+    sync_gateways(NASModel.objects.
+                  annotate(usercount=Count('abon')).
+                  filter(usercount__gt=0, enabled=True))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+import os
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from threading import Lock
+from datetime import timedelta
+from time import monotonic
+from typing import Iterable, NamedTuple, Optional
+import django
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "djing.settings")
+django.setup()
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+from easysnmp import EasySNMPError
+from devapp.base_intr import DeviceImplementationError
+from devapp.models import Device, PortState, OnuSignalBlock, DeviceDBException
+
+# How many devices is polling at the same time
+DEVICE_POLL_WORKERS = getattr(settings, 'DEVICE_POLL_WORKERS', 16)
+
+# Time in seconds for poll one device
+DEVICE_POLL_TIMEOUT = getattr(settings, 'DEVICE_POLL_TIMEOUT', 60)
+
+# Days while all samples of ONU signal are kept, older are downsampled
+ONU_SIGNAL_RAW_DAYS = getattr(settings, 'ONU_SIGNAL_RAW_DAYS', 7)
+
+# Seconds between downsampled samples of ONU signal
+ONU_SIGNAL_STEP = getattr(settings, 'ONU_SIGNAL_STEP', 3600)
+
+# Days while history of ONU signal is kept
+ONU_SIGNAL_KEEP_DAYS = getattr(settings, 'ONU_SIGNAL_KEEP_DAYS', 365)
+
+
+class DevicePollResult(NamedTuple):
+    ports: tuple
+    # see devapp.base_intr.DevBase.get_onu_signals
+    onu_signals: Optional[dict]
+
+
+class DevicePollJob(object):
+    """
+    Read ports of one device, and state of all its ONUs if it is OLT.
+    It is executed in worker thread.
+    Result of job that is over its deadline is dropped.
+    """
+
+    def __init__(self, device: Device):
+        self.device = device
+        self.start_time = None
+        self._lock = Lock()
+
+    def __call__(self):
+        with self._lock:
+            self.start_time = monotonic()
+        try:
+            mngr = self.device.get_manager_object()
+            ports, onu_signals = mngr.poll_state()
+            ports = tuple(ports)
+            if len(ports) == 2 and isinstance(ports[0], Exception):
+                # some of drivers give error with part of ports
+                raise ports[0]
+            now = timezone.now()
+            return DevicePollResult(
+                ports=tuple(PortState.from_port(self.device.pk, p, now) for p in ports),
+                onu_signals=onu_signals
+            )
+        finally:
+            connection.close()
+
+    def is_expired(self, timeout: float) -> bool:
+        with self._lock:
+            return self.start_time is not None and \
+                   monotonic() - self.start_time > timeout
+
+
+def poll_devices(devices: Iterable[Device], workers=DEVICE_POLL_WORKERS,
+                 timeout=DEVICE_POLL_TIMEOUT) -> dict:
+    """
+    Poll ports of many devices with bounded count of threads.
+    Snmp call can not be interrupted, so device that has not
+    answered in *timeout* seconds from start of its poll
+    is left and its state is not changed.
+    :return: device id -> DevicePollResult
+    """
+    jobs = {}
+    results = {}
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        for dev in devices:
+            job = DevicePollJob(dev)
+            jobs[executor.submit(job)] = job
+        not_done = set(jobs.keys())
+        while not_done:
+            done, not_done = wait(not_done, timeout=1,
+                                  return_when=FIRST_COMPLETED)
+            for future in done:
+                dev = jobs[future].device
+                try:
+                    results[dev.pk] = future.result()
+                except (EasySNMPError, DeviceImplementationError,
+                        DeviceDBException, OSError, TypeError, ValueError) as e:
+                    # unknown type of device or bad value in its
+                    # tables do not stop store of others
+                    print('Device "%s" is not polled:' % dev, e)
+            for future in tuple(not_done):
+                job = jobs[future]
+                if job.is_expired(timeout):
+                    print('Device "%s" poll deadline has reached' % job.device)
+                    not_done.discard(future)
+    finally:
+        # threads of left devices end by snmp timeout
+        executor.shutdown(wait=False)
+    return results
+
+
+def store_onu_signals(signals_by_olt: dict, now) -> int:
+    """
+    Add samples of ONUs that were read from tables of their OLT
+    :param signals_by_olt: OLT device id -> result of get_onu_signals
+    :return: count of samples
+    """
+    states = {}
+    onus = Device.objects.filter(
+        parent_dev_id__in=tuple(signals_by_olt.keys())
+    ).exclude(snmp_extra=None).values_list('pk', 'parent_dev_id', 'snmp_extra')
+    for pk, olt_id, snmp_extra in onus.iterator():
+        state = signals_by_olt[olt_id].get(snmp_extra.strip())
+        if state is not None:
+            states[pk] = state
+    if not states:
+        return 0
+    return OnuSignalBlock.objects.append(states, now)
+
+
+def main():
+    start_time = monotonic()
+    devices = Device.objects.exclude(man_passw=None).exclude(
+        man_passw=''
+    ).select_related('parent_dev')
+    results = poll_devices(devices.iterator())
+    count = PortState.objects.store({
+        dev_id: r.ports for dev_id, r in results.items()
+    })
+    now = timezone.now()
+    onu_count = store_onu_signals({
+        dev_id: r.onu_signals for dev_id, r in results.items()
+        if r.onu_signals is not None
+    }, now)
+    today = now.date()
+    OnuSignalBlock.objects.filter(
+        day__lt=today - timedelta(days=ONU_SIGNAL_KEEP_DAYS)
+    ).delete()
+    OnuSignalBlock.objects.downsample(
+        today - timedelta(days=ONU_SIGNAL_RAW_DAYS), ONU_SIGNAL_STEP
+    )
+    print('Polled %(devs)d devices, %(ports)d ports, %(onus)d onu signals in %(time).3f sec' % {
+        'devs': len(results),
+        'ports': count,
+        'onus': onu_count,
+        'time': monotonic() - start_time
+    })
+
+
+if __name__ == "__main__":
+    main()